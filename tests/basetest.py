@@ -34,6 +34,10 @@ import datetime
 
 
 TEST_POOLS="test_source1 test_source2 test_target1"
+
+# dont use (or pollute) the real cache with probe results and manifests
+TEST_CACHE_DIR="/tmp/zfs_autobackup_test_cache"
+os.environ["XDG_CACHE_HOME"]=TEST_CACHE_DIR
 # ZFS_USERSPACE=  subprocess.check_output("dpkg-query -W zfsutils-linux |cut -f2", shell=True).decode('utf-8').rstrip()
 # ZFS_KERNEL=     subprocess.check_output("modinfo zfs|grep ^version |sed 's/.* //'", shell=True).decode('utf-8').rstrip()
 
@@ -99,6 +103,7 @@ def prepare_zpools():
     subprocess.call("zpool destroy test_source1 2>/dev/null", shell=True)
     subprocess.call("zpool destroy test_source2 2>/dev/null", shell=True)
     subprocess.call("zpool destroy test_target1 2>/dev/null", shell=True)
+    subprocess.call("rm -rf "+TEST_CACHE_DIR, shell=True)
 
     #create pools
     subprocess.check_call("zpool create test_source1 /dev/ram0", shell=True)
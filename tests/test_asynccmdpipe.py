@@ -0,0 +1,121 @@
+from basetest import *
+from zfs_autobackup.CmdPipe import CmdItem
+from zfs_autobackup.ExecuteNode import ExecuteNode, ExecuteError
+
+if sys.version_info >= (3, 5):
+    from zfs_autobackup.AsyncCmdPipe import AsyncCmdPipe, gather_bounded, run_sync
+
+
+@unittest2.skipIf(sys.version_info < (3, 5), "asyncio needs python 3.5+")
+class TestAsyncCmdPipe(unittest2.TestCase):
+
+    def test_single(self):
+        """single process stdout and stderr"""
+        p=AsyncCmdPipe(readonly=False, inp=None)
+        err=[]
+        out=[]
+        p.add(CmdItem(["sh", "-c", "echo out1;echo err1 >&2; echo out2; echo err2 >&2"], stderr_handler=lambda line: err.append(line), exit_handler=lambda exit_code: self.assertEqual(exit_code,0), stdout_handler=lambda line: out.append(line)))
+        executed=run_sync(p.execute())
+
+        self.assertEqual(out, ["out1", "out2"])
+        self.assertEqual(err, ["err1","err2"])
+        self.assertIsNone(executed)
+
+    def test_input(self):
+        """test stdinput"""
+        p=AsyncCmdPipe(readonly=False, inp="test")
+        out=[]
+        p.add(CmdItem(["cat"], exit_handler=lambda exit_code: self.assertEqual(exit_code,0), stdout_handler=lambda line: out.append(line) ))
+        executed=run_sync(p.execute())
+
+        self.assertEqual(out, ["test"])
+        self.assertIsNone(executed)
+
+    def test_pipe(self):
+        """test piped"""
+        p=AsyncCmdPipe(readonly=False)
+        out=[]
+        p.add(CmdItem(["echo", "test"], exit_handler=lambda exit_code: self.assertEqual(exit_code,0)))
+        p.add(CmdItem(["tr", "e", "E"], exit_handler=lambda exit_code: self.assertEqual(exit_code,0)))
+        p.add(CmdItem(["tr", "t", "T"], exit_handler=lambda exit_code: self.assertEqual(exit_code,0), stdout_handler=lambda line: out.append(line)))
+        executed=run_sync(p.execute())
+
+        self.assertEqual(out, ["TEsT"])
+        self.assertIsNone(executed)
+
+    def test_exitcode(self):
+        """test piped exitcodes """
+        p=AsyncCmdPipe(readonly=False)
+        codes=[]
+        p.add(CmdItem(["sh", "-c", "exit 1"], exit_handler=lambda exit_code: codes.append(exit_code)))
+        p.add(CmdItem(["sh", "-c", "exit 2"], exit_handler=lambda exit_code: codes.append(exit_code), stdout_handler=lambda line: None))
+        executed=run_sync(p.execute())
+
+        self.assertEqual(codes, [1, 2])
+        self.assertIsNone(executed)
+
+    def test_readonly_skip(self):
+        """one command not readonly, skip"""
+
+        p=AsyncCmdPipe(readonly=True)
+        out=[]
+        p.add(CmdItem(["echo", "test1"], readonly=False))
+        p.add(CmdItem(["echo", "test2"], readonly=True, stdout_handler=lambda line: out.append(line)))
+        executed=run_sync(p.execute())
+
+        self.assertEqual(out, [])
+        self.assertTrue(executed)
+
+    def test_manual_pipes(self):
+
+        result=[]
+
+        def stdout_handler(line):
+            item2.process.stdin.write(line.encode('utf8'))
+
+        item1=CmdItem(["echo", "test"], stdout_handler=stdout_handler)
+        item2=CmdItem(["tr", "e", "E"], stdout_handler=lambda line: result.append(line))
+
+        p=AsyncCmdPipe()
+        p.add(item1)
+        p.add(item2)
+        run_sync(p.execute())
+
+        self.assertEqual(result, ["tEst"])
+
+    def test_run_async(self):
+        """ExecuteNode.run_async() has the same results as run()"""
+        node=ExecuteNode(debug_output=True)
+
+        self.assertEqual(run_sync(node.run_async(["echo", "test"])), node.run(["echo", "test"]))
+        self.assertEqual(run_sync(node.run_async(["echo", "a\tb"], tab_split=True)), [["a", "b"]])
+        self.assertEqual(run_sync(node.run_async(["cat"], inp="test")), ["test"])
+
+        with self.assertRaises(ExecuteError):
+            run_sync(node.run_async(["sh", "-c", "exit 1"]))
+
+        self.assertEqual(run_sync(node.run_async(["sh", "-c", "exit 1"], valid_exitcodes=[1], return_all=True)), ([], [], 1))
+
+        # missing executable: same exit code as run()
+        self.assertEqual(run_sync(node.run_async(["nonexisting_command"], valid_exitcodes=[127], return_all=True))[2],
+                         node.run(["nonexisting_command"], valid_exitcodes=[127], return_all=True)[2])
+
+        # pipes
+        pipe=node.run(["echo", "test"], pipe=True, inp=AsyncCmdPipe())
+        self.assertEqual(run_sync(node.run_async(["tr", "e", "E"], inp=pipe)), ["tEst"])
+
+    def test_gather_bounded(self):
+        """runs at most limit commands at the same time, and keeps the order"""
+        node=ExecuteNode()
+
+        start_time=time.time()
+        results=run_sync(gather_bounded([node.run_async(["sh", "-c", "sleep 0.2; echo {}".format(i)]) for i in range(0, 6)], 3))
+        duration=time.time()-start_time
+
+        self.assertEqual(results, [[str(i)] for i in range(0, 6)])
+        self.assertGreater(duration, 0.4)
+        self.assertLess(duration, 1.1)
+
+        results=run_sync(gather_bounded([node.run_async(["false"], hide_errors=True), node.run_async(["echo", "ok"])], 2, return_exceptions=True))
+        self.assertIsInstance(results[0], ExecuteError)
+        self.assertEqual(results[1], ["ok"])
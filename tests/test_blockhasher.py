@@ -1,5 +1,5 @@
 from basetest import *
-from zfs_autobackup.BlockHasher import BlockHasher
+from zfs_autobackup.BlockHasher import BlockHasher, IO_MODES
 
 
 # make VERY sure this works correctly under all circumstances.
@@ -154,4 +154,118 @@ class TestBlockHasher(unittest2.TestCase):
             ]
         )
 
-    #NOTE: compare doesnt use skip. thats the job of its input generator
\ No newline at end of file
+    #NOTE: compare doesnt use skip. thats the job of its input generator
+    def test_threads(self):
+        # threaded hashing should give exactly the same result, in the same order
+        for skip in [0, 1, 2]:
+            with self.subTest("skip {}".format(skip)):
+                block_hasher = BlockHasher(count=1, skip=skip)
+                threaded_hasher = BlockHasher(count=1, skip=skip, threads=4)
+                for fname in ["tests/data/empty", "tests/data/whole_whole2_partial", "tests/data/whole_whole2_partial"]:
+                    self.assertEqual(
+                        list(threaded_hasher.generate(fname)),
+                        list(block_hasher.generate(fname))
+                    )
+
+        with self.subTest("compare"):
+            threaded_hasher = BlockHasher(count=1, threads=4)
+            self.assertEqual(
+                list(threaded_hasher.compare("tests/data/whole_whole2_partial", [
+                    (0, "3c0bf91170d873b8e327d3bafb6bc074580d11b7"),  # whole
+                    (1, "2e863f1fcccd6642e4e28453eba10d2d3f74d799"),  # whole2 with wrong sum
+                    (2, "642027d63bb0afd7e0ba197f2c66ad03e3d70de1"),  # partial
+                    (3, "642027d63bb0afd7e0ba197f2c66ad03e3d70de1"),  # past end
+                ])),
+                [
+                    (1, "2e863f1fcccd6642e4e28453eba10d2d3f74d799", "2e863f1fcccd6642e4e28453eba10d2d3f74d798"),
+                    (3, "642027d63bb0afd7e0ba197f2c66ad03e3d70de1", "EOF"),
+                ]
+            )
+
+    def test_io_modes(self):
+        # all io modes should hash exactly the same data
+        for io_mode in IO_MODES:
+            for bs in [1000, 4096]:
+                with self.subTest("{} bs {}".format(io_mode, bs)):
+                    block_hasher = BlockHasher(count=1, bs=bs)
+                    other_hasher = BlockHasher(count=1, bs=bs, io_mode=io_mode)
+                    self.assertEqual(
+                        list(other_hasher.generate("tests/data/whole_whole2_partial")),
+                        list(block_hasher.generate("tests/data/whole_whole2_partial"))
+                    )
+                    self.assertEqual(
+                        list(other_hasher.compare("tests/data/whole_whole2_partial", block_hasher.generate("tests/data/whole_whole2_partial"))),
+                        []
+                    )
+
+        with self.subTest("small io size"):
+            # force multiple reads per chunk
+            block_hasher = BlockHasher(count=2)
+            block_hasher.io_size = 1000
+            self.assertEqual(
+                list(block_hasher.generate("tests/data/whole_whole2_partial")),
+                list(BlockHasher(count=2, io_mode="read").generate("tests/data/whole_whole2_partial"))
+            )
+
+    def test_offset(self):
+        # every offset checks different chunks, together they check all chunks exactly once
+        all_chunks = list(BlockHasher(count=1).generate("tests/data/whole_whole2_partial"))
+        checked = []
+        for offset in range(3):
+            checked.extend(BlockHasher(count=1, skip=2, offset=offset).generate("tests/data/whole_whole2_partial"))
+
+        self.assertEqual(sorted(checked), all_chunks)
+        self.assertEqual(
+            list(BlockHasher(count=1, skip=2, offset=1).generate("tests/data/whole_whole2_partial")),
+            [(1, "2e863f1fcccd6642e4e28453eba10d2d3f74d798")]
+        )
+
+    def test_holes(self):
+        # sparse file with: hole, data, partial hole, zeros that are not a hole, and a hole at the end
+        with open("/tmp/testsparse", "wb") as fh:
+            fh.seek(8192)
+            fh.write(b"x" * 4096)
+            fh.seek(4096*4+100)
+            fh.write(b"y" * 100)
+            fh.seek(4096*6)
+            fh.write(b"\0" * 8192)
+            fh.truncate(4096*11)
+
+        expected = list(BlockHasher(count=2, io_mode="read").generate("/tmp/testsparse"))
+        self.assertEqual(len(expected), 6)
+        for io_mode in IO_MODES:
+            for holes in [True, False]:
+                with self.subTest(io_mode + " holes={}".format(holes)):
+                    block_hasher = BlockHasher(count=2, io_mode=io_mode, holes=holes)
+                    self.assertEqual(list(block_hasher.generate("/tmp/testsparse")), expected)
+                    self.assertEqual(list(block_hasher.compare("/tmp/testsparse", expected)), [])
+
+    def test_skip_exact_chunks(self):
+        # file size is an exact multiple of the chunk size: should never hash past the end
+        block_hasher = BlockHasher(count=1, skip=1)
+        self.assertEqual(
+            list(block_hasher.generate("tests/data/whole")),
+            [(0, "3c0bf91170d873b8e327d3bafb6bc074580d11b7")]
+        )
+        self.assertEqual(
+            list(block_hasher.generate("tests/data/whole")),
+            []
+        )
+        self.assertEqual(
+            list(block_hasher.generate("tests/data/whole")),
+            [(0, "3c0bf91170d873b8e327d3bafb6bc074580d11b7")]
+        )
+
+    def test_skip_compatible(self):
+        # files that dont end on a chunk boundary should still get the same samples as older versions
+        block_hasher = BlockHasher(count=1, skip=2)
+        self.assertEqual(
+            [list(block_hasher.generate("tests/data/" + f)) for f in
+             ["partial", "whole_whole2_partial", "partial", "whole_whole2_partial"]],
+            [
+                [(0, "642027d63bb0afd7e0ba197f2c66ad03e3d70de1")],
+                [(2, "642027d63bb0afd7e0ba197f2c66ad03e3d70de1")],
+                [],
+                [(1, "2e863f1fcccd6642e4e28453eba10d2d3f74d798")],
+            ]
+        )
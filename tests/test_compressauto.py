@@ -0,0 +1,104 @@
+from basetest import *
+from zfs_autobackup.CompressAuto import CompressAuto
+from zfs_autobackup.ExecuteNode import ExecuteNode
+
+
+class TestCompressAuto(unittest2.TestCase):
+
+    def test_best(self):
+
+        results = {
+            'fast': (50, 1.0),  # halves the data, at 100 bytes/s
+            'slow': (10, 10.0),  # much smaller, at 10 bytes/s
+        }
+
+        with self.subTest("fast link, compression only slows us down"):
+            self.assertEqual(None, CompressAuto.best(100, 0.1, results))
+
+        with self.subTest("medium link, fast compressor wins"):
+            self.assertEqual('fast', CompressAuto.best(100, 4.0, results))
+
+        with self.subTest("very slow link, best compression wins"):
+            self.assertEqual('slow', CompressAuto.best(100, 200.0, results))
+
+        with self.subTest("no compressors available"):
+            self.assertEqual(None, CompressAuto.best(100, 200.0, {}))
+
+        with self.subTest("slow reading, compression only slows us down"):
+            self.assertEqual(None, CompressAuto.best(100, 4.0, results, read_time=20.0))
+
+    def test_measure(self):
+        """measure with local commands. (the sample comes from a file instead of zfs send)"""
+
+        class QuietNode(ExecuteNode):
+            def verbose(self, txt):
+                pass
+
+            def debug(self, txt, *args):
+                pass
+
+        class SlowLinkNode(QuietNode):
+            # every transfer to us takes 2 seconds extra
+            def run(self, cmd, inp=None, **kwargs):
+                if cmd == ["wc", "-c"]:
+                    time.sleep(2)
+                return super(SlowLinkNode, self).run(cmd, inp=inp, **kwargs)
+
+        def measure(target_node, sample_cmd):
+            compress_auto = CompressAuto(QuietNode(), target_node, None, sample_size=1024 * 1024)
+            compress_auto.sample_cmd = lambda snapshot, zfs_compressed: sample_cmd
+            return compress_auto.measure(None, False)
+
+        with self.subTest("incompressible data over a fast link"):
+            self.assertEqual(None, measure(QuietNode(), ["head", "-c", "1000000", "/dev/urandom"]))
+
+        with self.subTest("compressible data over a slow link"):
+            self.assertIsNotNone(measure(SlowLinkNode(), ["yes", ExecuteNode.PIPE, "head", "-c", "1000000"]))
+
+        with self.subTest("temporary sample file is removed"):
+            self.assertEqual([], [name for name in os.listdir("/tmp") if name.endswith("-compress-sample")])
+
+    def test_select_fallback(self):
+        """a failed measurement, or test mode, should fall back to no compression"""
+
+        class RemoteNode(ExecuteNode):
+            def is_local(self):
+                return False
+
+            def verbose(self, txt):
+                pass
+
+            def debug(self, txt, *args):
+                pass
+
+            def warning(self, txt):
+                self.warnings.append(txt)
+
+        class Dataset(object):
+            snapshots = ["test_source1/fs1@test"]
+
+            def get_property(self, name):
+                return "1000"
+
+        state_file = StateFile("compress-auto-test.json")
+        state_file.set("source -> target", None)
+
+        with self.subTest("measuring fails"):
+            source_node = RemoteNode()
+            source_node.warnings = []
+            compress_auto = CompressAuto(source_node, RemoteNode(), state_file)
+            compress_auto.key = lambda: "source -> target"
+            compress_auto.sample_cmd = lambda snapshot, zfs_compressed: ["false"]
+
+            self.assertEqual(None, compress_auto.select([Dataset()], False))
+            self.assertEqual(1, len(source_node.warnings))
+            # (not remembered, so it tries again next time)
+            self.assertEqual(None, state_file.get("source -> target"))
+
+        with self.subTest("test mode doesnt measure"):
+            source_node = RemoteNode(readonly=True)
+            compress_auto = CompressAuto(source_node, RemoteNode(readonly=True), state_file)
+            compress_auto.key = lambda: "source -> target"
+            with patch.object(compress_auto, 'measure') as measure:
+                self.assertEqual(None, compress_auto.select([Dataset()], False))
+                measure.assert_not_called()
@@ -68,6 +68,24 @@ class TestExecuteNode(unittest2.TestCase):
         node=ExecuteNode(ssh_to="localhost", debug_output=True)
         self.basics(node)
 
+    def test_direct_exec(self):
+        """simple local commands are started without a shell"""
+        node=ExecuteNode(debug_output=True)
+
+        with self.subTest("no shell"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    self.assertEqual(node.run(["sh", "-c", "echo $PPID"]), [str(os.getpid())])
+                    node.run(["echo", "a b"])
+
+                # still copy-pastable
+                self.assertIn("CMD    > (echo 'a b')", buf.getvalue())
+
+        with self.subTest("missing command, same as with a shell"):
+            (stdout, stderr, exit_code)=node.run(["nonexisting_command"], valid_exitcodes=[127], return_all=True)
+            self.assertEqual(exit_code, 127)
+            self.assertRegex(stderr[0], "not found")
+
     ################
 
     def test_readonly(self):
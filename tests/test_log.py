@@ -1,5 +1,7 @@
 from zfs_autobackup.LogConsole import LogConsole
+from zfs_autobackup.LogJson import LogJson
 from basetest import *
+import json
 
 
 class TestLog(unittest2.TestCase):
@@ -48,5 +50,66 @@ class TestLog(unittest2.TestCase):
 
         # zfs_autobackup.LogConsole.colorama=False
 
+    def test_lazy_format(self):
+        """debug arguments should only be formatted when debug is enabled"""
 
+        class Counter:
+            count = 0
 
+            def __str__(self):
+                Counter.count = Counter.count + 1
+                return "counter"
+
+        with OutputIO() as buf:
+            with redirect_stdout(buf):
+                l = LogConsole(show_verbose=False, show_debug=False, color=False)
+                l.debug("value {}", Counter())
+                self.assertEqual(Counter.count, 0)
+
+                l = LogConsole(show_verbose=False, show_debug=True, color=False)
+                l.debug("value {}", Counter())
+                self.assertEqual(Counter.count, 1)
+
+            self.assertEqual(buf.getvalue(), "# value counter\n")
+
+    def test_json(self):
+        """test json lines output"""
+
+        json_file = "/tmp/zfs_autobackup_test_log.json"
+        if os.path.exists(json_file):
+            os.unlink(json_file)
+
+        with OutputIO() as buf:
+            with redirect_stdout(buf), redirect_stderr(buf):
+                json_log = LogJson(json_file)
+                l = LogConsole(show_verbose=True, show_debug=False, color=False, json_log=json_log)
+                l.verbose("verbose")
+                l.debug("debug")
+                l.error("error {}")
+                json_log.close()
+
+        with open(json_file) as fh:
+            records = [json.loads(line) for line in fh]
+
+        self.assertEqual([(r['level'], r['message']) for r in records], [("verbose", "verbose"), ("error", "error {}")])
+        self.assertIn("time", records[0])
+
+    def test_json_stalled(self):
+        """a fifo without reader should never block startup or exit"""
+
+        json_file = "/tmp/zfs_autobackup_test_log.fifo"
+        if os.path.exists(json_file):
+            os.unlink(json_file)
+        os.mkfifo(json_file)
+
+        try:
+            start = time.time()
+            json_log = LogJson(json_file, max_queue=10, close_timeout=0.5)
+            for i in range(20):
+                json_log.log("verbose", "message {}".format(i))
+            json_log.close()
+
+            self.assertLess(time.time() - start, 5)
+            self.assertEqual(json_log.dropped, 10)
+        finally:
+            os.unlink(json_file)
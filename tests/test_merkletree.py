@@ -0,0 +1,54 @@
+from basetest import *
+from zfs_autobackup.MerkleTree import MerkleTree
+import hashlib
+
+
+def leaves(count, changes=()):
+    ret = [hashlib.sha1(str(i).encode()).hexdigest() for i in range(count)]
+    for i in changes:
+        ret[i] = hashlib.sha1(b"changed").hexdigest()
+    return ret
+
+
+class TestMerkleTree(unittest2.TestCase):
+
+    def diff(self, local, remote):
+        """returns (different leaves, number of remote nodes requested)"""
+
+        requested = [0]
+
+        def get_remote_nodes(level, indexes):
+            requested[0] = requested[0] + len(indexes)
+            return remote.get_nodes(level, indexes)
+
+        return (local.diff(get_remote_nodes, len(remote.levels[0])), requested[0])
+
+    def test_shape(self):
+        self.assertEqual(MerkleTree.level_sizes(0, 4), [0, 1])
+        self.assertEqual(MerkleTree.level_sizes(1, 4), [1, 1])
+        self.assertEqual(MerkleTree.level_sizes(17, 4), [17, 5, 2, 1])
+        self.assertEqual([len(level) for level in MerkleTree(leaves(17), fanout=4).levels], [17, 5, 2, 1])
+
+    def test_equal(self):
+        (different, requested) = self.diff(MerkleTree(leaves(1000)), MerkleTree(leaves(1000)))
+        self.assertEqual(different, [])
+        # just the root
+        self.assertEqual(requested, 1)
+
+    def test_changes(self):
+        (different, requested) = self.diff(MerkleTree(leaves(1000), fanout=4), MerkleTree(leaves(1000, [5, 999]), fanout=4))
+        self.assertEqual(different, [5, 999])
+        self.assertLess(requested, 50)
+
+    def test_sizes(self):
+        with self.subTest("remote has more leaves"):
+            (different, requested) = self.diff(MerkleTree(leaves(1000), fanout=4), MerkleTree(leaves(1003), fanout=4))
+            self.assertEqual(different, [1000, 1001, 1002])
+
+        with self.subTest("remote has less leaves, other height"):
+            (different, requested) = self.diff(MerkleTree(leaves(17), fanout=4), MerkleTree(leaves(3, [1]), fanout=4))
+            self.assertEqual(different, [1] + list(range(3, 17)))
+
+        with self.subTest("empty"):
+            (different, requested) = self.diff(MerkleTree(leaves(0)), MerkleTree(leaves(0)))
+            self.assertEqual(different, [])
@@ -79,6 +79,94 @@ test_target1/test_source2/fs2/sub@test-20101111000003
 
                 shelltest("zfs destroy -r test_target1/test_source1/fs1/sub")
 
+    def test_compress_skip(self):
+        """datasets that are already compressed by zfs are sent without --compress"""
+
+        shelltest("zfs set compression=gzip test_source1/fs1")
+        shelltest("yes | head -c 10000000 > /test_source1/fs1/compressible")
+
+        with OutputIO() as buf:
+            with redirect_stdout(buf):
+                with mocktime("20101111000000"):
+                    self.assertFalse(ZfsAutobackup(
+                        ["test", "test_target1", "--exclude-received", "--no-holds", "--no-progress", "--verbose",
+                         "--compress=gzip", "--zfs-compressed"]).run())
+
+            print(buf.getvalue())
+            self.assertRegex(buf.getvalue(), "test_source1/fs1: Not using compression: already compressed by zfs")
+
+    def test_transfer_properties(self):
+        """transfer options from user properties, per dataset"""
+
+        shelltest("zfs set autobackup:test:compress=gzip test_source1/fs1")
+        shelltest("zfs set autobackup:test:compress=none test_source1/fs1/sub")
+        shelltest("zfs set autobackup:test:buffer=1M test_source1/fs1/sub")
+
+        with self.subTest("valid"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    with mocktime("20101111000000"):
+                        self.assertFalse(ZfsAutobackup(
+                            ["test", "test_target1", "--exclude-received", "--no-holds", "--no-progress", "--verbose",
+                             "--compress=xz"]).run())
+
+                print(buf.getvalue())
+                self.assertIn("test_source1/fs1: zfs send compression   : gzip -3", buf.getvalue())
+                self.assertIn("test_source1/fs1/sub: zfs send buffer        : 1M", buf.getvalue())
+                self.assertNotIn("test_source1/fs1/sub: zfs send compression", buf.getvalue())
+
+        with self.subTest("commands in properties are never used"):
+            shelltest("rm -f /tmp/zfs_autobackup_injected")
+            shelltest("zfs set 'autobackup:test:send-pipe=touch /tmp/zfs_autobackup_injected' test_source1/fs1")
+            with mocktime("20101111000001"):
+                self.assertFalse(ZfsAutobackup(
+                    ["test", "test_target1", "--exclude-received", "--no-holds", "--no-progress", "--verbose",
+                     "--allow-empty"]).run())
+            self.assertFalse(os.path.exists("/tmp/zfs_autobackup_injected"))
+
+        with self.subTest("invalid"):
+            shelltest("zfs set autobackup:test:compress=nonexisting test_source2")
+            with mocktime("20101111000002"):
+                self.assertEqual(1, ZfsAutobackup(
+                    ["test", "test_target1", "--exclude-received", "--no-holds", "--no-progress", "--verbose",
+                     "--allow-empty"]).run())
+
+    def test_compress_auto(self):
+        """auto compression measures once, and then uses the remembered result"""
+
+        with self.subTest("measure"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    with mocktime("20101111000000"):
+                        self.assertFalse(ZfsAutobackup(
+                            ["test", "test_target1", "--exclude-received", "--no-holds", "--no-progress", "--verbose",
+                             "--ssh-target=localhost", "--compress=auto"]).run())
+
+                print(buf.getvalue())
+                self.assertIn("Auto compression: measuring with", buf.getvalue())
+
+        with self.subTest("remembered"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    with mocktime("20101111000001"):
+                        self.assertFalse(ZfsAutobackup(
+                            ["test", "test_target1", "--exclude-received", "--no-holds", "--no-progress", "--verbose",
+                             "--ssh-target=localhost", "--compress=auto"]).run())
+
+                print(buf.getvalue())
+                self.assertIn("(measured earlier)", buf.getvalue())
+
+        with self.subTest("local"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    with mocktime("20101111000002"):
+                        self.assertFalse(ZfsAutobackup(
+                            ["test", "test_target1", "--exclude-received", "--no-holds", "--no-progress", "--verbose",
+                             "--compress=auto"]).run())
+
+                print(buf.getvalue())
+                self.assertIn("transfer is local, not using compression", buf.getvalue())
+
     def test_buffer(self):
         """test different buffer configurations"""
 
@@ -144,3 +232,27 @@ test_target1/test_source2/fs2/sub@test-20101111000003
 
         # not a great way of verifying but it works.
         self.assertGreater(time.time() - start, 5)
+
+    def test_stream_checksum(self):
+
+        with mocktime("20101111000000"):
+            self.assertFalse(ZfsAutobackup(
+                ["test", "test_target1", "--allow-empty", "--exclude-received", "--no-holds", "--no-progress",
+                 "--stream-checksum", "--compress=gzip"]).run())
+
+        source = shelltest("zfs get -H -o value autobackup:test:stream-md5 test_source1/fs1@test-20101111000000").strip()
+        target = shelltest("zfs get -H -o value autobackup:test:stream-md5 test_target1/test_source1/fs1@test-20101111000000").strip()
+        self.assertRegex(source, "^[0-9a-f]{32}$")
+        self.assertEqual(source, target)
+
+    def test_stream_checksum_missing(self):
+        """a missing stream checksum fails the transfer"""
+
+        with patch.object(ZfsNode, 'pop_stream_hash', return_value=None):
+            with mocktime("20101111000000"):
+                self.assertEqual(3, ZfsAutobackup(
+                    ["test", "test_target1", "--allow-empty", "--exclude-received", "--no-holds", "--no-progress",
+                     "--stream-checksum"]).run())
+
+        r = shelltest("zfs get -H -o value autobackup:test:stream-md5 test_source1/fs1@test-20101111000000").strip()
+        self.assertEqual(r, "-")
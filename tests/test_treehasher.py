@@ -82,3 +82,101 @@ class TestTreeHasher(unittest2.TestCase):
                              [('whole', '-', '-', "ERROR: [Errno 2] No such file or directory: '/tmp/treehashertest/whole'")])
 
 
+
+    def test_treehasher_threads(self):
+        shelltest("rm -rf /tmp/treehashertest; mkdir /tmp/treehashertest")
+        shelltest("cp tests/data/whole /tmp/treehashertest")
+        shelltest("mkdir /tmp/treehashertest/emptydir")
+        shelltest("mkdir /tmp/treehashertest/dir")
+        shelltest("cp tests/data/whole_whole2_partial /tmp/treehashertest/dir")
+
+        # it should ignore these:
+        shelltest("ln -s / /tmp/treehashertest/symlink")
+        shelltest("mkfifo /tmp/treehashertest/f")
+
+        # with threads the output is sorted by name
+        block_hasher = BlockHasher(count=1, skip=0, threads=4)
+        tree_hasher = TreeHasher(block_hasher)
+        with self.subTest("Test output, count 1, skip 0"):
+            self.assertEqual(list(tree_hasher.generate("/tmp/treehashertest")), [
+                ('dir/whole_whole2_partial', 0, '3c0bf91170d873b8e327d3bafb6bc074580d11b7'),
+                ('dir/whole_whole2_partial', 1, '2e863f1fcccd6642e4e28453eba10d2d3f74d798'),
+                ('dir/whole_whole2_partial', 2, '642027d63bb0afd7e0ba197f2c66ad03e3d70de1'),
+                ('whole', 0, '3c0bf91170d873b8e327d3bafb6bc074580d11b7'),
+            ])
+
+        block_hasher = BlockHasher(count=1, skip=1, threads=4)
+        tree_hasher = TreeHasher(block_hasher)
+        with self.subTest("Test output, count 1, skip 1"):
+            self.assertEqual(list(tree_hasher.generate("/tmp/treehashertest")), [
+                ('dir/whole_whole2_partial', 0, '3c0bf91170d873b8e327d3bafb6bc074580d11b7'),
+                # ('dir/whole_whole2_partial', 1, '2e863f1fcccd6642e4e28453eba10d2d3f74d798'),
+                ('dir/whole_whole2_partial', 2, '642027d63bb0afd7e0ba197f2c66ad03e3d70de1'),
+                # ('whole', 0, '3c0bf91170d873b8e327d3bafb6bc074580d11b7'),
+            ])
+
+        block_hasher = BlockHasher(count=1, threads=4)
+        tree_hasher = TreeHasher(block_hasher)
+        with self.subTest("Test mismatch"):
+            generator = list(tree_hasher.generate("/tmp/treehashertest"))
+            shelltest("cp tests/data/whole2 /tmp/treehashertest/whole")
+
+            self.assertEqual(list(tree_hasher.compare("/tmp/treehashertest", generator)),
+                             [('whole',
+                               0,
+                               '3c0bf91170d873b8e327d3bafb6bc074580d11b7',
+                               '2e863f1fcccd6642e4e28453eba10d2d3f74d798')])
+
+    def test_treehasher_file_names(self):
+        shelltest("rm -rf /tmp/treehashertest; mkdir /tmp/treehashertest")
+        shelltest("cp tests/data/whole /tmp/treehashertest")
+        shelltest("mkdir /tmp/treehashertest/dir")
+        shelltest("cp tests/data/whole_whole2_partial /tmp/treehashertest/dir")
+        shelltest("cp tests/data/whole2 /tmp/treehashertest/dir/whole2")
+        shelltest("ln -s / /tmp/treehashertest/symlink")
+
+        # only the specified regular files are hashed, sorted like a full tree. (missing files and symlinks are ignored)
+        block_hasher = BlockHasher(count=1, skip=0)
+        tree_hasher = TreeHasher(block_hasher)
+        with self.subTest("Test output, file names"):
+            self.assertEqual(list(tree_hasher.generate("/tmp/treehashertest", ["whole", "symlink", "deleted", "dir/whole_whole2_partial"])), [
+                ('dir/whole_whole2_partial', 0, '3c0bf91170d873b8e327d3bafb6bc074580d11b7'),
+                ('dir/whole_whole2_partial', 1, '2e863f1fcccd6642e4e28453eba10d2d3f74d798'),
+                ('dir/whole_whole2_partial', 2, '642027d63bb0afd7e0ba197f2c66ad03e3d70de1'),
+                ('whole', 0, '3c0bf91170d873b8e327d3bafb6bc074580d11b7'),
+            ])
+
+        with self.subTest("Test output, no file names"):
+            self.assertEqual(list(tree_hasher.generate("/tmp/treehashertest", [])), [])
+
+    def test_treehasher_sort_listdir(self):
+        shelltest("rm -rf /tmp/treehashertest; mkdir /tmp/treehashertest")
+        shelltest("cp tests/data/whole /tmp/treehashertest")
+        shelltest("mkdir /tmp/treehashertest/dir")
+        shelltest("cp tests/data/whole_whole2_partial /tmp/treehashertest/dir")
+        shelltest("cp tests/data/whole2 /tmp/treehashertest/dir/whole2")
+        shelltest("mkdir /tmp/treehashertest/emptydir")
+        shelltest("ln -s / /tmp/treehashertest/symlink")
+        shelltest("mkfifo /tmp/treehashertest/f")
+
+        # without os.scandir (python 2) the tree should be walked in the same sorted order
+        tree_hasher = TreeHasher(BlockHasher(count=1, skip=1), sort=True)
+        expected = list(tree_hasher.generate("/tmp/treehashertest"))
+
+        scandir = getattr(os, "scandir", None)
+        if scandir is not None:
+            del os.scandir
+        try:
+            tree_hasher = TreeHasher(BlockHasher(count=1, skip=1), sort=True)
+            self.assertEqual(list(tree_hasher.generate("/tmp/treehashertest")), expected)
+        finally:
+            if scandir is not None:
+                os.scandir = scandir
+
+        self.assertEqual(expected, [
+            ('dir/whole2', 0, '2e863f1fcccd6642e4e28453eba10d2d3f74d798'),
+            # ('dir/whole_whole2_partial', 0, '3c0bf91170d873b8e327d3bafb6bc074580d11b7'),
+            ('dir/whole_whole2_partial', 1, '2e863f1fcccd6642e4e28453eba10d2d3f74d798'),
+            # ('dir/whole_whole2_partial', 2, '642027d63bb0afd7e0ba197f2c66ad03e3d70de1'),
+            ('whole', 0, '3c0bf91170d873b8e327d3bafb6bc074580d11b7'),
+        ])
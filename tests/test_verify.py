@@ -1,12 +1,11 @@
 
+import re
 from basetest import *
 
 
 # test zfs-verify:
 # - when there is no common snapshot at all
-# - when encryption key not loaded
 # - --test mode
-# - --fs-compare methods
 # - on snapshots of datasets:
 #   - that are correct
 #   - that are different
@@ -14,14 +13,17 @@ from basetest import *
 #  - that are correct
 #  - that are different
 # - test all directions (local, remote/local, local/remote, remote/remote)
+# - in parallel
 #
 
+# zfs-check of this source tree, also via ssh
+CHECK_COMMAND = "--check-command=PYTHONPATH={} python3 -m zfs_autobackup.ZfsCheck".format(os.getcwd())
+
+
 class TestZfsVerify(unittest2.TestCase):
 
 
     def setUp(self):
-        self.skipTest("WIP")
-
         prepare_zpools()
 
         #create actual test files and data
@@ -68,35 +70,77 @@ class TestZfsVerify(unittest2.TestCase):
         with self.subTest("default --test"):
             self.assertFalse(ZfsAutoverify("test test_target1 --verbose --test".split(" ")).run())
 
-        with self.subTest("rsync, remote source and target. (not supported, all 6 fail)"):
-            self.assertEqual(6, ZfsAutoverify("test test_target1 --ssh-source=localhost --ssh-target=localhost --verbose --exclude-received --fs-compare=rsync".split(" ")).run())
-
         def runchecked(testname, command):
             with self.subTest(testname):
                 with OutputIO() as buf:
                     result=None
                     with redirect_stderr(buf):
-                        result=ZfsAutoverify(command.split(" ")).run()
+                        result=ZfsAutoverify(command.split(" ") + [CHECK_COMMAND]).run()
 
                     print(buf.getvalue())
                     self.assertEqual(2,result)
                     self.assertRegex(buf.getvalue(), "bad_filesystem: FAILED:")
                     self.assertRegex(buf.getvalue(), "bad_zvol: FAILED:")
 
-        runchecked("rsync, remote source", "test test_target1 --ssh-source=localhost --verbose --exclude-received --fs-compare=rsync")
-        runchecked("rsync, remote target", "test test_target1 --ssh-target=localhost --verbose --exclude-received --fs-compare=rsync")
-        runchecked("rsync, local", "test test_target1 --verbose --exclude-received --fs-compare=rsync")
+        runchecked("remote source and remote target",
+                   "test test_target1 --ssh-source=localhost --ssh-target=localhost --verbose --exclude-received")
+        runchecked("remote source",
+                   "test test_target1 --ssh-source=localhost --verbose --exclude-received")
+        runchecked("remote target",
+                   "test test_target1 --ssh-target=localhost --verbose --exclude-received")
+        runchecked("local", "test test_target1 --verbose --exclude-received")
+        runchecked("local, parallel", "test test_target1 --verbose --exclude-received --parallel 4")
 
-        runchecked("tar, remote source and remote target",
-                   "test test_target1 --ssh-source=localhost --ssh-target=localhost --verbose --exclude-received --fs-compare=find")
-        runchecked("tar, remote source",
-                   "test test_target1 --ssh-source=localhost --verbose --exclude-received --fs-compare=find")
-        runchecked("tar, remote target",
-                   "test test_target1 --ssh-target=localhost --verbose --exclude-received --fs-compare=find")
-        runchecked("tar, local", "test test_target1 --verbose --exclude-received --fs-compare=find")
+        with self.subTest("timeout"):
+            self.assertEqual(6, ZfsAutoverify("test test_target1 --verbose --exclude-received --timeout 0".split(" ") + [CHECK_COMMAND]).run())
 
         with self.subTest("no common snapshot"):
             #destroy common snapshot, now 3 should fail
             shelltest("zfs destroy test_source1/fs1/ok_zvol@test-20101111000000")
-            self.assertEqual(3, ZfsAutoverify("test test_target1 --verbose --exclude-received".split(" ")).run())
+            self.assertEqual(3, ZfsAutoverify("test test_target1 --verbose --exclude-received".split(" ") + [CHECK_COMMAND]).run())
+
+    def test_verify_incremental(self):
+
+        args = "test test_target1 --verbose --exclude-received --incremental".split(" ") + [CHECK_COMMAND]
+
+        with self.subTest("first run verifies everything"):
+            self.assertEqual(2, ZfsAutoverify(args).run())
+
+        with self.subTest("second run only verifies what failed"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    result = ZfsAutoverify(args).run()
+
+                print(buf.getvalue())
+                self.assertRegex(buf.getvalue(), "ok_filesystem@test-20101111000000: Nothing changed since last verification")
+                self.assertRegex(buf.getvalue(), "bad_filesystem: No previously verified snapshot")
+                self.assertEqual(2, result)
+
+    def test_verify_budget(self):
+
+        args = "test test_target1 --verbose --exclude-received".split(" ") + [CHECK_COMMAND]
+
+        with self.subTest("no time left"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    self.assertEqual(0, ZfsAutoverify(args + ["--budget-time=0"]).run())
+
+                print(buf.getvalue())
+                self.assertNotRegex(buf.getvalue(), "Verifying...")
+                self.assertRegex(buf.getvalue(), "Budget exhausted")
+
+        with self.subTest("one dataset per run, oldest first"):
+            # every run verifies the next dataset, until all are tried once
+            verified = []
+            for i in range(0, 8):
+                with OutputIO() as buf:
+                    with redirect_stdout(buf):
+                        ZfsAutoverify(args + ["--budget-bytes=1"]).run()
+
+                    print(buf.getvalue())
+                    verified.extend(re.findall(r"(\S+)@test-20101111000000: Verifying...", buf.getvalue()))
 
+            # (7 selected datasets, so the 8th run starts over with one that never verified successfully)
+            self.assertEqual(8, len(verified))
+            self.assertEqual(7, len(set(verified)))
+            self.assertRegex(verified[7], "bad_")
@@ -1,4 +1,5 @@
 from basetest import *
+import re
 
 class TestZfsAutobackup32(unittest2.TestCase):
     """various new 3.2 features"""
@@ -198,3 +199,83 @@ test_target1/test_source1/fs1/sub@test2-20010203000000
 """)
 
 
+
+    def test_transfer_order(self):
+
+        shelltest("zfs set autobackup:test:priority=10 test_source2/fs2/sub")
+        shelltest("zfs set autobackup:test:priority=5 test_source1/fs1/sub")
+
+        with OutputIO() as buf:
+            with redirect_stdout(buf):
+                with mocktime("20101111000000"):
+                    self.assertFalse(ZfsAutobackup(
+                        "test test_target1 --no-progress --verbose --allow-empty --transfer-order=priority".split(
+                            " ")).run())
+
+            print(buf.getvalue())
+            transfers = re.findall(r"@test-20101111000000: -> (\S+)", buf.getvalue())
+
+            # highest priority first, but the parent fs1 still before fs1/sub
+            self.assertEqual(transfers, [
+                "test_target1/test_source2/fs2/sub",
+                "test_target1/test_source1/fs1",
+                "test_target1/test_source1/fs1/sub",
+            ])
+
+    def test_deadline(self):
+
+        with self.subTest("deadline reached, everything deferred"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf), redirect_stderr(buf):
+                    with mocktime("20101111000000"):
+                        self.assertFalse(ZfsAutobackup(
+                            "test test_target1 --no-progress --verbose --allow-empty --max-runtime=0".split(" ")).run())
+
+                print(buf.getvalue())
+                self.assertIn("test_source1/fs1: Deferred: deadline reached", buf.getvalue())
+                self.assertIn("Deferred 3 dataset(s) because of the deadline", buf.getvalue())
+                self.assertIn("Partially completed: 3 dataset(s) deferred because of the deadline", buf.getvalue())
+
+            r = shelltest("zfs list -H -o name -r -t snapshot test_target1")
+            self.assertMultiLineEqual(r, "\n")
+
+        with self.subTest("deadline not reached"):
+            with mocktime("20101111000001"):
+                self.assertFalse(ZfsAutobackup(
+                    "test test_target1 --no-progress --verbose --allow-empty --deadline=06:00".split(" ")).run())
+
+            r = shelltest("zfs list -H -o name -r -t snapshot test_target1")
+            self.assertMultiLineEqual(r, """
+test_target1/test_source1/fs1@test-20101111000000
+test_target1/test_source1/fs1@test-20101111000001
+test_target1/test_source1/fs1/sub@test-20101111000000
+test_target1/test_source1/fs1/sub@test-20101111000001
+test_target1/test_source2/fs2/sub@test-20101111000000
+test_target1/test_source2/fs2/sub@test-20101111000001
+""")
+
+        with self.subTest("started after the deadline"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf), redirect_stderr(buf):
+                    with mocktime("20101111000002"):
+                        self.assertFalse(ZfsAutobackup(
+                            "test test_target1 --no-progress --verbose --allow-empty --deadline=23:00".split(" ")).run())
+
+                print(buf.getvalue())
+                self.assertIn("Partially completed: 3 dataset(s) deferred because of the deadline", buf.getvalue())
+
+            r = shelltest("zfs list -H -o name -r -t snapshot test_target1")
+            self.assertNotIn("20101111000002", r)
+
+        with self.subTest("nearest deadline"):
+            def time_left(now, deadline):
+                with mocktime(now):
+                    zfs_autobackup = ZfsAutobackup("test test_target1 --deadline={}".format(deadline).split(" "))
+                    return round((zfs_autobackup.get_deadline() - time.time()) / 3600.0)
+
+            self.assertEqual(time_left("20101111100000", "11:00"), 1)
+            self.assertEqual(time_left("20101111100000", "09:00"), -1)
+            self.assertEqual(time_left("20101111230000", "01:00"), 2)
+            self.assertEqual(time_left("20101111010000", "23:00"), -2)
+            self.assertEqual(time_left("20101111100000", "21:00"), 11)
+            self.assertEqual(time_left("20101111100000", "23:00"), -11)
@@ -2,6 +2,7 @@ from os.path import exists
 
 from basetest import *
 from zfs_autobackup.BlockHasher import BlockHasher
+from zfs_autobackup.LogStub import LogStub
 
 
 class TestZfsCheck(unittest2.TestCase):
@@ -41,6 +42,33 @@ class TestZfsCheck(unittest2.TestCase):
                 print(buf.getvalue())
                 self.assertEqual("Chunk 1 failed: 2c2ceccb5ec5574f791d45b63c940cff20550f9X 2c2ceccb5ec5574f791d45b63c940cff20550f9a\n", buf.getvalue())
 
+            # snapshot device should be hidden again
+            self.assertEqual("hidden\n", subprocess.check_output("zfs get -H -o value snapdev test_source1/vol", shell=True, universal_newlines=True))
+
+        with self.subTest("Compare, snapshot device still used by another zfs-check"):
+            shelltest("zfs set zfs_check:snapdev=hidden test_source1/vol")
+            shelltest("zfs set zfs_check:snapdev-other=1 test_source1/vol")
+            shelltest("zfs set snapdev=visible test_source1/vol")
+
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    self.assertEqual(1, ZfsCheck("test_source1/vol@test --check=/tmp/testhashes".split(" "),print_arguments=False).run())
+
+            # the other one restores it
+            self.assertEqual("visible\n", subprocess.check_output("zfs get -H -o value snapdev test_source1/vol", shell=True, universal_newlines=True))
+            self.assertEqual("zfs_check:snapdev\nzfs_check:snapdev-other\n", subprocess.check_output("zfs get -H -s local -o property all test_source1/vol | grep zfs_check: | sort", shell=True, universal_newlines=True))
+
+            shelltest("zfs inherit zfs_check:snapdev-other test_source1/vol")
+            shelltest("zfs inherit zfs_check:snapdev test_source1/vol")
+            shelltest("zfs set snapdev=hidden test_source1/vol")
+
+        with self.subTest("Compare, cloned"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    self.assertEqual(1, ZfsCheck("test_source1/vol@test --mount --check=/tmp/testhashes".split(" "),print_arguments=False).run())
+                print(buf.getvalue())
+                self.assertEqual("Chunk 1 failed: 2c2ceccb5ec5574f791d45b63c940cff20550f9X 2c2ceccb5ec5574f791d45b63c940cff20550f9a\n", buf.getvalue())
+
     def test_filesystem(self):
         prepare_zpools()
 
@@ -79,6 +107,108 @@ dir/testfile	0	2e863f1fcccd6642e4e28453eba10d2d3f74d798
                 print(buf.getvalue())
                 self.assertEqual("dir/testfile: Chunk 0 failed: 2e863f1fcccd6642e4e28453eba10d2d3f74d79X 2e863f1fcccd6642e4e28453eba10d2d3f74d798\n", buf.getvalue())
 
+        with self.subTest("Compare, mounted"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    self.assertEqual(1, ZfsCheck("test_source1@test --mount --check=/tmp/testhashes".split(" "),print_arguments=False).run())
+
+                print(buf.getvalue())
+                self.assertEqual("dir/testfile: Chunk 0 failed: 2e863f1fcccd6642e4e28453eba10d2d3f74d79X 2e863f1fcccd6642e4e28453eba10d2d3f74d798\n", buf.getvalue())
+
+    def test_manifest(self):
+        prepare_zpools()
+
+        shelltest("cp tests/data/whole /test_source1/testfile")
+        shelltest("mkdir /test_source1/dir")
+        shelltest("cp tests/data/whole2 /test_source1/dir/testfile")
+        shelltest("zfs snapshot test_source1@test")
+
+        with self.subTest("Generate, stores manifest"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    self.assertFalse(ZfsCheck("test_source1@test".split(" "), print_arguments=False).run())
+
+                hashes=buf.getvalue()
+                self.assertEqual(len(os.listdir(TEST_CACHE_DIR+"/zfs_autobackup/manifests")), 1)
+
+        with self.subTest("Generate, uses manifest"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    with patch.object(ZfsCheck, 'prepare_target') as prepare_target:
+                        self.assertFalse(ZfsCheck("test_source1@test".split(" "), print_arguments=False).run())
+                        prepare_target.assert_not_called()
+
+                self.assertEqual(hashes, buf.getvalue())
+
+        with self.subTest("Compare, uses manifest"):
+            with open("/tmp/testhashes", "w") as fh:
+                fh.write(hashes+"dir/testfile	0	2e863f1fcccd6642e4e28453eba10d2d3f74d79X\nmissing	0	2e863f1fcccd6642e4e28453eba10d2d3f74d79X\n")
+
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    with patch.object(ZfsCheck, 'prepare_target') as prepare_target:
+                        self.assertEqual(2, ZfsCheck("test_source1@test --check=/tmp/testhashes".split(" "),print_arguments=False).run())
+                        prepare_target.assert_not_called()
+
+                print(buf.getvalue())
+                self.assertEqual("""dir/testfile: Chunk 0 failed: 2e863f1fcccd6642e4e28453eba10d2d3f74d79X 2e863f1fcccd6642e4e28453eba10d2d3f74d798
+missing: Chunk - failed: - ERROR: not found
+""", buf.getvalue())
+
+        with self.subTest("Rehash"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    self.assertFalse(ZfsCheck("test_source1@test --rehash".split(" "), print_arguments=False).run())
+
+                self.assertEqual(hashes, buf.getvalue())
+
+        with self.subTest("Received snapshot doesnt use the manifest of its source"):
+            # (same guid, but a different snapshot)
+            shelltest("zfs send test_source1@test | zfs recv test_target1/received")
+
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    self.assertFalse(ZfsCheck("test_target1/received@test".split(" "), print_arguments=False).run())
+
+                self.assertEqual(hashes, buf.getvalue())
+                self.assertEqual(len(os.listdir(TEST_CACHE_DIR+"/zfs_autobackup/manifests")), 2)
+
+    def test_manifest_sort_skip(self):
+        prepare_zpools()
+
+        # a top level file that sorts after a subdirectory, so the os.walk order differs from the sorted order
+        shelltest("mkdir /test_source1/a")
+        shelltest("cp tests/data/whole_whole2_partial /test_source1/a/testfile")
+        shelltest("cp tests/data/whole /test_source1/b")
+        shelltest("cp tests/data/whole2 /test_source1/c")
+        shelltest("zfs snapshot test_source1@test")
+
+        with OutputIO() as buf:
+            with redirect_stdout(buf):
+                self.assertFalse(ZfsCheck("test_source1@test --sort --skip=1 --no-manifest".split(" "),
+                                          print_arguments=False).run())
+            expected = buf.getvalue()
+
+        # plain run stores the manifest
+        with OutputIO() as buf:
+            with redirect_stdout(buf):
+                self.assertFalse(ZfsCheck("test_source1@test".split(" "), print_arguments=False).run())
+        self.assertEqual(len(os.listdir(TEST_CACHE_DIR + "/zfs_autobackup/manifests")), 1)
+
+        # should sample the same chunks as a fresh sorted run
+        with OutputIO() as buf:
+            with redirect_stdout(buf):
+                with patch.object(ZfsCheck, 'prepare_target') as prepare_target:
+                    self.assertFalse(ZfsCheck("test_source1@test --sort --skip=1".split(" "),
+                                              print_arguments=False).run())
+                    prepare_target.assert_not_called()
+
+            self.assertEqual(expected, buf.getvalue())
+            self.assertEqual("""a/testfile	0	3c0bf91170d873b8e327d3bafb6bc074580d11b7
+a/testfile	2	642027d63bb0afd7e0ba197f2c66ad03e3d70de1
+c	0	2e863f1fcccd6642e4e28453eba10d2d3f74d798
+""", buf.getvalue())
+
     def test_file(self):
 
         with self.subTest("Generate"):
@@ -101,6 +231,121 @@ dir/testfile	0	2e863f1fcccd6642e4e28453eba10d2d3f74d798
                 print(buf.getvalue())
                 self.assertEqual("Chunk 0 failed: 3c0bf91170d873b8e327d3bafb6bc074580d11bX 3c0bf91170d873b8e327d3bafb6bc074580d11b7\n", buf.getvalue())
 
+    def test_file_hash(self):
+
+        with self.subTest("Generate"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    self.assertFalse(ZfsCheck("tests/data/whole --hash sha256".split(" "), print_arguments=False).run())
+
+                print(buf.getvalue())
+                self.assertEqual("""# zfs-check hash=sha256
+0	6e610dd2c95714724a3aba191916c074da6bf0175a7546959331bdd9e135eb53
+""", buf.getvalue())
+
+                # store on disk for next step, add error
+                with open("/tmp/testhashes", "w") as fh:
+                    fh.write(buf.getvalue()+"0	6e610dd2c95714724a3aba191916c074da6bf0175a7546959331bdd9e135eb5X")
+
+        with self.subTest("Compare, detects hash"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    self.assertEqual(1,ZfsCheck("tests/data/whole --check=/tmp/testhashes".split(" "), print_arguments=False).run())
+                print(buf.getvalue())
+                self.assertEqual("Chunk 0 failed: 6e610dd2c95714724a3aba191916c074da6bf0175a7546959331bdd9e135eb5X 6e610dd2c95714724a3aba191916c074da6bf0175a7546959331bdd9e135eb53\n", buf.getvalue())
+
+        with self.subTest("Compare, wrong hash specified"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    self.assertEqual(255,ZfsCheck("tests/data/whole --check=/tmp/testhashes --hash sha1".split(" "), print_arguments=False).run())
+
+    def test_binary(self):
+
+        with self.subTest("Generate"):
+            self.assertFalse(ZfsCheck("tests/data/whole_whole2_partial --count 1 --format binary -o /tmp/testhashes.bin".split(" "), print_arguments=False).run())
+            with open("/tmp/testhashes.bin", "rb") as fh:
+                self.assertEqual(fh.readline(), b"ZFSCHECKBIN1 hash=sha1 digest_size=20 bs=4096 count=1 skip=0 offset=0\n")
+                self.assertEqual(len(fh.read()), 3*20)
+
+        with self.subTest("Compare"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    self.assertEqual(0, ZfsCheck("tests/data/whole_whole2_partial --count 1 --check=/tmp/testhashes.bin".split(" "), print_arguments=False).run())
+                    self.assertEqual(1, ZfsCheck("tests/data/whole_whole2 --count 1 --check=/tmp/testhashes.bin".split(" "), print_arguments=False).run())
+
+                print(buf.getvalue())
+                self.assertEqual("Chunk 2 failed: 642027d63bb0afd7e0ba197f2c66ad03e3d70de1 EOF\n", buf.getvalue())
+
+        with self.subTest("Compare, wrong count"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    self.assertEqual(255, ZfsCheck("tests/data/whole_whole2_partial --check=/tmp/testhashes.bin".split(" "), print_arguments=False).run())
+
+        with self.subTest("Convert to text and back"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    self.assertFalse(ZfsCheck("--convert /tmp/testhashes.bin --count 1".split(" "), print_arguments=False).run())
+
+                self.assertEqual("""0	3c0bf91170d873b8e327d3bafb6bc074580d11b7
+1	2e863f1fcccd6642e4e28453eba10d2d3f74d798
+2	642027d63bb0afd7e0ba197f2c66ad03e3d70de1
+""", buf.getvalue())
+
+                with open("/tmp/testhashes", "w") as fh:
+                    fh.write(buf.getvalue())
+
+            self.assertFalse(ZfsCheck("--convert /tmp/testhashes --count 1 --format binary -o /tmp/testhashes2.bin".split(" "), print_arguments=False).run())
+            with open("/tmp/testhashes.bin", "rb") as fh1:
+                with open("/tmp/testhashes2.bin", "rb") as fh2:
+                    self.assertEqual(fh1.read(), fh2.read())
+
+        with self.subTest("Trees not supported"):
+            shelltest("rm -rf /tmp/testtree; mkdir /tmp/testtree; cp tests/data/whole /tmp/testtree")
+            self.assertEqual(255, ZfsCheck("/tmp/testtree --format binary -o /tmp/testhashes.bin".split(" "), print_arguments=False).run())
+
+    def test_merkle(self):
+        shelltest("rm -rf /tmp/testtree /tmp/testtree2; mkdir -p /tmp/testtree/dir /tmp/testtree2/dir")
+        shelltest("cp tests/data/whole tests/data/whole_whole2_partial /tmp/testtree")
+        shelltest("cp tests/data/whole2 /tmp/testtree/dir")
+        shelltest("cp tests/data/whole tests/data/whole_whole2_partial /tmp/testtree2")
+        shelltest("cp tests/data/whole /tmp/testtree2/dir/whole2")
+
+        with self.subTest("Generate"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    self.assertFalse(ZfsCheck("/tmp/testtree --merkle --merkle-fanout 2 --count 1".split(" "), print_arguments=False).run())
+
+                print(buf.getvalue())
+                self.assertEqual("""# zfs-check merkle=2 leaves=5
+M3 d5faad580b5f007fd2da2881bb8d39037005dfd8
+M2 4ffd21c4658d61bca7aeb0dbc4987f474dcfb318
+M2 c2e3ea070afde63ee44de52741eb895ec6ebe768
+M1 1192f981c7fd2c35b22e700fdcb4cfba8c276ce2
+M1 65d4fef10a24ce2cd229673d8f832238b33ab5d9
+M1 e4221d0630a88d6912881eb1450692cdb98b1856
+dir/whole2	0	2e863f1fcccd6642e4e28453eba10d2d3f74d798
+whole	0	3c0bf91170d873b8e327d3bafb6bc074580d11b7
+whole_whole2_partial	0	3c0bf91170d873b8e327d3bafb6bc074580d11b7
+whole_whole2_partial	1	2e863f1fcccd6642e4e28453eba10d2d3f74d798
+whole_whole2_partial	2	642027d63bb0afd7e0ba197f2c66ad03e3d70de1
+""", buf.getvalue())
+
+                with open("/tmp/testhashes", "w") as fh:
+                    fh.write(buf.getvalue())
+
+        with self.subTest("Compare, same"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    self.assertEqual(0, ZfsCheck("/tmp/testtree --check=/tmp/testhashes --count 1".split(" "), print_arguments=False).run())
+
+        with self.subTest("Compare, different"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    self.assertEqual(1, ZfsCheck("/tmp/testtree2 --check=/tmp/testhashes --count 1".split(" "), print_arguments=False).run())
+
+                print(buf.getvalue())
+                self.assertEqual("dir/whole2: Chunk 0 failed: 2e863f1fcccd6642e4e28453eba10d2d3f74d798 3c0bf91170d873b8e327d3bafb6bc074580d11b7\n", buf.getvalue())
+
     def test_tree(self):
         shelltest("rm -rf /tmp/testtree; mkdir /tmp/testtree")
         shelltest("cp tests/data/whole /tmp/testtree")
@@ -221,3 +466,111 @@ test_target1
 
 
 
+
+    def test_rotate(self):
+        # start without rotation state of earlier runs
+        shelltest("rm -rf " + TEST_CACHE_DIR)
+
+        with self.subTest("Rotating offsets"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    for i in range(3):
+                        self.assertFalse(ZfsCheck("tests/data/whole_whole2_partial --count 1 --skip 1 --rotate".split(" "), print_arguments=False).run())
+
+                print(buf.getvalue())
+                self.assertEqual("""# zfs-check skip=1 offset=0
+0	3c0bf91170d873b8e327d3bafb6bc074580d11b7
+2	642027d63bb0afd7e0ba197f2c66ad03e3d70de1
+# zfs-check skip=1 offset=1
+1	2e863f1fcccd6642e4e28453eba10d2d3f74d798
+# zfs-check skip=1 offset=0
+0	3c0bf91170d873b8e327d3bafb6bc074580d11b7
+2	642027d63bb0afd7e0ba197f2c66ad03e3d70de1
+""", buf.getvalue())
+
+        with self.subTest("Check uses sample of input"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    self.assertFalse(ZfsCheck("tests/data/whole_whole2_partial --count 1 --skip 1 --offset 1 -o /tmp/testhashes".split(" "), print_arguments=False).run())
+                    self.assertEqual(0, ZfsCheck("tests/data/whole_whole2_partial --count 1 --check=/tmp/testhashes".split(" "), print_arguments=False).run())
+                    self.assertEqual(1, ZfsCheck("tests/data/whole --count 1 --check=/tmp/testhashes".split(" "), print_arguments=False).run())
+
+                print(buf.getvalue())
+                self.assertEqual("Chunk 1 failed: 2e863f1fcccd6642e4e28453eba10d2d3f74d798 EOF\n", buf.getvalue())
+
+        with self.subTest("Invalid offset"):
+            with self.assertRaises(SystemExit):
+                ZfsCheck("tests/data/whole_whole2_partial --count 1 --skip 1 --offset 2".split(" "), print_arguments=False)
+
+    def test_compare_to(self):
+        shelltest("rm -rf /tmp/testtree /tmp/testtree2; mkdir -p /tmp/testtree/dir /tmp/testtree2/dir")
+        shelltest("cp tests/data/whole tests/data/whole_whole2_partial /tmp/testtree")
+        shelltest("cp tests/data/whole2 /tmp/testtree/dir")
+        shelltest("cp tests/data/whole /tmp/testtree2")
+        shelltest("cp tests/data/whole_whole2 /tmp/testtree2/whole_whole2_partial")
+        shelltest("cp tests/data/whole /tmp/testtree2/dir/whole2")
+        shelltest("cp tests/data/whole /tmp/testtree2/dir/extra")
+
+        command = "--check-command=python3 -m zfs_autobackup.ZfsCheck"
+
+        with self.subTest("Compare"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    self.assertEqual(3, ZfsCheck("/tmp/testtree --compare-to /tmp/testtree2 --count 1".split(" ") + [command], print_arguments=False).run())
+
+                print(buf.getvalue())
+                self.assertEqual("""dir/extra: Chunk 0 failed: EOF 3c0bf91170d873b8e327d3bafb6bc074580d11b7
+dir/whole2: Chunk 0 failed: 2e863f1fcccd6642e4e28453eba10d2d3f74d798 3c0bf91170d873b8e327d3bafb6bc074580d11b7
+whole_whole2_partial: Chunk 2 failed: 642027d63bb0afd7e0ba197f2c66ad03e3d70de1 EOF
+""", buf.getvalue())
+
+        with self.subTest("Compare, max errors"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    self.assertEqual(1, ZfsCheck("/tmp/testtree --compare-to /tmp/testtree2 --count 1 --max-errors 1".split(" ") + [command], print_arguments=False).run())
+
+                print(buf.getvalue())
+                self.assertEqual("dir/extra: Chunk 0 failed: EOF 3c0bf91170d873b8e327d3bafb6bc074580d11b7\n", buf.getvalue())
+
+        with self.subTest("Compare, files from"):
+            with open("/tmp/testfiles", "w") as fh:
+                fh.write("whole\ndir/whole2\n")
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    self.assertEqual(1, ZfsCheck("/tmp/testtree --compare-to /tmp/testtree2 --count 1 --files-from /tmp/testfiles".split(" ") + [command], print_arguments=False).run())
+
+                print(buf.getvalue())
+                self.assertEqual("dir/whole2: Chunk 0 failed: 2e863f1fcccd6642e4e28453eba10d2d3f74d798 3c0bf91170d873b8e327d3bafb6bc074580d11b7\n", buf.getvalue())
+
+        with self.subTest("Compare, equal"):
+            self.assertEqual(0, ZfsCheck("/tmp/testtree --compare-to /tmp/testtree --count 1".split(" ") + [command], print_arguments=False).run())
+
+        with self.subTest("Compare, missing target"):
+            self.assertEqual(255, ZfsCheck("/tmp/testtree --compare-to /tmp/nonexisting --count 1".split(" ") + [command], print_arguments=False).run())
+
+    def test_base(self):
+        prepare_zpools()
+
+        shelltest("cp tests/data/whole /test_source1/testfile")
+        shelltest("mkdir /test_source1/dir")
+        shelltest("cp tests/data/whole2 /test_source1/dir/testfile")
+        shelltest("zfs snapshot test_source1@base")
+
+        shelltest("cp tests/data/whole2 '/test_source1/dir/changed file'")
+        shelltest("echo >> /test_source1/testfile")
+        shelltest("rm /test_source1/dir/testfile")
+        shelltest("zfs snapshot test_source1@test")
+
+        with self.subTest("Changed files"):
+            snapshot = ZfsNode(LogStub(), readonly=True).get_dataset("test_source1@test")
+            self.assertEqual(sorted(snapshot.changed_files(snapshot.parent.find_snapshot("base"))), ["dir/changed file", "testfile"])
+
+        with self.subTest("Generate, base"):
+            with OutputIO() as buf:
+                with redirect_stdout(buf):
+                    self.assertFalse(ZfsCheck("test_source1@test --base base".split(" "), print_arguments=False).run())
+
+                print(buf.getvalue())
+                self.assertEqual("""dir/changed file	0	2e863f1fcccd6642e4e28453eba10d2d3f74d798
+testfile	0	8ace0a440241213b0ba11fbbb4b4147e66b1195f
+""", buf.getvalue())
@@ -1,6 +1,8 @@
 from basetest import *
 from zfs_autobackup.LogStub import LogStub
 from zfs_autobackup.ExecuteNode import ExecuteError
+from zfs_autobackup.CachedProperty import CachedProperty
+from zfs_autobackup.StateFile import StateFile
 
 
 class TestZfsNode(unittest2.TestCase):
@@ -177,6 +179,22 @@ test_target1
  (local): test_source2/fs2/sub,
  (local): test_source1/fs1/onlyparent]""")
 
+    def test_getselected_one_command(self):
+        """selecting should take exactly one command, also with exclude_unchanged"""
+
+        logger = LogStub()
+        description = "[Source]"
+        node = ZfsNode(utc=False, snapshot_time_format="test-%Y%m%d%H%M%S", hold_name="zfs_autobackup:test", logger=logger, description=description)
+
+        with patch.object(node, 'run', wraps=node.run) as run:
+            (selected_datasets, excluded_datasets)=node.selected_datasets(property_name="autobackup:test", exclude_paths=[], exclude_received=False,
+                                   exclude_unchanged=1)
+            self.assertEqual(run.call_count, 1)
+
+        self.assertEqual(len(selected_datasets), 3)
+        for dataset in selected_datasets:
+            self.assertFalse(CachedProperty.is_cached(dataset, 'properties'))
+
 
     def test_validcommand(self):
         logger = LogStub()
@@ -195,6 +213,21 @@ test_target1
         # -D propably always supported
         self.assertGreater(len(node.supported_send_options), 0)
 
+    def test_supportedoptions_cached(self):
+        logger = LogStub()
+        description = "[Source]"
+        shelltest("rm -f /tmp/zfs_autobackup_test_probes.json")
+        probe_cache = StateFile("/tmp/zfs_autobackup_test_probes.json")
+
+        node = ZfsNode(utc=False, snapshot_time_format="test-%Y%m%d%H%M%S", hold_name="zfs_autobackup:test", logger=logger, description=description, probe_cache=probe_cache)
+        send_options = node.supported_send_options
+
+        # second node only has to check the zfs version
+        node = ZfsNode(utc=False, snapshot_time_format="test-%Y%m%d%H%M%S", hold_name="zfs_autobackup:test", logger=logger, description=description, probe_cache=StateFile("/tmp/zfs_autobackup_test_probes.json"))
+        with patch.object(node, 'run', wraps=node.run) as run:
+            self.assertEqual(node.supported_send_options, send_options)
+            self.assertEqual(run.call_count, 1)
+
     def test_supportedrecvoptions(self):
         logger = LogStub()
         description = "[Source]"
@@ -202,6 +235,50 @@ test_target1
         node = ZfsNode(utc=False, snapshot_time_format="test-%Y%m%d%H%M%S", hold_name="zfs_autobackup:test", logger=logger, description=description, ssh_to='localhost')
         self.assertIsInstance(node.supported_recv_options, list)
 
+    def test_stream_hash(self):
+        logger = LogStub()
+        node = ZfsNode(utc=False, snapshot_time_format="test-%Y%m%d%H%M%S", hold_name="zfs_autobackup:test", logger=logger, description="[Source]")
+
+        self.assertIsNone(node.pop_stream_hash())
+        node._parse_stderr("summary: 10 MiByte in  0.1sec - average of 100 MiB/s", True)
+        node._parse_stderr("md5 hash: 0CC175B9C0F1B6A831C399E269772661", False)
+        self.assertEqual(node.pop_stream_hash(), "0cc175b9c0f1b6a831c399e269772661")
+        self.assertIsNone(node.pop_stream_hash())
+
+
+    @unittest2.skipIf(sys.version_info < (3, 5), "asyncio needs python 3.5+")
+    def test_prefetch_properties(self):
+        logger = LogStub()
+        node = ZfsNode(utc=False, snapshot_time_format="test-%Y%m%d%H%M%S", hold_name="zfs_autobackup:test", logger=logger, description="[Source]")
+
+        datasets = [node.get_dataset("test_source1/fs1"), node.get_dataset("test_source2/fs2/sub"), node.get_dataset("test_source1/nonexisting")]
+        node.prefetch_properties(datasets)
+
+        # the existing ones are cached now, no more zfs get needed
+        with patch.object(node, 'run', wraps=node.run) as run:
+            self.assertEqual(datasets[0].properties['type'], "filesystem")
+            self.assertEqual(datasets[1].properties['type'], "filesystem")
+            self.assertEqual(run.call_count, 0)
+
+            with self.assertRaises(ExecuteError):
+                datasets[2].properties
+            self.assertEqual(run.call_count, 1)
+
+    def test_prefetch_properties_sync(self):
+        """zfs-autobackup prefetches the properties of the source and target datasets"""
+
+        with patch.object(ZfsNode, 'prefetch_properties', autospec=True,
+                          side_effect=ZfsNode.prefetch_properties) as prefetch_properties:
+            with mocktime("20101111000000"):
+                self.assertFalse(ZfsAutobackup("test test_target1 --no-progress --allow-empty".split(" ")).run())
+
+        self.assertEqual(prefetch_properties.call_count, 2)
+        self.assertEqual([dataset.name for dataset in prefetch_properties.call_args_list[1][0][1]], [
+            "test_target1/test_source1/fs1",
+            "test_target1/test_source1/fs1/sub",
+            "test_target1/test_source2/fs2/sub",
+        ])
+
 
 if __name__ == '__main__':
     unittest.main()
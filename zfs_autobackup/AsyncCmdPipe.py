@@ -0,0 +1,176 @@
+# asyncio version of CmdPipe. (python 3.5+ only, so only import it when you need it)
+
+# It runs the processes of the pipe with asyncio.create_subprocess_exec(), instead of blocking on a select() loop. This
+# way many independent pipes can run at the same time in one thread. (see gather_bounded())
+
+# Items are piped the same way as with CmdPipe: items without a stdout_handler are connected to the next item with an
+# actual system pipe. Handlers and exit handlers are called the same way too.
+
+import asyncio
+import os
+
+from .CmdPipe import CmdPipe, find_executable, cmd_quote
+from .ExecuteNode import ExecuteError
+
+# max length of an output line
+LINE_LIMIT = 1024 * 1024
+
+
+class AsyncCmdPipe(CmdPipe):
+    """a CmdPipe with an async execute()"""
+
+    async def execute(self):
+        """run the pipe. returns True all exit handlers returned true. (otherwise it will be False/None depending on exit handlers returncode) """
+
+        if not self._should_execute:
+            return True
+
+        if not any(item.stdout_handler or item.stderr_handler for item in self.items):
+            raise (Exception("Cant use cmdpipe without any output handlers."))
+
+        readers = await self._create()
+        await asyncio.gather(*readers)
+
+        for item in self.items:
+            await item.process.wait()
+
+        # call exit handlers
+        success = True
+        for item in self.items:
+            if item.exit_handler is not None:
+                success = item.exit_handler(item.process.returncode) and success
+
+        return success
+
+    @staticmethod
+    async def _read_lines(stream, handler, eof_handler=None):
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            line = line.decode('utf-8').rstrip()
+            if line != "" and handler is not None:
+                handler(line)
+
+        if eof_handler is not None:
+            eof_handler()
+
+    async def _create(self):
+        """create actual processes, do piping and return coroutines that read the outputs."""
+
+        readers = []
+        next_stdin = asyncio.subprocess.PIPE  # means we write input via python instead of an actual system pipe
+        prev_item = None
+
+        for item in self.items:
+
+            if item.stdout_handler is None:
+                # no manual stdout handling, pipe it to the next process via sytem pipe
+                (pipe_read, pipe_write) = os.pipe()
+                stdout = pipe_write
+            else:
+                stdout = asyncio.subprocess.PIPE
+
+            # make sure the command gets all the data in utf8 format, like CmdItem.create()
+            encoded_cmd = [arg.encode('utf-8') for arg in item.cmd]
+            if item.shell:
+                encoded_cmd = [b"/bin/sh", b"-c"] + encoded_cmd
+            elif find_executable(item.cmd[0]) is None:
+                # let the shell handle it, so the error and exit code are the same as CmdItem.create()
+                encoded_cmd = [b"/bin/sh", b"-c", " ".join(map(cmd_quote, item.cmd)).encode('utf-8')]
+
+            item.process = await asyncio.create_subprocess_exec(*encoded_cmd, env=os.environ, stdin=next_stdin,
+                                                                stdout=stdout, stderr=asyncio.subprocess.PIPE,
+                                                                limit=LINE_LIMIT)
+
+            # we piped previous process? dont forget to close our copies of the pipe
+            if next_stdin != asyncio.subprocess.PIPE:
+                os.close(next_stdin)
+
+            if stdout != asyncio.subprocess.PIPE:
+                os.close(pipe_write)
+                next_stdin = pipe_read
+            else:
+                def close_next(item=item):
+                    if item.next is not None:
+                        item.next.process.stdin.close()
+
+                readers.append(self._read_lines(item.process.stdout, item.stdout_handler, close_next))
+                # next process will get input from python:
+                next_stdin = asyncio.subprocess.PIPE
+
+            readers.append(self._read_lines(item.process.stderr, item.stderr_handler))
+
+            # we're the first process in the pipe
+            if prev_item is None:
+                readers.append(self._write_input(item.process.stdin))
+            else:
+                prev_item.next = item
+
+            prev_item = item
+
+        # output of the last item isnt used
+        if next_stdin != asyncio.subprocess.PIPE:
+            os.close(next_stdin)
+
+        return readers
+
+    async def _write_input(self, stdin):
+        """write the input we have. (while the outputs are read, so big inputs dont block)"""
+        try:
+            if self.inp is not None:
+                stdin.write(self.inp.encode('utf-8'))
+                await stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        stdin.close()
+
+
+async def run(node, cmd, inp=None, tab_split=False, valid_exitcodes=None, readonly=False, hide_errors=False,
+              return_stderr=False, pipe=False, return_all=False, cwd=None):
+    """async version of ExecuteNode.run(). (use node.run_async() instead)
+
+    :type node: ExecuteNode
+    """
+
+    # create new pipe?
+    if not isinstance(inp, AsyncCmdPipe):
+        cmd_pipe = AsyncCmdPipe(node.readonly, inp)
+    else:
+        # add stuff to existing pipe
+        cmd_pipe = inp
+
+    result = node._add_run_item(cmd_pipe, cmd, tab_split, valid_exitcodes, readonly, hide_errors, return_stderr, pipe,
+                                return_all, cwd)
+
+    if pipe:
+        return cmd_pipe
+
+    node._debug_pipe(cmd_pipe)
+
+    if not await cmd_pipe.execute():
+        raise (ExecuteError("Last command returned error"))
+
+    return result()
+
+
+async def gather_bounded(coroutines, limit, return_exceptions=False):
+    """like asyncio.gather(), but runs at most limit coroutines at the same time. results are in the same order."""
+
+    semaphore = asyncio.Semaphore(limit)
+
+    async def bounded(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*[bounded(coroutine) for coroutine in coroutines], return_exceptions=return_exceptions)
+
+
+def run_sync(coroutine):
+    """runs coroutine in a new event loop, and returns its result. (the synchronous facade for non-async code)"""
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
@@ -1,6 +1,20 @@
+import errno
 import hashlib
+import io
+import mmap
 import os
 
+from .util import parallel_map
+
+# modes to read the data:
+#  read:     python reads of bs bytes, like the original implementation. (mostly useful for benchmarking)
+#  readinto: unbuffered reads of large parts directly into reusable buffers.
+#  mmap:     hash straight from a memory mapping of the chunk. (python 3 only)
+IO_MODES = ["readinto", "mmap", "read"]
+
+# max size of a single read in readinto-mode.
+MAX_IO_SIZE = 4 * 1024 * 1024
+
 
 class BlockHasher():
     """This class was created to checksum huge files and blockdevices (TB's)
@@ -14,50 +28,301 @@ class BlockHasher():
 
     NOTE: skipping is only used on the generator side. The compare side just compares what it gets from the input generator.
 
+    With threads>1 multiple chunks are read and hashed at the same time. (hashlib releases the GIL) The results are
+    still yielded in order.
+
+    The io mode only changes how data is read, not what is hashed. (see IO_MODES) With fadvise the kernel is told we
+    read sequentially, and chunks are dropped from the page cache after hashing them, so we dont push out useful data.
+
+    With holes=True, holes in sparse files are not read at all. (detected with SEEK_DATA/SEEK_HOLE) Holes and other
+    zero blocks are not hashed until we find actual data in the chunk, so that chunks with only zeros can use a cached
+    digest. The digests are the same as without this optimization.
+
     """
 
-    def __init__(self, count=10000, bs=4096, hash_class=hashlib.sha1, skip=0):
+    def __init__(self, count=10000, bs=4096, hash_class=hashlib.sha1, skip=0, threads=1, io_mode="readinto", fadvise=True,
+                 offset=0, holes=True):
         self.count = count
         self.bs = bs
         self.chunk_size=bs*count
         self.hash_class = hash_class
+        self.threads = threads
+
+        if io_mode not in IO_MODES:
+            raise (Exception("Unknown io mode {}".format(io_mode)))
+        self.io_mode = io_mode
+        self.fadvise = fadvise
+        self.holes = holes
+
+        # size of the readinto-buffers. (multiple of bs, and never more than a chunk)
+        self.io_size = bs * max(1, min(count, MAX_IO_SIZE // bs))
+        # unused buffers. (list.pop() and append() are thread safe)
+        self._buffers = []
+
+        # to hash and detect zero blocks
+        self._zeros = b"\0" * self.io_size
+        # cached digests of chunks with only zeros, per (hash_class, length)
+        self._zero_digests = {}
 
         # self.coverage=coverage
         self.skip=skip
-        self._skip_count=0
+        # skip this many chunks at the start. (with offsets 0 to skip, all chunks are checked exactly once)
+        self._skip_count=offset
 
         self.stats_total_bytes=0
 
 
-    def _seek_next_chunk(self, fh, fsize):
-        """seek fh to next chunk and update skip counter.
-        returns chunk_nr
-        return false it should skip the rest of the file
-
+    def chunk_nrs(self, fsize):
+        """yields the numbers of the chunks that should be hashed for a file of fsize bytes, and updates the skip counter.
+        (the skip pattern continues over multiple files)
 
+        yields nothing for empty files.
         """
 
         #ignore rempty files
         if fsize==0:
-            return False
-
-        # need to skip chunks?
-        if self._skip_count > 0:
-            chunks_left = ((fsize - fh.tell()) // self.chunk_size) + 1
-            # not enough chunks left in this file?
-            if self._skip_count >= chunks_left:
-                # skip rest of this file
-                self._skip_count = self._skip_count - chunks_left
-                return False
+            return
+
+        pos = 0
+        while pos < fsize:
+            # need to skip chunks?
+            if self._skip_count > 0:
+                # (rounded up: a partial chunk at the end counts as well)
+                # NOTE: older versions counted one chunk too many if the file ended exactly on a chunk boundary, and
+                # "hashed" a non-existing chunk past EOF. Only in that case the samples differ from older versions.
+                chunks_left = (fsize - pos + self.chunk_size - 1) // self.chunk_size
+                # not enough chunks left in this file?
+                if self._skip_count >= chunks_left:
+                    # skip rest of this file
+                    self._skip_count = self._skip_count - chunks_left
+                    return
+                else:
+                    # go to next chunk, reset skip count
+                    pos = pos + self.chunk_size * self._skip_count
+                    self._skip_count = self.skip
             else:
-                # seek to next chunk, reset skip count
-                fh.seek(self.chunk_size * self._skip_count, os.SEEK_CUR)
+                # should read this chunk, reset skip count
                 self._skip_count = self.skip
-                return  fh.tell()//self.chunk_size
-        else:
-            # should read this chunk, reset skip count
-            self._skip_count = self.skip
-            return fh.tell() // self.chunk_size
+
+            yield pos // self.chunk_size
+            pos = pos + self.chunk_size
+
+    def _open(self, fname):
+        """open file for hashing. Only legacy read-mode uses python buffering."""
+
+        if self.io_mode == "read":
+            return open(fname, "rb")
+
+        fh = io.open(fname, "rb", buffering=0)
+        self._advise(fh, 0, 0, "POSIX_FADV_SEQUENTIAL")
+        return fh
+
+    def _advise(self, fh, offset, length, advice_name):
+        """give the kernel a hint via posix_fadvise(), if supported by this platform/python."""
+
+        if not self.fadvise or self.io_mode == "read" or not hasattr(os, "posix_fadvise"):
+            return
+
+        advice = getattr(os, advice_name, None)
+        if advice is None:
+            return
+
+        try:
+            os.posix_fadvise(fh.fileno(), offset, length, advice)
+        except OSError:
+            # not all files support this (pipes, some filesystems)
+            pass
+
+    def _hash_chunk(self, fh, chunk_nr):
+        """hash one chunk. returns the hexdigest, or None if there was nothing to read. (EOF)"""
+
+        offset = chunk_nr * self.chunk_size
+
+        if self.io_mode == "read":
+            return self._hash_chunk_read(fh, offset)
+
+        self._advise(fh, offset, self.chunk_size, "POSIX_FADV_WILLNEED")
+        try:
+            if self.io_mode == "mmap":
+                return self._hash_chunk_mmap(fh, offset)
+            else:
+                return self._hash_chunk_readinto(fh, offset)
+        finally:
+            self._advise(fh, offset, self.chunk_size, "POSIX_FADV_DONTNEED")
+
+    def _segments(self, fh, offset, length):
+        """yields (start, end, is_data) for the data and holes in this part of the file.
+
+        Falls back to one data segment if the file or platform doesnt support SEEK_DATA/SEEK_HOLE. (e.g. blockdevices)
+        """
+
+        end = offset + length
+        if not self.holes or not hasattr(os, "SEEK_DATA"):
+            yield (offset, end, True)
+            return
+
+        pos = offset
+        while pos < end:
+            try:
+                data = os.lseek(fh.fileno(), pos, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # only a hole until the end of the file
+                    data = end
+                else:
+                    yield (pos, end, True)
+                    return
+
+            if data > pos:
+                yield (pos, min(data, end), False)
+            if data >= end:
+                return
+
+            hole = os.lseek(fh.fileno(), data, os.SEEK_HOLE)
+            yield (data, min(hole, end), True)
+            pos = hole
+
+    def _zero_digest(self, length):
+        """hexdigest of length zero bytes"""
+
+        key = (self.hash_class, length)
+        try:
+            return self._zero_digests[key]
+        except KeyError:
+            hash = self.hash_class()
+            self._hash_zeros(hash, length)
+            self._zero_digests[key] = hash.hexdigest()
+            return self._zero_digests[key]
+
+    def _hash_zeros(self, hash, length):
+        while length:
+            size = min(length, self.io_size)
+            hash.update(self._zeros[:size] if size < self.io_size else self._zeros)
+            length = length - size
+
+    def _is_zero(self, buffer, size):
+        if size == self.io_size:
+            return buffer == self._zeros
+        return buffer[:size] == self._zeros[:size]
+
+    def _hash_chunk_read(self, fh, offset):
+
+        fh.seek(offset)
+        hash = self.hash_class()
+        block_nr = 0
+        while block_nr != self.count:
+            block=fh.read(self.bs)
+            if block==b"":
+                break
+            hash.update(block)
+            block_nr = block_nr + 1
+
+        if block_nr == 0:
+            return None
+
+        return hash.hexdigest()
+
+    def _hash_chunk_readinto(self, fh, offset):
+
+        try:
+            buffer = self._buffers.pop()
+        except IndexError:
+            buffer = bytearray(self.io_size)
+
+        try:
+            # also works for blockdevices, where fstat() doesnt know the size
+            fsize = fh.seek(0, os.SEEK_END)
+            if offset >= fsize:
+                return None
+
+            # not created until we find something other than zeros
+            hash = None
+            # zeros that still have to be hashed
+            zeros = 0
+            view = memoryview(buffer)
+            for (start, end, is_data) in self._segments(fh, offset, min(self.chunk_size, fsize - offset)):
+                if not is_data:
+                    zeros = zeros + end - start
+                    continue
+
+                fh.seek(start)
+                remaining = end - start
+                while remaining:
+                    size = fh.readinto(view[:min(remaining, self.io_size)])
+                    if not size:
+                        break
+                    if self.holes and self._is_zero(buffer, size):
+                        zeros = zeros + size
+                    else:
+                        if hash is None:
+                            hash = self.hash_class()
+                        if zeros:
+                            self._hash_zeros(hash, zeros)
+                            zeros = 0
+                        hash.update(view[:size])
+                    remaining = remaining - size
+        finally:
+            self._buffers.append(buffer)
+
+        if hash is None:
+            return self._zero_digest(zeros)
+
+        self._hash_zeros(hash, zeros)
+        return hash.hexdigest()
+
+    def _hash_chunk_mmap(self, fh, offset):
+
+        # also works for blockdevices, where fstat() doesnt know the size
+        fh.seek(0, os.SEEK_END)
+        fsize = fh.tell()
+        if offset >= fsize:
+            return None
+
+        length = min(self.chunk_size, fsize - offset)
+
+        # a hole doesnt need a mapping
+        if self.holes and next(self._segments(fh, offset, length)) == (offset, offset + length, False):
+            return self._zero_digest(length)
+
+        # mappings should start at a multiple of the page size
+        delta = offset % mmap.ALLOCATIONGRANULARITY
+        mapping = mmap.mmap(fh.fileno(), delta + length, access=mmap.ACCESS_READ, offset=offset - delta)
+        try:
+            if hasattr(mapping, "madvise"):
+                mapping.madvise(mmap.MADV_SEQUENTIAL)
+            hash = self.hash_class()
+            view = memoryview(mapping)
+            try:
+                part = view[delta:delta + length]
+                hash.update(part)
+                part.release()
+            finally:
+                view.release()
+        finally:
+            mapping.close()
+
+        return hash.hexdigest()
+
+    def _hash_chunk_file(self, fname, chunk_nr):
+        """hash one chunk, using its own filehandle. (used by worker threads)"""
+
+        with self._open(fname) as fh:
+            return (chunk_nr, self._hash_chunk(fh, chunk_nr))
+
+    def hash_chunks(self, fname, chunk_nrs=None):
+        """hashes chunks of a file in the calling thread. (used by the TreeHasher workers)
+
+        chunk_nrs: list of chunks to hash. (see chunk_nrs()) None to hash all of them, without skipping.
+
+        returns list of (chunk_nr, hexdigest)
+        """
+
+        with self._open(fname) as fh:
+            if chunk_nrs is None:
+                fh.seek(0, os.SEEK_END)
+                chunk_nrs = range((fh.tell() + self.chunk_size - 1) // self.chunk_size)
+
+            return [(chunk_nr, self._hash_chunk(fh, chunk_nr)) for chunk_nr in chunk_nrs]
 
     def generate(self, fname):
         """Generates checksums
@@ -68,60 +333,69 @@ class BlockHasher():
         """
 
 
-        with open(fname, "rb") as fh:
+        with self._open(fname) as fh:
 
             fh.seek(0, os.SEEK_END)
             fsize=fh.tell()
             fh.seek(0)
 
-            while fh.tell()<fsize:
-                chunk_nr=self._seek_next_chunk(fh, fsize)
-                if chunk_nr is False:
-                    return
+            if self.threads > 1:
+                for (chunk_nr, hexdigest) in parallel_map(lambda chunk_nr: self._hash_chunk_file(fname, chunk_nr),
+                                                          self.chunk_nrs(fsize), self.threads):
+                    yield (chunk_nr, hexdigest)
+            else:
+                for chunk_nr in self.chunk_nrs(fsize):
+                    yield (chunk_nr, self._hash_chunk(fh, chunk_nr))
 
-                #read chunk
-                hash = self.hash_class()
-                block_nr = 0
-                while block_nr != self.count:
-                    block=fh.read(self.bs)
-                    if block==b"":
-                        break
-                    hash.update(block)
-                    block_nr = block_nr + 1
+    def _compare_chunk(self, fh, chunk_nr, hexdigest):
+        """compare one chunk. returns None if its ok, otherwise a mismatch or error. (see compare())"""
 
-                yield (chunk_nr, hash.hexdigest())
+        try:
+            actual_hexdigest = self._hash_chunk(fh, int(chunk_nr))
+
+            if actual_hexdigest is None:
+                return (chunk_nr, hexdigest, 'EOF')
+
+            elif actual_hexdigest != hexdigest:
+                return (chunk_nr, hexdigest, actual_hexdigest)
+
+        except Exception as e:
+            return ( chunk_nr , hexdigest, 'ERROR: '+str(e))
 
-    def compare(self, fname, generator):
+        return None
+
+    def _compare_chunk_file(self, fname, chunk_nr, hexdigest):
+        """compare one chunk, using its own filehandle. (used by worker threads)"""
+
+        try:
+            with self._open(fname) as fh:
+                return self._compare_chunk(fh, chunk_nr, hexdigest)
+        except Exception as e:
+            return ( chunk_nr , hexdigest, 'ERROR: '+str(e))
+
+    def compare(self, fname, generator, threads=None):
         """reads from generator and compares blocks
         Yields mismatches in the form: ( chunk_nr, hexdigest, actual_hexdigest)
         Yields errors in the form: ( chunk_nr, hexdigest, "message" )
 
+        threads: overrides self.threads
+
         """
 
+        if threads is None:
+            threads = self.threads
+
         try:
-            checked = 0
-            with open(fname, "rb") as f:
-                for (chunk_nr, hexdigest) in generator:
-                    try:
-
-                        checked = checked + 1
-                        hash = self.hash_class()
-                        f.seek(int(chunk_nr) * self.bs * self.count)
-                        block_nr = 0
-                        for block in iter(lambda: f.read(self.bs), b""):
-                            hash.update(block)
-                            block_nr = block_nr + 1
-                            if block_nr == self.count:
-                                break
-
-                        if block_nr == 0:
-                            yield (chunk_nr, hexdigest, 'EOF')
-
-                        elif (hash.hexdigest() != hexdigest):
-                            yield (chunk_nr, hexdigest, hash.hexdigest())
-
-                    except Exception as e:
-                        yield ( chunk_nr , hexdigest, 'ERROR: '+str(e))
+            with self._open(fname) as f:
+                if threads > 1:
+                    results = parallel_map(lambda item: self._compare_chunk_file(fname, item[0], item[1]),
+                                           generator, threads)
+                else:
+                    results = (self._compare_chunk(f, chunk_nr, hexdigest) for (chunk_nr, hexdigest) in generator)
+
+                for result in results:
+                    if result is not None:
+                        yield result
 
         except Exception as e:
-            yield ( '-', '-', 'ERROR: '+ str(e))
\ No newline at end of file
+            yield ( '-', '-', 'ERROR: '+ str(e))
@@ -31,6 +31,13 @@ class CachedProperty(object):
         if hasattr(obj, '_cached_properties'):
             obj._cached_properties = {}
 
+    @staticmethod
+    def set(obj, propname, value):
+        """store a value that was computed somewhere else"""
+        if not hasattr(obj, '_cached_properties'):
+            obj._cached_properties = {}
+        obj._cached_properties[propname] = value
+
     @staticmethod
     def is_cached(obj, propname):
         if hasattr(obj, '_cached_properties') and propname in obj._cached_properties:
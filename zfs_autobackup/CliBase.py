@@ -3,6 +3,7 @@ import os.path
 import sys
 
 from .LogConsole import LogConsole
+from .LogJson import LogJson
 
 
 class CliBase(object):
@@ -50,7 +51,12 @@ class CliBase(object):
         if args.debug:
             args.verbose = True
 
-        self.log = LogConsole(show_debug=args.debug, show_verbose=args.verbose, color=sys.stdout.isatty())
+        json_log = None
+        if args.log_json is not None:
+            json_log = LogJson(args.log_json)
+
+        self.log = LogConsole(show_debug=args.debug, show_verbose=args.verbose, color=sys.stdout.isatty(),
+                              json_log=json_log)
 
         self.verbose(self.HEADER)
         self.verbose("")
@@ -84,6 +90,9 @@ class CliBase(object):
                             help='Use UTC instead of local time when dealing with timestamps for both formatting and parsing. To snapshot in an ISO 8601 compliant time format you may for example specify --snapshot-format "{}-%%Y-%%m-%%dT%%H:%%M:%%SZ". Changing this parameter after-the-fact (existing snapshots) will cause their timestamps to be interpreted as a different time than before.')
         group.add_argument('--version', action='store_true',
                             help='Show version.')
+        group.add_argument('--log-json', metavar='FILE', default=None,
+                            help='Also write the log messages to FILE, as json lines. (this is done in the background, '
+                                 'so a slow FILE like a pipe cant slow down the rest)')
 
 
         return parser
@@ -97,8 +106,11 @@ class CliBase(object):
     def error(self, txt):
         self.log.error(txt)
 
-    def debug(self, txt):
-        self.log.debug(txt)
+    def is_debug(self):
+        return self.log.is_debug()
+
+    def debug(self, txt, *args):
+        self.log.debug(txt, *args)
 
     def progress(self, txt):
         self.log.progress(txt)
@@ -15,12 +15,36 @@
 import subprocess
 import os
 import select
+import sys
 
 try:
     from shlex import quote as cmd_quote
 except ImportError:
     from pipes import quote as cmd_quote
 
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+# python 3 already passes arguments to the OS in utf8 in that case
+ENCODE_ARGS = sys.version_info[0] < 3 or sys.getfilesystemencoding().lower().replace("-", "") != "utf8"
+
+# python 3 creates all filehandles non-inheritable, so it doesnt have to close them when starting a process
+CLOSE_FDS = sys.version_info[0] < 3
+
+# full path of executables, per (name, PATH). (see find_executable())
+executables = {}
+
+
+def find_executable(name):
+    """returns full path of executable name in the PATH, or None. (cached)"""
+
+    key = (name, os.environ.get("PATH"))
+    if key not in executables:
+        executables[key] = which(name)
+    return executables[key]
+
 
 class CmdItem:
     """one command item, to be added to a CmdPipe"""
@@ -57,12 +81,28 @@ class CmdItem:
 
         # make sure the command gets all the data in utf8 format:
         # (this is necessary if LC_ALL=en_US.utf8 is not set in the environment)
-        encoded_cmd = []
-        for arg in self.cmd:
-            encoded_cmd.append(arg.encode('utf-8'))
+        if ENCODE_ARGS:
+            encoded_cmd = [arg.encode('utf-8') for arg in self.cmd]
+        else:
+            encoded_cmd = self.cmd
 
-        self.process = subprocess.Popen(encoded_cmd, env=os.environ, stdout=subprocess.PIPE, stdin=stdin,
-                                        stderr=subprocess.PIPE, shell=self.shell)
+        if self.shell:
+            self.process = subprocess.Popen(encoded_cmd, env=os.environ, stdout=subprocess.PIPE, stdin=stdin,
+                                            stderr=subprocess.PIPE, shell=True)
+            return
+
+        # start it directly. with the full path and without close_fds, python 3 can use posix_spawn() or vfork().
+        # (it creates all its filehandles non-inheritable, so we dont leak them. python 2 doesnt, so there we have to
+        # close them: otherwise commands that run in other threads would inherit our pipes, and never get EOF)
+        executable = find_executable(self.cmd[0])
+        if executable is None:
+            # let the shell handle it, so the error and exit code are the same as always
+            self.process = subprocess.Popen(" ".join(map(cmd_quote, self.cmd)), env=os.environ,
+                                            stdout=subprocess.PIPE, stdin=stdin, stderr=subprocess.PIPE, shell=True)
+            return
+
+        self.process = subprocess.Popen(encoded_cmd, executable=executable, env=os.environ, stdout=subprocess.PIPE,
+                                        stdin=stdin, stderr=subprocess.PIPE, close_fds=CLOSE_FDS)
 
 
 class CmdPipe:
@@ -133,41 +173,37 @@ class CmdPipe:
     def __process_outputs(self, selectors):
         """watch all output selectors and call handlers"""
 
-        while True:
+        selectors = list(selectors)
+        while selectors:
             # wait for output on one of the stderrs or last_stdout
             (read_ready, write_ready, ex_ready) = select.select(selectors, [], [])
 
-            eof_count = 0
-            done_count = 0
-
             # read line and call appropriate handlers
 
             for item in self.items:
                 if item.process.stdout in read_ready:
-                    line = item.process.stdout.readline().decode('utf-8').rstrip()
-                    if line != "":
-                        item.stdout_handler(line)
+                    line = item.process.stdout.readline()
+                    if line:
+                        line = line.decode('utf-8').rstrip()
+                        if line != "":
+                            item.stdout_handler(line)
                     else:
-                        eof_count = eof_count + 1
+                        selectors.remove(item.process.stdout)
                         if item.next:
                             item.next.process.stdin.close()
 
                 if item.process.stderr in read_ready:
-                    line = item.process.stderr.readline().decode('utf-8').rstrip()
-                    if line != "":
-                        item.stderr_handler(line)
+                    line = item.process.stderr.readline()
+                    if line:
+                        line = line.decode('utf-8').rstrip()
+                        if line != "":
+                            item.stderr_handler(line)
                     else:
-                        eof_count = eof_count + 1
-
-
-                if item.process.poll() is not None:
-                    done_count = done_count + 1
-
-            # all filehandles are eof and all processes are done (poll() is not None)
-            if eof_count == len(selectors) and done_count == len(self.items):
-                break
-
+                        selectors.remove(item.process.stderr)
 
+        # all filehandles are eof, so the processes are done or almost done. (dont keep polling them)
+        for item in self.items:
+            item.process.wait()
 
     def __create(self):
         """create actual processes, do piping and return selectors."""
@@ -0,0 +1,192 @@
+import time
+
+from . import compressors
+from .ExecuteNode import ExecuteNode
+from .util import tmp_name
+
+# bytes of the send stream we use to benchmark
+SAMPLE_SIZE = 16 * 1024 * 1024
+
+# seconds before we benchmark a link again
+AUTO_TTL = 24 * 3600
+
+# zstd-adapt changes its level during the transfer, so a benchmark doesnt tell us anything
+SKIP_COMPRESSORS = ['zstd-adapt']
+
+
+class CompressAuto(object):
+    """Selects the compressor that gives the highest transfer rate from source_node to target_node. (--compress auto)
+
+    It measures the link by sending a sample of an actual zfs send stream to the target, and measures every available
+    compressor on the same sample on the source. The result is remembered per link in state_file, for AUTO_TTL seconds.
+
+    If measuring fails, and in test mode, no compression is used.
+    """
+
+    def __init__(self, source_node, target_node, state_file, sample_size=SAMPLE_SIZE, ttl=AUTO_TTL):
+        """
+        :type source_node: ZfsNode
+        :type target_node: ZfsNode
+        :type state_file: StateFile
+        """
+
+        self.source_node = source_node
+        self.target_node = target_node
+        self.state_file = state_file
+        self.sample_size = sample_size
+        self.ttl = ttl
+
+    def key(self):
+        return "{} -> {}".format(self.source_node, self.target_node)
+
+    def select(self, source_datasets, zfs_compressed):
+        """returns the name of the best compressor, or None if its faster without compression.
+
+        :type source_datasets: list[ZfsDataset]
+        """
+
+        if self.source_node.is_local() and self.target_node.is_local():
+            self.source_node.verbose("Auto compression: transfer is local, not using compression")
+            return None
+
+        cached = self.state_file.get(self.key())
+        if cached is not None and time.time() - cached['time'] < self.ttl:
+            self.source_node.verbose("Auto compression: using {} (measured earlier)".format(cached['compressor']))
+            return cached['compressor']
+
+        # measuring runs a zfs send and writes a temporary file
+        if self.source_node.readonly:
+            self.source_node.verbose("Auto compression: not measuring in test mode, not using compression")
+            return None
+
+        try:
+            snapshot = self.get_sample_snapshot(source_datasets)
+            if snapshot is None:
+                self.source_node.verbose("Auto compression: no snapshot to measure with, not using compression")
+                return None
+
+            self.source_node.verbose("Auto compression: measuring with {}".format(snapshot))
+            compressor = self.measure(snapshot, zfs_compressed)
+        except Exception as e:
+            # (for example an encrypted dataset without a loaded key) this shouldnt stop the backup
+            self.source_node.warning("Auto compression: measuring failed, not using compression: {}".format(e))
+            return None
+
+        self.state_file.set(self.key(), {'compressor': compressor, 'time': time.time()})
+        self.source_node.verbose("Auto compression: using {}".format(compressor))
+
+        return compressor
+
+    @staticmethod
+    def get_sample_snapshot(source_datasets):
+        """latest snapshot of the biggest dataset, so we have enough data for the sample"""
+
+        best = None
+        for dataset in source_datasets:
+            if dataset.snapshots and (
+                    best is None or int(dataset.get_property('referenced')) > int(best.get_property('referenced'))):
+                best = dataset
+
+        if best is None:
+            return None
+
+        return best.snapshots[-1]
+
+    def sample_cmd(self, snapshot, zfs_compressed):
+        cmd = ["zfs", "send"]
+        if zfs_compressed and "-c" in self.source_node.supported_send_options:
+            cmd.append("-c")
+        cmd.extend([snapshot.name, ExecuteNode.PIPE, "head", "-c", str(self.sample_size)])
+        return cmd
+
+    def available(self):
+        """compressors that are installed on both nodes"""
+
+        def installed(node, programs):
+            found = node.run(["which"] + sorted(set(programs)), valid_exitcodes=[], readonly=True, hide_errors=True)
+            return [path.split("/")[-1] for path in found]
+
+        names = [name for name in compressors.choices() if name not in SKIP_COMPRESSORS]
+        source_programs = installed(self.source_node, [compressors.COMPRESS_CMDS[name]['cmd'] for name in names])
+        target_programs = installed(self.target_node, [compressors.COMPRESS_CMDS[name]['dcmd'] for name in names])
+
+        return [name for name in names if compressors.COMPRESS_CMDS[name]['cmd'] in source_programs and
+                compressors.COMPRESS_CMDS[name]['dcmd'] in target_programs]
+
+    @staticmethod
+    def time_cmd(node, cmd, inp=None):
+        """runs cmd, that outputs a byte count. returns (byte count, seconds)"""
+
+        start = time.time()
+        size = int(node.run(cmd, inp=inp, readonly=True)[0])
+        return size, time.time() - start
+
+    def measure(self, snapshot, zfs_compressed):
+        """measure link and compressors and return the best compressor
+
+        The sample is stored in a temporary file on the source first. This way the link and every compressor are
+        measured with the same (cached) data, without the zfs send. The time it takes to start a command and read the
+        sample is subtracted as well."""
+
+        path = "/tmp/" + tmp_name("-compress-sample")
+        try:
+            # the zfs send itself
+            start = time.time()
+            self.source_node.run(self.sample_cmd(snapshot, zfs_compressed) + [ExecuteNode.PIPE, "dd", "of=" + path],
+                                 hide_errors=True, readonly=True)
+            read_time = time.time() - start
+
+            # overhead (the first time also warms up the cache)
+            overhead = None
+            for i in range(2):
+                (sample_size, seconds) = self.time_cmd(self.source_node, ["cat", path, ExecuteNode.PIPE, "wc", "-c"])
+                overhead = seconds if overhead is None else min(overhead, seconds)
+
+            self.source_node.debug("Auto compression: read {} bytes in {:.2f}s (overhead {:.2f}s)", sample_size,
+                                   read_time, overhead)
+            if not sample_size:
+                return None
+
+            # link: send the plain sample to the target
+            pipe = self.source_node.run(["cat", path], pipe=True, readonly=True)
+            (size, seconds) = self.time_cmd(self.target_node, ["wc", "-c"], inp=pipe)
+            link_time = max(seconds - overhead, 0.001)
+            self.source_node.debug("Auto compression: sent {} bytes in {:.2f}s", size, link_time)
+
+            # compressors: only the compression on the source
+            results = {}
+            for name in self.available():
+                (size, seconds) = self.time_cmd(self.source_node, ["cat", path, ExecuteNode.PIPE] +
+                                                compressors.compress_cmd(name) + [ExecuteNode.PIPE, "wc", "-c"])
+                results[name] = (size, max(seconds - overhead, 0.001))
+                self.source_node.debug("Auto compression: {} compressed to {} bytes in {:.2f}s", name, size,
+                                       results[name][1])
+        finally:
+            self.source_node.run(["rm", "-f", path], hide_errors=True, valid_exitcodes=[], readonly=True)
+
+        return self.best(sample_size, link_time, results, read_time)
+
+    @staticmethod
+    def best(sample_size, link_time, results, read_time=0):
+        """returns the compressor with the highest end-to-end rate, or None if no compression is the fastest.
+
+        Reading, compression and transfer happen at the same time, so the slowest of them determines the rate.
+
+        :param sample_size: bytes in the sample
+        :param link_time: seconds it took to send the uncompressed sample
+        :param results: dict with compressor name: (compressed size, seconds to compress the sample)
+        :param read_time: seconds it took zfs send to read the sample
+        """
+
+        link_rate = sample_size / float(max(link_time, 0.001))
+
+        best_name = None
+        best_time = max(read_time, link_time)
+        for name in sorted(results):
+            (size, compress_time) = results[name]
+            total_time = max(read_time, compress_time, size / link_rate)
+            if total_time < best_time:
+                best_name = name
+                best_time = total_time
+
+        return best_name
@@ -19,6 +19,9 @@ class ExecuteNode(LogStub):
 
     PIPE=1
 
+    # start simple local commands directly, instead of via sh -c. (see _add_run_item())
+    DIRECT_EXEC=True
+
     def __init__(self, ssh_config=None, ssh_to=None, readonly=False, debug_output=False):
         """ssh_config: custom ssh config
            ssh_to: server you want to ssh to. none means local
@@ -40,12 +43,12 @@ class ExecuteNode(LogStub):
     def _parse_stdout(self, line):
         """parse stdout. can be overridden in subclass"""
         if self.debug_output:
-            self.debug("STDOUT > " + line.rstrip())
+            self.debug("STDOUT > {}", line.rstrip())
 
     def _parse_stderr(self, line, hide_errors):
         """parse stderr. can be overridden in subclass"""
         if hide_errors:
-            self.debug("STDERR > " + line.rstrip())
+            self.debug("STDERR > {}", line.rstrip())
         else:
             self.error("STDERR > " + line.rstrip())
 
@@ -119,6 +122,41 @@ class ExecuteNode(LogStub):
             # add stuff to existing pipe
             cmd_pipe = inp
 
+        result = self._add_run_item(cmd_pipe, cmd, tab_split, valid_exitcodes, readonly, hide_errors, return_stderr,
+                                    pipe, return_all, cwd)
+
+        # return CmdPipe instead of executing?
+        if pipe:
+            return cmd_pipe
+
+        self._debug_pipe(cmd_pipe)
+
+        # execute and calls handlers in CmdPipe
+        if not cmd_pipe.execute():
+            raise(ExecuteError("Last command returned error"))
+
+        return result()
+
+    def run_async(self, cmd, inp=None, **kwargs):
+        """like run(), but returns a coroutine that runs the command with asyncio. (python 3.5+)
+
+        Use AsyncCmdPipe.gather_bounded() to run many commands at the same time, and AsyncCmdPipe.run_sync() to wait
+        for them in non-async code. inp can also be an AsyncCmdPipe that was returned by a run(..., pipe=True)."""
+
+        from .AsyncCmdPipe import run
+        return run(self, cmd, inp, **kwargs)
+
+    def _debug_pipe(self, cmd_pipe):
+        if cmd_pipe.should_execute():
+            self.debug("CMD    > {}", cmd_pipe)
+        else:
+            self.debug("CMDSKIP> {}", cmd_pipe)
+
+    def _add_run_item(self, cmd_pipe, cmd, tab_split, valid_exitcodes, readonly, hide_errors, return_stderr, pipe,
+                      return_all, cwd):
+        """add cmd to cmd_pipe, with the handlers of run(). returns a function that returns the result of run(), after
+        the pipe is executed."""
+
         # stderr parser
         error_lines = []
         returned_exit_code=None
@@ -136,7 +174,7 @@ class ExecuteNode(LogStub):
 
         def exit_handler(exit_code):
             if self.debug_output:
-                self.debug("EXIT   > {}".format(exit_code))
+                self.debug("EXIT   > {}", exit_code)
 
             if (valid_exitcodes != []) and (exit_code not in valid_exitcodes):
                 self.error("Command \"{}\" returned exit code {} (valid codes: {})".format(cmd_item, exit_code, valid_exitcodes))
@@ -159,29 +197,22 @@ class ExecuteNode(LogStub):
                     output_lines.append(line.rstrip())
                 self._parse_stdout(line)
 
-        # add shell command and handlers to pipe
-        cmd_item=CmdItem(cmd=self._shell_cmd(cmd, cwd), readonly=readonly, stderr_handler=stderr_handler, exit_handler=exit_handler, shell=self.is_local(), stdout_handler=stdout_handler)
-        cmd_pipe.add(cmd_item)
-
-        # return CmdPipe instead of executing?
-        if pipe:
-            return cmd_pipe
-
-        if cmd_pipe.should_execute():
-            self.debug("CMD    > {}".format(cmd_pipe))
+        # add command and handlers to pipe. (without a shell, if the shell has nothing to do)
+        if self.DIRECT_EXEC and self.is_local() and cwd is None and self.PIPE not in cmd:
+            cmd_item=CmdItem(cmd=list(cmd), readonly=readonly, stderr_handler=stderr_handler, exit_handler=exit_handler, shell=False, stdout_handler=stdout_handler)
         else:
-            self.debug("CMDSKIP> {}".format(cmd_pipe))
+            cmd_item=CmdItem(cmd=self._shell_cmd(cmd, cwd), readonly=readonly, stderr_handler=stderr_handler, exit_handler=exit_handler, shell=self.is_local(), stdout_handler=stdout_handler)
+        cmd_pipe.add(cmd_item)
 
-        # execute and calls handlers in CmdPipe
-        if not cmd_pipe.execute():
-            raise(ExecuteError("Last command returned error"))
+        def result():
+            if return_all:
+                return output_lines, error_lines, cmd_item.process and cmd_item.process.returncode
+            elif return_stderr:
+                return output_lines, error_lines
+            else:
+                return output_lines
 
-        if return_all:
-            return output_lines, error_lines, cmd_item.process and cmd_item.process.returncode
-        elif return_stderr:
-            return output_lines, error_lines
-        else:
-            return output_lines
+        return result
 
     def script(self, lines, inp=None, stdout_handler=None, stderr_handler=None, exit_handler=None, valid_exitcodes=None, readonly=False, hide_errors=False, pipe=False):
         """Run a multiline script on the node.
@@ -216,7 +247,7 @@ class ExecuteNode(LogStub):
         if stdout_handler is not None:
             if self.debug_output:
                 def internal_stdout_handler(line):
-                    self.debug("STDOUT > " + line.rstrip())
+                    self.debug("STDOUT > {}", line.rstrip())
                     stdout_handler(line)
             else:
                 internal_stdout_handler=stdout_handler
@@ -232,7 +263,7 @@ class ExecuteNode(LogStub):
 
         def internal_exit_handler(exit_code):
             if self.debug_output:
-                self.debug("EXIT   > {}".format(exit_code))
+                self.debug("EXIT   > {}", exit_code)
 
             if exit_handler is not None:
                 exit_handler(exit_code)
@@ -252,7 +283,7 @@ class ExecuteNode(LogStub):
             cmd.append("ssh")
 
             if self.ssh_config is not None:
-                cmd.append(["-F", self.ssh_config])
+                cmd.extend(["-F", self.ssh_config])
 
             cmd.append(self.ssh_to)
 
@@ -263,7 +294,7 @@ class ExecuteNode(LogStub):
         cmd_item=CmdItem(cmd=cmd, readonly=readonly, stderr_handler=internal_stderr_handler, exit_handler=internal_exit_handler, stdout_handler=internal_stdout_handler, shell=self.is_local())
         cmd_pipe.add(cmd_item)
 
-        self.debug("SCRIPT > {}".format(cmd_pipe))
+        self.debug("SCRIPT > {}", cmd_pipe)
 
         if pipe:
             return cmd_pipe
@@ -3,13 +3,20 @@ from __future__ import print_function
 
 import sys
 
+from .LogStub import format_log
+
 class LogConsole:
     """Log-class that outputs to console, adding colors if needed"""
 
-    def __init__(self, show_debug, show_verbose, color):
+    def __init__(self, show_debug, show_verbose, color, json_log=None):
+        """
+        :type json_log: LogJson
+        :param json_log: also send the shown messages to this LogJson
+        """
         self.last_log = ""
         self.show_debug = show_debug
         self.show_verbose = show_verbose
+        self.json_log = json_log
         self._progress_uncleared=False
 
         if color:
@@ -25,7 +32,12 @@ class LogConsole:
         else:
             self.colorama=False
 
+    def is_debug(self):
+        return self.show_debug
+
     def error(self, txt):
+        if self.json_log is not None:
+            self.json_log.log("error", txt)
         self.clear_progress()
         if self.colorama:
             print(colorama.Fore.RED + colorama.Style.BRIGHT + "! " + txt + colorama.Style.RESET_ALL, file=sys.stderr)
@@ -34,6 +46,8 @@ class LogConsole:
         sys.stderr.flush()
 
     def warning(self, txt):
+        if self.json_log is not None:
+            self.json_log.log("warning", txt)
         self.clear_progress()
         if self.colorama:
             print(colorama.Fore.YELLOW + colorama.Style.NORMAL + "  NOTE: " + txt + colorama.Style.RESET_ALL)
@@ -43,6 +57,8 @@ class LogConsole:
 
     def verbose(self, txt):
         if self.show_verbose:
+            if self.json_log is not None:
+                self.json_log.log("verbose", txt)
             self.clear_progress()
             if self.colorama:
                 print(colorama.Style.NORMAL + "  " + txt + colorama.Style.RESET_ALL)
@@ -50,8 +66,11 @@ class LogConsole:
                 print("  " + txt)
             sys.stdout.flush()
 
-    def debug(self, txt):
+    def debug(self, txt, *args):
         if self.show_debug:
+            txt = format_log(txt, args)
+            if self.json_log is not None:
+                self.json_log.log("debug", txt)
             self.clear_progress()
             if self.colorama:
                 print(colorama.Fore.GREEN + "# " + txt + colorama.Style.RESET_ALL)
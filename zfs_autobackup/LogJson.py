@@ -0,0 +1,99 @@
+import atexit
+import json
+import os
+import stat
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# seconds we wait for the remaining messages to be written at exit
+CLOSE_TIMEOUT = 5
+
+
+class LogJson(object):
+    """Writes log messages as json lines to a file. (one object per line with time, level and message)
+
+    Writing is done by a background thread, so a slow reader of the file (a pipe, journald, ...) cant slow down the
+    program. If the reader is too slow, messages are dropped instead. (this is noted in the log) At exit we wait at most
+    close_timeout seconds for the remaining messages.
+    """
+
+    def __init__(self, path, max_queue=10000, close_timeout=CLOSE_TIMEOUT):
+
+        # opening a fifo blocks until there is a reader, so the writer thread does that
+        self.path = path
+        self.fh = None
+        if not (os.path.exists(path) and stat.S_ISFIFO(os.stat(path).st_mode)):
+            self.fh = open(path, "a")
+
+        self.queue = queue.Queue(max_queue)
+        self.dropped = 0
+        self.close_timeout = close_timeout
+
+        self.thread = threading.Thread(target=self._write)
+        self.thread.daemon = True
+        self.thread.start()
+
+        # make sure everything is written before we exit
+        atexit.register(self.close)
+
+    def log(self, level, txt):
+        try:
+            self.queue.put_nowait({"time": time.time(), "level": level, "message": txt})
+        except queue.Full:
+            self.dropped = self.dropped + 1
+
+    def _write(self):
+        if self.fh is None:
+            try:
+                self.fh = open(self.path, "a")
+            except (IOError, OSError) as e:
+                # (messages will be dropped when the queue is full)
+                sys.stderr.write("Cant open json log {}: {}\n".format(self.path, e))
+                return
+
+        done = False
+        while not done:
+            records = [self.queue.get()]
+
+            # write everything thats waiting at once
+            try:
+                while True:
+                    records.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            lines = []
+            for record in records:
+                if record is None:
+                    done = True
+                    break
+                lines.append(json.dumps(record) + "\n")
+
+            self.fh.write("".join(lines))
+            self.fh.flush()
+
+        self.fh.close()
+
+    def close(self):
+        """write the remaining messages and close the file. (gives up after close_timeout, if the reader is stalled)"""
+
+        if self.thread is None:
+            return
+
+        try:
+            if self.dropped:
+                self.queue.put_nowait({"time": time.time(), "level": "warning",
+                                       "message": "Log writer too slow, dropped {} messages".format(self.dropped)})
+            self.queue.put(None, timeout=self.close_timeout)
+        except queue.Full:
+            pass
+
+        # (if its still blocked, its a daemon thread so it wont keep us from exiting)
+        self.thread.join(self.close_timeout)
+        self.thread = None
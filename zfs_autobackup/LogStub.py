@@ -1,12 +1,25 @@
 #Used for baseclasses that dont implement their own logging (Like ExecuteNode)
 #Usually logging is implemented in subclasses (Like ZfsNode thats a subclass of ExecuteNode), but for regression testing its nice to have these stubs.
 
+
+def format_log(txt, args):
+    """format a debug message with deferred arguments: debug("CMD > {}", cmd_pipe) only calls str(cmd_pipe) if the
+    message is actually shown."""
+    if args:
+        return txt.format(*args)
+    return txt
+
+
 class LogStub:
     """Just a stub, usually overriden in subclasses."""
 
+    def is_debug(self):
+        """False if debug messages are dropped anyway, so there is no need to build them."""
+        return True
+
     # simple logging stubs
-    def debug(self, txt):
-        print("DEBUG  : " + txt)
+    def debug(self, txt, *args):
+        print("DEBUG  : " + format_log(txt, args))
 
     def verbose(self, txt):
         print("VERBOSE: " + txt)
@@ -15,4 +28,4 @@ class LogStub:
         print("WARNING: " + txt)
 
     def error(self, txt):
-        print("ERROR  : " + txt)
\ No newline at end of file
+        print("ERROR  : " + txt)
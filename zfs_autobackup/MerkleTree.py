@@ -0,0 +1,84 @@
+import hashlib
+
+
+class MerkleTree(object):
+    """A hash tree over a list of leaf digests (hexdigest strings).
+
+    Every node is the hash of the concatenated hexdigests of (at most) fanout children. Levels are numbered from the
+    bottom: level 0 are the leaves, level self.height contains only the root. Since nodes are grouped from the bottom,
+    node i of a level always covers the same leaves, also in trees with a different number of leaves.
+
+    Two trees can be compared by only looking at the nodes that differ, starting at the top. (see diff())
+    This way only O(differences * log(leaves)) nodes have to be exchanged with the other side.
+    """
+
+    def __init__(self, leaves, hash_class=hashlib.sha1, fanout=16):
+        """
+        :type leaves: list of str
+        """
+        if fanout < 2:
+            raise (Exception("Merkle fanout should be at least 2"))
+
+        self.hash_class = hash_class
+        self.fanout = fanout
+
+        self.levels = [list(leaves)]
+        while len(self.levels) < len(self.level_sizes(len(self.levels[0]), fanout)):
+            level = self.levels[-1]
+            parents = []
+            for offset in range(0, max(len(level), 1), fanout):
+                hash = self.hash_class()
+                hash.update("".join(level[offset:offset + fanout]).encode('ascii'))
+                parents.append(hash.hexdigest())
+            self.levels.append(parents)
+
+    @staticmethod
+    def level_sizes(leaf_count, fanout):
+        """number of nodes per level, for a tree with leaf_count leaves. (so the other side can determine its shape)"""
+        sizes = [leaf_count]
+        while sizes[-1] > 1 or len(sizes) == 1:
+            sizes.append(max(1, (sizes[-1] + fanout - 1) // fanout))
+        return sizes
+
+    @property
+    def height(self):
+        return len(self.levels) - 1
+
+    @property
+    def root(self):
+        return self.levels[-1][0]
+
+    def get_nodes(self, level, indexes):
+        """get nodes of level, None for indexes that dont exist"""
+        nodes = self.levels[level] if level < len(self.levels) else []
+        return [nodes[index] if index < len(nodes) else None for index in indexes]
+
+    def diff(self, get_remote_nodes, remote_leaf_count):
+        """compare with a remote tree, descending only into nodes that differ.
+
+        get_remote_nodes(level, indexes): returns list of digests of the remote tree. (None if it doesnt exist)
+        remote_leaf_count: number of leaves of the remote tree.
+
+        Returns indexes of the leaves that differ, or that only exist on one side. (sorted)
+        """
+
+        remote_sizes = self.level_sizes(remote_leaf_count, self.fanout)
+
+        # start at the highest level both trees have. (just the root if they have the same height)
+        level = min(self.height, len(remote_sizes) - 1)
+        indexes = range(max(len(self.levels[level]), remote_sizes[level]))
+
+        while True:
+            local_nodes = self.get_nodes(level, indexes)
+            remote_nodes = get_remote_nodes(level, indexes)
+            different = [index for (index, local, remote) in zip(indexes, local_nodes, remote_nodes) if local != remote]
+
+            if not different or level == 0:
+                return different
+
+            # descend into the children of the nodes that differ
+            level = level - 1
+            size = max(len(self.levels[level]), remote_sizes[level])
+            indexes = []
+            for index in different:
+                indexes.extend(range(index * self.fanout, min((index + 1) * self.fanout, size)))
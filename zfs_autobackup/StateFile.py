@@ -0,0 +1,63 @@
+import json
+import os
+import threading
+
+
+def cache_dir():
+    """directory where we remember stuff between runs. ($XDG_CACHE_HOME/zfs_autobackup or ~/.cache/zfs_autobackup)"""
+
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "zfs_autobackup")
+
+
+class StateFile(object):
+    """A small json file in the cache_dir(), to remember things between runs.
+
+    Its only used for things we can determine again, so errors are never fatal: In that case the state is just lost.
+    """
+
+    def __init__(self, name):
+        """name: filename relative to cache_dir() (or an absolute path)"""
+
+        self.path = os.path.join(cache_dir(), name)
+        self._data = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._data is None:
+            try:
+                with open(self.path, "r") as fh:
+                    self._data = json.load(fh)
+            except (IOError, OSError, ValueError):
+                self._data = {}
+
+        return self._data
+
+    def _save(self):
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+
+            # write it atomicly, other processes might be reading it
+            tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+            with open(tmp_path, "w") as fh:
+                json.dump(self._data, fh, indent=1, sort_keys=True)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            pass
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._load().get(key, default)
+
+    def set(self, key, value):
+        """set key to value and save it to disk"""
+        with self._lock:
+            self._load()[key] = value
+            self._save()
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._load():
+                del self._data[key]
+                self._save()
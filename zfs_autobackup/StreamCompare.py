@@ -0,0 +1,163 @@
+import threading
+import time
+from collections import deque
+
+from .util import tmp_name
+
+try:
+    from shlex import quote as cmd_quote
+except ImportError:
+    from pipes import quote as cmd_quote
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class StreamCompare(object):
+    """Runs zfs-check on two nodes at the same time, and compares both hash streams while they come in.
+
+    Both sides should output their hashes in the same order. (zfs-check --sort)
+
+    Differences are yielded the same way as the TreeHasher or BlockHasher compare() would. (items that only exist on
+    one side have EOF as the hash of the other side)
+    """
+
+    def __init__(self, nodes, commands, timeout=None, file_names=None):
+        """
+        :type nodes: list of ExecuteNode
+        :param commands: zfs-check command line for each node. (script line, so it should already be quoted)
+        :param timeout: raise an exception when comparing takes more than this many seconds.
+        :param file_names: only compare these files of the directory trees. (zfs-check --files-from)
+        """
+        self.nodes = nodes
+        self.commands = commands
+        self.timeout = timeout
+        self.file_names = file_names
+
+    def put_file_names(self):
+        """store the file names in a temporary file on both nodes. returns the path"""
+
+        for file_name in self.file_names:
+            if "\n" in file_name:
+                raise (Exception("Cant compare file names with newlines: {}".format(file_name)))
+
+        path = "/tmp/" + tmp_name("-files-{}".format(id(self)))
+        text = "".join(file_name + "\n" for file_name in self.file_names)
+        for node in self.nodes:
+            node.debug("Writing {} file names to {}".format(len(self.file_names), path))
+            node.run(["dd", "of=" + path], inp=text, hide_errors=True, valid_exitcodes=[0], readonly=True)
+
+        return path
+
+    def remove_file_names(self, path):
+        for node in self.nodes:
+            node.run(["rm", "-f", path], hide_errors=True, valid_exitcodes=[], readonly=True)
+
+    @staticmethod
+    def stream_key(item):
+        """sort key of a hash line, in the order zfs-check generates them. (with --sort)"""
+        if len(item) == 3:
+            # per directory, so compare path components
+            return (item[0].split("/"), int(item[1]))
+        return ([], int(item[0]))
+
+    def compare(self):
+
+        if self.file_names is None:
+            for i in self._compare(self.commands):
+                yield i
+            return
+
+        path = self.put_file_names()
+        try:
+            for i in self._compare([command + " --files-from " + cmd_quote(path) for command in self.commands]):
+                yield i
+        finally:
+            self.remove_file_names(path)
+
+    def _compare(self, commands):
+
+        # hash lines that the other side didnt send yet
+        pending = [deque(), deque()]
+        results = queue.Queue()
+        exit_codes = [None, None]
+
+        def merge():
+            (source, target) = pending
+            while source and target:
+                source_key = self.stream_key(source[0])
+                target_key = self.stream_key(target[0])
+                if len(source[0]) != len(target[0]):
+                    raise (Exception("Cant compare a file with a directory tree"))
+                if source_key == target_key:
+                    (source_item, target_item) = (source.popleft(), target.popleft())
+                    if source_item[-1] != target_item[-1]:
+                        results.put(tuple(source_item) + (target_item[-1],))
+                elif source_key < target_key:
+                    results.put(tuple(source.popleft()) + ("EOF",))
+                else:
+                    target_item = target.popleft()
+                    results.put(tuple(target_item[:-1]) + ("EOF", target_item[-1]))
+
+        def stdout_handler(side):
+            def handler(line):
+                # (headers and other output dont have tabs)
+                if "\t" not in line:
+                    self.nodes[side].debug(line)
+                    return
+                pending[side].append(line.split("\t"))
+                merge()
+            return handler
+
+        def exit_handler(side):
+            def handler(exit_code):
+                exit_codes[side] = exit_code
+            return handler
+
+        cmd_pipe = None
+        for side in [0, 1]:
+            cmd_pipe = self.nodes[side].script([commands[side]], inp=cmd_pipe,
+                                               stdout_handler=stdout_handler(side), exit_handler=exit_handler(side),
+                                               valid_exitcodes=[], readonly=True, pipe=True)
+
+        def execute():
+            try:
+                cmd_pipe.execute()
+                for side in [0, 1]:
+                    if exit_codes[side] != 0:
+                        raise (Exception("zfs-check on {} returned exit code {}".format(self.nodes[side], exit_codes[side])))
+
+                # whats left only exists on one side
+                (source, target) = pending
+                for item in source:
+                    results.put(tuple(item) + ("EOF",))
+                for item in target:
+                    results.put(tuple(item[:-1]) + ("EOF", item[-1]))
+                results.put(None)
+            except Exception as e:
+                results.put(e)
+
+        thread = threading.Thread(target=execute)
+        thread.daemon = True
+        thread.start()
+        end_time = None if self.timeout is None else time.time() + self.timeout
+        try:
+            while True:
+                try:
+                    result = results.get(timeout=None if end_time is None else max(0, end_time - time.time()))
+                except queue.Empty:
+                    raise (Exception("Compare took more than {} seconds".format(self.timeout)))
+                if result is None:
+                    break
+                if isinstance(result, Exception):
+                    raise result
+                yield result
+        finally:
+            # stopped early?
+            while thread.is_alive():
+                for item in cmd_pipe.items:
+                    if item.process is not None and item.process.poll() is None:
+                        item.process.terminate()
+                thread.join(0.1)
@@ -1,5 +1,8 @@
 import itertools
 import os
+import stat
+
+from .util import parallel_map
 
 
 class TreeHasher():
@@ -7,22 +10,103 @@ class TreeHasher():
 
     Input and output generators are in the format: ( relative-filepath, chunk_nr, hexdigest)
 
+    If the BlockHasher uses multiple threads, we hash multiple files at the same time instead. (much faster with lots of
+    small files) In that case the order is always the same: Directory entries are sorted by name.
+
     """
 
-    def __init__(self, block_hasher):
+    def __init__(self, block_hasher, sort=False):
         """
 
         :type block_hasher: BlockHasher
+        :param sort: always sort directory entries, also with a single thread. (otherwise the os.walk() order is used)
         """
         self.block_hasher=block_hasher
-
-    def generate(self, start_path):
+        self.sort=sort
+
+    def _scan_files(self, dir_path, rel_path):
+        """yields (file_path, relative_path) of all regular files below dir_path, sorted by name per directory"""
+
+        if not hasattr(os, "scandir"):
+            # python 2
+            for f in self._scan_files_listdir(dir_path, rel_path):
+                yield f
+            return
+
+        for entry in sorted(os.scandir(dir_path), key=lambda e: e.name):
+            entry_rel_path = os.path.join(rel_path, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                for f in self._scan_files(entry.path, entry_rel_path):
+                    yield f
+            elif entry.is_file(follow_symlinks=False):
+                yield (entry.path, entry_rel_path)
+
+    def _scan_files_listdir(self, dir_path, rel_path):
+        """same as _scan_files(), with os.listdir() and lstat() for pythons without os.scandir()"""
+
+        for name in sorted(os.listdir(dir_path)):
+            entry_path = os.path.join(dir_path, name)
+            entry_rel_path = os.path.join(rel_path, name)
+            mode = os.lstat(entry_path).st_mode
+            if stat.S_ISDIR(mode):
+                for f in self._scan_files_listdir(entry_path, entry_rel_path):
+                    yield f
+            elif stat.S_ISREG(mode):
+                yield (entry_path, entry_rel_path)
+
+    def _list_files(self, start_path, file_names):
+        """yields (file_path, relative_path) of the regular files in file_names, in the same order as _scan_files()
+
+        files that don't exist (anymore) are skipped, so that the other side of a compare will report them."""
+
+        for rel_path in sorted(set(file_names), key=lambda name: name.split("/")):
+            file_path = os.path.join(start_path, rel_path)
+            try:
+                if stat.S_ISREG(os.lstat(file_path).st_mode):
+                    yield (file_path, rel_path)
+            except OSError:
+                pass
+
+    def _generate_parallel(self, start_path, file_names=None):
+
+        if file_names is None:
+            files = self._scan_files(start_path, "")
+        else:
+            files = self._list_files(start_path, file_names)
+
+        def plan():
+            """yields jobs for the workers, and applies the skip pattern in the right order"""
+            for (file_path, rel_path) in files:
+                if self.block_hasher.skip:
+                    chunk_nrs = list(self.block_hasher.chunk_nrs(os.lstat(file_path).st_size))
+                    if chunk_nrs:
+                        yield (file_path, rel_path, chunk_nrs)
+                else:
+                    # the worker will determine the size
+                    yield (file_path, rel_path, None)
+
+        def hash_file(job):
+            (file_path, rel_path, chunk_nrs) = job
+            return (rel_path, self.block_hasher.hash_chunks(file_path, chunk_nrs))
+
+        for (rel_path, results) in parallel_map(hash_file, plan(), self.block_hasher.threads):
+            for (chunk_nr, hash) in results:
+                yield (rel_path, chunk_nr, hash)
+
+    def generate(self, start_path, file_names=None):
         """Use BlockHasher on every file in a tree, yielding the results
 
         note that it only checks the contents of actual files. It ignores metadata like permissions and mtimes.
         It also ignores empty directories, symlinks and special files.
+
+        :param file_names: only hash these files (paths relative to start_path), instead of the whole tree. (always sorted)
         """
 
+        if file_names is not None or self.block_hasher.threads > 1 or self.sort:
+            for i in self._generate_parallel(start_path, file_names):
+                yield i
+            return
+
         def walkerror(e):
             raise e
 
@@ -48,6 +132,19 @@ class TreeHasher():
         def filter_file_name( file_name, chunk_nr, hexdigest):
                 return ( chunk_nr, hexdigest )
 
+        if self.block_hasher.threads > 1:
+            # compare multiple files at the same time
+            def compare_file(job):
+                (file_name, blocks) = job
+                return (file_name, list(self.block_hasher.compare(os.path.join(start_path, file_name), blocks, threads=1)))
+
+            jobs = ((file_name, list(itertools.starmap(filter_file_name, group_generator)))
+                    for file_name, group_generator in itertools.groupby(generator, lambda x: x[0]))
+
+            for (file_name, results) in parallel_map(compare_file, jobs, self.block_hasher.threads):
+                for ( chunk_nr, compare_hexdigest, actual_hexdigest) in results:
+                    yield ( file_name, chunk_nr, compare_hexdigest, actual_hexdigest )
+            return
 
         for file_name, group_generator in itertools.groupby(generator, lambda x: x[0]):
             count=count+1
@@ -1,7 +1,11 @@
 
 import argparse
+import copy
+import sys
+import time
+from datetime import datetime, timedelta
 from signal import signal, SIGPIPE
-from .util import output_redir, sigpipe_handler, datetime_now
+from .util import output_redir, sigpipe_handler, datetime_now, run_parallel
 
 from .ZfsAuto import ZfsAuto
 
@@ -11,12 +15,28 @@ from .Thinner import Thinner
 from .ZfsDataset import ZfsDataset
 from .ZfsNode import ZfsNode
 from .ThinnerRule import ThinnerRule
+from .StateFile import StateFile
+from .CompressAuto import CompressAuto
 
 class ZfsAutobackup(ZfsAuto):
     """The main zfs-autobackup class. Start here, at run() :)"""
 
+    # transfer options that can be set per dataset, with the user property <property-format>:<option>
+    # NOTE: never add options that run commands (like --send-pipe): anyone that can set user properties (zfs allow,
+    # received datasets) could then run commands on the source and target.
+    TRANSFER_PROPERTIES = ['compress', 'zfs-compressed', 'buffer', 'rate']
+
+    # keys for --transfer-order
+    TRANSFER_ORDER_KEYS = ['priority', 'stale', 'size']
+
     def __init__(self, argv, print_arguments=True):
 
+        # (for --max-runtime, set again by run())
+        self.start_time = time.time()
+
+        # datasets that where not sent because of --deadline/--max-runtime
+        self.deferred = []
+
         # NOTE: common options and parameters are in ZfsAuto
         super(ZfsAutobackup, self).__init__(argv, print_arguments)
 
@@ -41,10 +61,24 @@ class ZfsAutobackup(ZfsAuto):
             self.warning(
                 "The --raw option isn't needed anymore (it's autodetected now). Also see --encrypt and --decrypt.")
 
-        if args.compress and args.ssh_source is None and args.ssh_target is None:
+        if args.compress and args.compress != 'auto' and args.ssh_source is None and args.ssh_target is None:
             self.warning("Using compression, but transfer is local.")
 
-        if args.compress and args.zfs_compressed:
+        if args.deadline is not None:
+            try:
+                datetime.strptime(args.deadline, "%H:%M")
+            except ValueError:
+                self.log.error("Invalid --deadline: {} (use HH:MM)".format(args.deadline))
+                sys.exit(255)
+
+        if args.transfer_order is not None:
+            for key in args.transfer_order.split(","):
+                if key not in self.TRANSFER_ORDER_KEYS:
+                    self.log.error("Invalid --transfer-order key: {} (use {})".format(
+                        key, ", ".join(self.TRANSFER_ORDER_KEYS)))
+                    sys.exit(255)
+
+        if args.compress and args.compress != 'auto' and args.zfs_compressed:
             self.warning("Using --compress with --zfs-compressed, might be inefficient.")
 
         return args
@@ -115,11 +149,32 @@ class ZfsAutobackup(ZfsAuto):
                            help='Clones support. (The default policy "never" expands clones into full independent datasets. '
                                 '"simple" tries to reproduce the clone when the origin snapshot is already copied '
                                 'in the same target root)')
-
-        group = parser.add_argument_group("Data transfer options")
+        group.add_argument('--transfer-order', metavar='KEYS', default=None,
+                           help='Transfer datasets in this order, instead of in order of creation. Comma separated '
+                                'list of: priority (highest <property-format>:priority property first), stale (oldest '
+                                'last snapshot on target first), size (smallest estimated transfer first). '
+                                'Parents and clone origins are still transferred before their children. '
+                                '(e.g. priority,stale)')
+        group.add_argument('--deadline', metavar='HH:MM', default=None,
+                           help='Dont start transferring new datasets after this time. (local time, or UTC with '
+                                '--utc) Datasets that are estimated to not finish before it are skipped as well. '
+                                'Skipped datasets are still thinned, and reported at the end. If this time was '
+                                'less than 12 hours ago, the deadline is already reached.')
+        group.add_argument('--max-runtime', metavar='SECONDS', default=None, type=int,
+                           help='Same as --deadline, but SECONDS after the start.')
+        group.add_argument('--no-probe-cache', action='store_true',
+                           help='Dont remember which zfs options are supported. (Normally cached per host and zfs '
+                                'version, in ~/.cache/zfs_autobackup)')
+
+        group = parser.add_argument_group("Data transfer options",
+                                          "These can be changed per dataset, with the user properties "
+                                          "<property-format>:compress, :zfs-compressed, :buffer and :rate. (use "
+                                          "'none' or 'off' to disable an option)")
         group.add_argument('--compress', metavar='TYPE', default=None, nargs='?', const='zstd-fast',
-                           choices=compressors.choices(),
-                           help='Use compression during transfer, defaults to zstd-fast if TYPE is not specified. ({})'.format(
+                           choices=list(compressors.choices()) + ['auto'],
+                           help='Use compression during transfer, defaults to zstd-fast if TYPE is not specified. ({}) '
+                                'auto measures the link and the compressors with a sample of the data, and selects '
+                                'the fastest. (remembered per link for a day)'.format(
                                ", ".join(compressors.choices())))
         group.add_argument('--rate', metavar='DATARATE', default=None,
                            help='Limit data transfer rate in Bytes/sec (e.g. 128K. requires mbuffer.)')
@@ -127,6 +182,9 @@ class ZfsAutobackup(ZfsAuto):
                            help='Add zfs send and recv buffers to smooth out IO bursts. (e.g. 128M. requires mbuffer)')
         parser.add_argument('--buffer-chunk-size', metavar="BUFFERCHUNKSIZE", default=None,
                             help='Tune chunk size when mbuffer is used. (requires mbuffer.)')
+        group.add_argument('--stream-checksum', action='store_true',
+                           help='Hash the stream on both sides during transfer and compare the hashes. Stores the md5 '
+                                'hash in the property <property-format>:stream-md5 of both snapshots. (requires mbuffer)')
         group.add_argument('--send-pipe', metavar="COMMAND", default=[], action='append',
                            help='pipe zfs send output through COMMAND (can be used multiple times)')
         group.add_argument('--recv-pipe', metavar="COMMAND", default=[], action='append',
@@ -246,8 +304,8 @@ class ZfsAutobackup(ZfsAuto):
         # if self.args.progress:
         #     self.clear_progress()
 
-    def get_send_pipes(self, logger):
-        """determine the zfs send pipe"""
+    def get_send_pipes(self, logger, args):
+        """determine the zfs send pipe. (args: self.args, or the per dataset version from get_transfer_args())"""
 
         ret = []
         _mbuffer = False
@@ -256,78 +314,265 @@ class ZfsAutobackup(ZfsAuto):
         _rate = False
 
         # IO buffer
-        if self.args.buffer:
-            logger("zfs send buffer        : {}".format(self.args.buffer))
+        if args.buffer:
+            logger("zfs send buffer        : {}".format(args.buffer))
             _mbuffer = True
-            _buffer = self.args.buffer
+            _buffer = args.buffer
 
         # IO chunk size
-        if self.args.buffer_chunk_size:
-            logger("zfs send chunk size    : {}".format(self.args.buffer_chunk_size))
+        if args.buffer_chunk_size:
+            logger("zfs send chunk size    : {}".format(args.buffer_chunk_size))
             _mbuffer = True
-            _cs = self.args.buffer_chunk_size
+            _cs = args.buffer_chunk_size
+
+        # hash the stream as it comes out of zfs send
+        if args.stream_checksum:
+            logger("zfs send checksum      : md5")
+            ret.extend([ExecuteNode.PIPE, "mbuffer", "-q", "-H"])
 
         # custom pipes
-        for send_pipe in self.args.send_pipe:
+        for send_pipe in args.send_pipe:
             ret.append(ExecuteNode.PIPE)
             ret.extend(send_pipe.split(" "))
             logger("zfs send custom pipe   : {}".format(send_pipe))
 
         # compression
-        if self.args.compress != None:
+        if args.compress != None:
             ret.append(ExecuteNode.PIPE)
-            cmd = compressors.compress_cmd(self.args.compress)
+            cmd = compressors.compress_cmd(args.compress)
             ret.extend(cmd)
             logger("zfs send compression   : {}".format(" ".join(cmd)))
 
         # transfer rate
-        if self.args.rate:
-            logger("zfs send transfer rate : {}".format(self.args.rate))
+        if args.rate:
+            logger("zfs send transfer rate : {}".format(args.rate))
             _mbuffer = True
-            _rate = self.args.rate
+            _rate = args.rate
 
         if _mbuffer:
             cmd = [ExecuteNode.PIPE, "mbuffer", "-q", "-s{}".format(_cs), "-m{}".format(_buffer)]
             if _rate:
-                cmd.append("-R{}".format(self.args.rate))
+                cmd.append("-R{}".format(args.rate))
             ret.extend(cmd)
 
         return ret
 
-    def get_recv_pipes(self, logger):
+    def get_recv_pipes(self, logger, args):
+        """determine the zfs recv pipe. (args: self.args, or the per dataset version from get_transfer_args())"""
 
         ret = []
 
         # decompression
-        if self.args.compress != None:
-            cmd = compressors.decompress_cmd(self.args.compress)
+        if args.compress != None:
+            cmd = compressors.decompress_cmd(args.compress)
             ret.extend(cmd)
             ret.append(ExecuteNode.PIPE)
             logger("zfs recv decompression : {}".format(" ".join(cmd)))
 
         # custom pipes
-        for recv_pipe in self.args.recv_pipe:
+        for recv_pipe in args.recv_pipe:
             ret.extend(recv_pipe.split(" "))
             ret.append(ExecuteNode.PIPE)
             logger("zfs recv custom pipe   : {}".format(recv_pipe))
 
         # IO buffer
-        if self.args.buffer or self.args.buffer_chunk_size:
+        if args.buffer or args.buffer_chunk_size:
             _cs = "128k"
             _buffer = "16M"
             # only add second buffer if its usefull. (e.g. non local transfer or other pipes active)
-            if self.args.ssh_source != None or self.args.ssh_target != None or self.args.recv_pipe or self.args.send_pipe or self.args.compress != None:
-                logger("zfs recv buffer        : {}".format(self.args.buffer))
+            if args.ssh_source != None or args.ssh_target != None or args.recv_pipe or args.send_pipe or args.compress != None:
+                logger("zfs recv buffer        : {}".format(args.buffer))
 
-                if self.args.buffer_chunk_size:
-                    _cs = self.args.buffer_chunk_size
-                if self.args.buffer:
-                    _buffer = self.args.buffer
+                if args.buffer_chunk_size:
+                    _cs = args.buffer_chunk_size
+                if args.buffer:
+                    _buffer = args.buffer
 
                 ret.extend(["mbuffer", "-q", "-s{}".format(_cs), "-m{}".format(_buffer), ExecuteNode.PIPE])
 
+        # hash the stream as it goes into zfs recv
+        if args.stream_checksum:
+            logger("zfs recv checksum      : md5")
+            ret.extend(["mbuffer", "-q", "-H", ExecuteNode.PIPE])
+
         return ret
 
+    def transfer_property_names(self):
+        return [self.property_name + ":" + option for option in self.TRANSFER_PROPERTIES + ['priority']]
+
+    def get_transfer_order_key(self, source_dataset, target_node, key):
+        """sort key of source_dataset, for one of the TRANSFER_ORDER_KEYS
+
+        :type source_dataset: ZfsDataset
+        :type target_node: ZfsNode
+        """
+
+        if key == 'priority':
+            value = source_dataset.get_property(self.property_name + ":priority")
+            try:
+                return -int(value) if value != "-" else 0
+            except ValueError:
+                source_dataset.warning("Ignoring invalid {}:priority: {}".format(self.property_name, value))
+                return 0
+
+        if key == 'stale':
+            # time of the last snapshot on the target. (normally the common snapshot)
+            target_dataset = target_node.get_dataset(self.make_target_name(source_dataset))
+            if target_dataset.exists and target_dataset.our_snapshots:
+                return target_dataset.our_snapshots[-1].timestamp
+            return 0
+
+        return self.estimate_transfer_size(source_dataset, target_node)
+
+    def estimate_transfer_size(self, source_dataset, target_node):
+        """rough estimate of the bytes we have to send for source_dataset. (referenced for a new target, otherwise
+        whats written since the previous snapshot)
+
+        :type source_dataset: ZfsDataset
+        :type target_node: ZfsNode
+        """
+
+        target_dataset = target_node.get_dataset(self.make_target_name(source_dataset))
+        if target_dataset.exists:
+            return int(source_dataset.get_property('written'))
+        return int(source_dataset.get_property('referenced'))
+
+    def get_deadline(self):
+        """returns the time.time() after which we dont start new transfers, or None. (--deadline and --max-runtime)"""
+
+        deadlines = []
+        if self.args.max_runtime is not None:
+            deadlines.append(self.start_time + self.args.max_runtime)
+
+        if self.args.deadline is not None:
+            # the nearest time its HH:MM. (so if we started less than 12 hours too late, the deadline is reached already)
+            now = datetime_now(self.args.utc)
+            deadline = datetime.combine(now.date(), datetime.strptime(self.args.deadline, "%H:%M").time())
+            if deadline - now > timedelta(hours=12):
+                deadline = deadline - timedelta(days=1)
+            elif now - deadline >= timedelta(hours=12):
+                deadline = deadline + timedelta(days=1)
+            deadlines.append(time.time() + (deadline - now).total_seconds())
+
+        if deadlines:
+            return min(deadlines)
+        return None
+
+    def defer_reason(self, deadline, estimated_size, transferred_bytes, transfer_time):
+        """returns why we shouldnt start a transfer of estimated_size bytes, or None.
+        (transferred_bytes and transfer_time are the estimated bytes and seconds of the transfers that are done)"""
+
+        time_left = deadline - time.time()
+        if time_left <= 0:
+            return "deadline reached"
+
+        if transferred_bytes and transfer_time:
+            needed = estimated_size / (transferred_bytes / transfer_time)
+            if needed > time_left:
+                return "estimated to take {:.0f}s, but only {:.0f}s left before the deadline".format(needed, time_left)
+
+        return None
+
+    def order_datasets(self, source_datasets, target_node):
+        """returns source_datasets, sorted according to --transfer-order. Selected parents and clone origins stay before
+        the datasets that need them.
+
+        :type source_datasets: list[ZfsDataset]
+        :type target_node: ZfsNode
+        """
+
+        keys = self.args.transfer_order.split(",")
+        sort_keys = {}
+        for source_dataset in source_datasets:
+            try:
+                sort_keys[source_dataset.name] = [self.get_transfer_order_key(source_dataset, target_node, key)
+                                                  for key in keys]
+            except Exception as e:
+                # will fail again during the sync, where its handled normally
+                source_dataset.debug("Cant determine transfer order: {}", e)
+                sort_keys[source_dataset.name] = []
+
+        # sort is stable, so otherwise they stay in order of creation
+        ordered = sorted(source_datasets, key=lambda dataset: sort_keys[dataset.name])
+
+        # make sure dependencies go first
+        selected = dict([(dataset.name, dataset) for dataset in source_datasets])
+        ret = []
+        done = set()
+
+        def add(dataset):
+            if dataset.name in done:
+                return
+            done.add(dataset.name)
+
+            dependencies = [dataset.parent]
+            if self.args.clones != 'never':
+                origin = dataset.properties.get("origin", "-")
+                if origin != "-":
+                    dependencies.append(dataset.zfs_node.get_dataset(origin.split("@")[0]))
+
+            for dependency in dependencies:
+                if dependency is not None and dependency.name in selected:
+                    add(selected[dependency.name])
+
+            ret.append(dataset)
+
+        for source_dataset in ordered:
+            add(source_dataset)
+
+        self.debug("Transfer order: {}", ", ".join([dataset.name for dataset in ret]))
+        return ret
+
+    def get_transfer_args(self, source_dataset, args):
+        """returns a copy of args, with the transfer options of the user properties of source_dataset. Returns None if
+        none are set. (They're inherited, and already fetched by selected_datasets())
+
+        :type source_dataset: ZfsDataset
+        """
+
+        ret = None
+        for option in self.TRANSFER_PROPERTIES:
+            prop_name = self.property_name + ":" + option
+            value = source_dataset.get_property(prop_name)
+            if value == "-":
+                continue
+
+            if ret is None:
+                ret = copy.copy(args)
+
+            if option == 'compress':
+                if value in ['none', 'off']:
+                    ret.compress = None
+                elif value in compressors.choices() or value == 'auto':
+                    ret.compress = value
+                else:
+                    raise (Exception("Invalid compressor in {}: {}".format(prop_name, value)))
+            elif option == 'zfs-compressed':
+                if value not in ['on', 'off']:
+                    raise (Exception("Invalid value in {}: {} (use on or off)".format(prop_name, value)))
+                ret.zfs_compressed = value == 'on'
+            else:
+                setattr(ret, option, None if value in ['none', 'off'] else value)
+
+        return ret
+
+    def get_pipes(self, args, send_logger, recv_logger):
+        """returns (send_pipes, recv_pipes, plain_pipes) for args. (see ZfsDataset.sync_snapshots())"""
+
+        send_pipes = self.get_send_pipes(send_logger, args)
+        recv_pipes = self.get_recv_pipes(recv_logger, args)
+
+        # for datasets that are already compressed
+        if args.compress != None:
+            plain_args = copy.copy(args)
+            plain_args.compress = None
+            plain_pipes = (self.get_send_pipes(lambda txt: None, plain_args),
+                           self.get_recv_pipes(lambda txt: None, plain_args))
+        else:
+            plain_pipes = None
+
+        return send_pipes, recv_pipes, plain_pipes
+
     def make_target_name(self, source_dataset):
         """make target_name from a source_dataset"""
         stripped=source_dataset.lstrip_path(self.args.strip_path)
@@ -351,6 +596,45 @@ class ZfsAutobackup(ZfsAuto):
 
             target_datasets[target_name]=source_dataset
 
+    def probe_nodes(self, source_node, source_datasets, target_node):
+        """probe zfs options and get zpool properties of both nodes, all at the same time. Then get the properties of
+        all source and target datasets, concurrently per node. (otherwise this is done one by one, when they're needed)
+        :type target_node: ZfsNode
+        :type source_datasets: list of ZfsDataset
+        :type source_node: ZfsNode
+        """
+
+        def ignore_errors(probe):
+            # errors will come up again later, where they're handled normally
+            def wrapper():
+                try:
+                    probe()
+                except Exception as e:
+                    self.debug("Probe failed: {}".format(str(e)))
+            return wrapper
+
+        probes = []
+        if not self.args.no_send:
+            probes.append(lambda: source_node.supported_send_options)
+            probes.append(lambda: target_node.supported_recv_options)
+
+        source_pools = []
+        for source_dataset in source_datasets:
+            pool = source_node.get_pool(source_dataset)
+            if pool not in source_pools:
+                source_pools.append(pool)
+        target_pool = target_node.get_pool(target_node.get_dataset(self.args.target_path))
+        for pool in source_pools + [target_pool]:
+            probes.append(lambda pool=pool: pool.properties)
+
+        self.debug("Probing nodes")
+        run_parallel([ignore_errors(probe) for probe in probes])
+
+        # (targets that dont exist yet just fail here)
+        source_node.prefetch_properties(source_datasets)
+        target_node.prefetch_properties(
+            [target_node.get_dataset(self.make_target_name(source_dataset)) for source_dataset in source_datasets])
+
     # NOTE: this method also uses self.args. args that need extra processing are passed as function parameters:
     def sync_datasets(self, source_node, source_datasets, target_node):
         """Sync datasets, or thin-only on both sides
@@ -359,8 +643,29 @@ class ZfsAutobackup(ZfsAuto):
         :type source_node: ZfsNode
         """
 
-        send_pipes = self.get_send_pipes(source_node.verbose)
-        recv_pipes = self.get_recv_pipes(target_node.verbose)
+        # --compress auto is measured only once, when its needed
+        auto_compress = []
+
+        def resolve_compress(args):
+            if args.compress == 'auto':
+                if not auto_compress:
+                    auto_compress.append(CompressAuto(source_node, target_node, StateFile("compress-auto.json")).select(
+                        source_datasets, self.args.zfs_compressed))
+                args.compress = auto_compress[0]
+            return args
+
+        if self.args.transfer_order is not None:
+            source_datasets = self.order_datasets(source_datasets, target_node)
+
+        default_args = resolve_compress(copy.copy(self.args))
+        (default_send_pipes, default_recv_pipes, default_plain_pipes) = self.get_pipes(default_args,
+                                                                                       source_node.verbose,
+                                                                                       target_node.verbose)
+
+        deadline = self.get_deadline()
+        self.deferred = []
+        transferred_bytes = 0
+        transfer_time = 0.0
 
         fail_count = 0
         count = 0
@@ -373,14 +678,40 @@ class ZfsAutobackup(ZfsAuto):
                 self.progress("Analysing dataset {}/{} ({} failed)".format(count, len(source_datasets), fail_count))
 
             try:
+                # transfer options of this dataset
+                args = self.get_transfer_args(source_dataset, self.args)
+                if args is None:
+                    args = default_args
+                    (send_pipes, recv_pipes, plain_pipes) = (default_send_pipes, default_recv_pipes,
+                                                             default_plain_pipes)
+                else:
+                    args = resolve_compress(args)
+                    (send_pipes, recv_pipes, plain_pipes) = self.get_pipes(args, source_dataset.verbose,
+                                                                           source_dataset.verbose)
+
                 # determine corresponding target_dataset
                 target_name = self.make_target_name(source_dataset)
                 target_dataset = target_node.get_dataset(target_name)
                 target_datasets.append(target_dataset)
 
+                # enough time left? (we still sync without sending, to do the thinning)
+                no_send = self.args.no_send
+                estimated_size = None
+                if deadline is not None and not no_send:
+                    if source_dataset.parent in self.deferred:
+                        reason = "parent is deferred"
+                    else:
+                        estimated_size = self.estimate_transfer_size(source_dataset, target_node)
+                        reason = self.defer_reason(deadline, estimated_size, transferred_bytes, transfer_time)
+
+                    if reason:
+                        source_dataset.verbose("Deferred: {}".format(reason))
+                        self.deferred.append(source_dataset)
+                        no_send = True
+
                 # ensure parents exists
                 # TODO: this isnt perfect yet, in some cases it can create parents when it shouldn't.
-                if not self.args.no_send \
+                if not no_send \
                         and target_dataset.parent \
                         and target_dataset.parent not in target_datasets \
                         and not target_dataset.parent.exists:
@@ -393,20 +724,26 @@ class ZfsAutobackup(ZfsAuto):
                 common_features = source_features and target_features
 
                 # sync the snapshots of this dataset
+                start_time = time.time()
                 source_dataset.sync_snapshots(target_dataset, show_progress=self.args.progress,
                                               features=common_features, filter_properties=self.filter_properties_list(),
                                               set_properties=self.set_properties_list(),
                                               ignore_recv_exit_code=self.args.ignore_transfer_errors,
                                               holds=not self.args.no_holds, rollback=self.args.rollback,
                                               also_other_snapshots=self.args.other_snapshots,
-                                              no_send=self.args.no_send,
+                                              no_send=no_send,
                                               destroy_incompatible=self.args.destroy_incompatible,
-                                              send_pipes=send_pipes, recv_pipes=recv_pipes,
+                                              send_pipes=send_pipes, recv_pipes=recv_pipes, plain_pipes=plain_pipes,
                                               decrypt=self.args.decrypt, encrypt=self.args.encrypt,
-                                              zfs_compressed=self.args.zfs_compressed, force=self.args.force,
+                                              zfs_compressed=args.zfs_compressed, force=self.args.force,
                                               guid_check=not self.args.no_guid_check,
                                               clones=self.args.clones,
-                                              make_target_name=lambda source_dataset: self.make_target_name(source_dataset))
+                                              make_target_name=lambda source_dataset: self.make_target_name(source_dataset),
+                                              stream_checksum_property=self.property_name + ":stream-md5" if self.args.stream_checksum else None)
+
+                if estimated_size is not None and not no_send:
+                    transferred_bytes = transferred_bytes + estimated_size
+                    transfer_time = transfer_time + time.time() - start_time
             except Exception as e:
 
                 fail_count = fail_count + 1
@@ -416,6 +753,10 @@ class ZfsAutobackup(ZfsAuto):
                     raise
 
 
+        if self.deferred:
+            self.warning("Deferred {} dataset(s) because of the deadline: {}".format(
+                len(self.deferred), ", ".join([dataset.name for dataset in self.deferred])))
+
         target_path_dataset = target_node.get_dataset(self.args.target_path)
         if not self.args.no_thinning:
             self.thin_missing_targets(target_dataset=target_path_dataset, used_target_datasets=target_datasets)
@@ -467,8 +808,15 @@ class ZfsAutobackup(ZfsAuto):
 
     def run(self):
 
+        self.start_time = time.time()
+
         try:
 
+            if self.args.no_probe_cache:
+                probe_cache = None
+            else:
+                probe_cache = StateFile("probes.json")
+
             ################ create source zfsNode
             self.set_title("Source settings")
 
@@ -482,14 +830,15 @@ class ZfsAutobackup(ZfsAuto):
                                   ssh_config=self.args.ssh_config,
                                   ssh_to=self.args.ssh_source, readonly=self.args.test,
                                   debug_output=self.args.debug_output, description=description, thinner=source_thinner,
-                                  exclude_snapshot_patterns=self.args.exclude_snapshot_pattern)
+                                  exclude_snapshot_patterns=self.args.exclude_snapshot_pattern, probe_cache=probe_cache)
 
             ################# select source datasets
             self.set_title("Selecting")
             ( source_datasets, excluded_datasets) = source_node.selected_datasets(property_name=self.property_name,
                                                             exclude_received=self.args.exclude_received,
                                                             exclude_paths=self.exclude_paths,
-                                                            exclude_unchanged=self.args.exclude_unchanged)
+                                                            exclude_unchanged=self.args.exclude_unchanged,
+                                                            extra_properties=self.transfer_property_names())
             if not source_datasets and not excluded_datasets:
                 self.print_error_sources()
                 return 255
@@ -520,7 +869,7 @@ class ZfsAutobackup(ZfsAuto):
                                       ssh_to=self.args.ssh_target,
                                       readonly=self.args.test, debug_output=self.args.debug_output,
                                       description="[Target]",
-                                      thinner=target_thinner)
+                                      thinner=target_thinner, probe_cache=probe_cache)
                 target_node.verbose("Receive datasets under: {}".format(self.args.target_path))
 
                 self.set_title("Synchronising")
@@ -534,6 +883,8 @@ class ZfsAutobackup(ZfsAuto):
                 # check for collisions due to strip-path
                 self.check_target_names(source_node, source_datasets, target_node)
 
+                self.probe_nodes(source_node, source_datasets, target_node)
+
                 # do the actual sync
                 # NOTE: even with no_send, no_thinning and no_snapshot it does a usefull thing because it checks if the common snapshots and shows incompatible snapshots
                 fail_count = self.sync_datasets(
@@ -550,6 +901,9 @@ class ZfsAutobackup(ZfsAuto):
             if not fail_count:
                 if self.args.test:
                     self.set_title("All tests successful.")
+                elif self.deferred:
+                    self.set_title("Partially completed: {} dataset(s) deferred because of the deadline".format(
+                        len(self.deferred)))
                 else:
                     self.set_title("All operations completed successfully")
                     if not self.args.target_path:
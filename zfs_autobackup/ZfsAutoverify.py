@@ -1,143 +1,19 @@
-# from util import activate_volume_snapshot, create_mountpoints, cleanup_mountpoint
 from signal import signal, SIGPIPE
-from .util import output_redir, sigpipe_handler
+import threading
+import time
+from .util import output_redir, sigpipe_handler, parallel_map
 
 from .ZfsAuto import ZfsAuto
 from .ZfsNode import ZfsNode
+from .StreamCompare import StreamCompare
+from .StateFile import StateFile
 import sys
 
+try:
+    from shlex import quote as cmd_quote
+except ImportError:
+    from pipes import quote as cmd_quote
 
-# # try to be as unix compatible as possible, while still having decent performance
-# def compare_trees_find(source_node, source_path, target_node, target_path):
-#     # find /tmp/zfstmp_pve1_1993135target/ -xdev -type f -print0 | xargs -0 md5sum | md5sum -c
-#
-#     #verify tree has atleast one file
-#
-#     stdout=source_node.run(["find", ".", "-type", "f",
-#                           ExecuteNode.PIPE, "head", "-n1",
-#                           ], cwd=source_path)
-#
-#     if not stdout:
-#         source_node.debug("No files, skipping check")
-#     else:
-#         pipe=source_node.run(["find", ".", "-type", "f", "-print0",
-#                               ExecuteNode.PIPE, "xargs", "-0", "md5sum"
-#                               ], pipe=True, cwd=source_path)
-#         stdout=target_node.run([ "md5sum", "-c", "--quiet"], inp=pipe, cwd=target_path, valid_exitcodes=[0,1])
-#
-#         if len(stdout):
-#             for line in stdout:
-#                 target_node.error("md5sum: "+line)
-#
-#             raise(Exception("Some files have checksum errors"))
-#
-#
-# def compare_trees_rsync(source_node, source_path, target_node, target_path):
-#     """use rsync to compare two trees.
-#      Advantage is that we can see which individual files differ.
-#      But requires rsync and cant do remote to remote."""
-#
-#     cmd = ["rsync", "-rcnq", "--info=COPY,DEL,MISC,NAME,SYMSAFE", "--msgs2stderr", "--delete" ]
-#
-#     #local
-#     if source_node.ssh_to is None and target_node.ssh_to is None:
-#         cmd.append("{}/".format(source_path))
-#         cmd.append("{}/".format(target_path))
-#         source_node.debug("Running rsync locally, on source.")
-#         stdout, stderr = source_node.run(cmd, return_stderr=True)
-#
-#     #source is local
-#     elif source_node.ssh_to is None and target_node.ssh_to is not None:
-#         cmd.append("{}/".format(source_path))
-#         cmd.append("{}:{}/".format(target_node.ssh_to, target_path))
-#         source_node.debug("Running rsync locally, on source.")
-#         stdout, stderr = source_node.run(cmd, return_stderr=True)
-#
-#     #target is local
-#     elif source_node.ssh_to is not None and target_node.ssh_to is None:
-#         cmd.append("{}:{}/".format(source_node.ssh_to, source_path))
-#         cmd.append("{}/".format(target_path))
-#         source_node.debug("Running rsync locally, on target.")
-#         stdout, stderr=target_node.run(cmd, return_stderr=True)
-#
-#     else:
-#         raise Exception("Source and target cant both be remote when verifying. (rsync limitation)")
-#
-#     if stderr:
-#         raise Exception("Dataset verify failed, see above list for differences")
-
-
-def verify_filesystem(source_snapshot, source_mnt, target_snapshot, target_mnt, method):
-    """Compare the contents of two zfs filesystem snapshots """
-
-    try:
-
-        # mount the snapshots
-        source_snapshot.mount(source_mnt)
-        target_snapshot.mount(target_mnt)
-
-        if method=='rsync':
-            compare_trees_rsync(source_snapshot.zfs_node, source_mnt, target_snapshot.zfs_node, target_mnt)
-        # elif method == 'tar':
-        #     compare_trees_tar(source_snapshot.zfs_node, source_mnt, target_snapshot.zfs_node, target_mnt)
-        elif method == 'find':
-            compare_trees_find(source_snapshot.zfs_node, source_mnt, target_snapshot.zfs_node, target_mnt)
-        else:
-            raise(Exception("program errror, unknown method"))
-
-    finally:
-        source_snapshot.unmount(source_mnt)
-        target_snapshot.unmount(target_mnt)
-
-
-# def hash_dev(node, dev):
-#     """calculate md5sum of a device on a node"""
-#
-#     node.debug("Hashing volume {} ".format(dev))
-#
-#     cmd = [ "md5sum", dev ]
-#
-#     stdout = node.run(cmd)
-#
-#     if node.readonly:
-#         hashed=None
-#     else:
-#         hashed = stdout[0].split(" ")[0]
-#
-#     node.debug("Hash of volume {} is {}".format(dev, hashed))
-#
-#     return hashed
-
-
-
-# def deacitvate_volume_snapshot(snapshot):
-#     clone_name=get_tmp_clone_name(snapshot)
-#     clone=snapshot.zfs_node.get_dataset(clone_name)
-#     clone.destroy(deferred=True, verbose=False)
-
-def verify_volume(source_dataset, source_snapshot, target_dataset, target_snapshot):
-    """compare the contents of two zfs volume snapshots"""
-
-    # try:
-    source_dev= activate_volume_snapshot(source_snapshot)
-    target_dev= activate_volume_snapshot(target_snapshot)
-
-    source_hash= hash_dev(source_snapshot.zfs_node, source_dev)
-    target_hash= hash_dev(target_snapshot.zfs_node, target_dev)
-
-    if source_hash!=target_hash:
-        raise Exception("md5hash difference: {} != {}".format(source_hash, target_hash))
-
-    # finally:
-    #     deacitvate_volume_snapshot(source_snapshot)
-    #     deacitvate_volume_snapshot(target_snapshot)
-
-
-# class ZfsAutoChecksumVolume(ZfsAuto):
-#     def __init__(self, argv, print_arguments=True):
-#
-#         # NOTE: common options and parameters are in ZfsAuto
-#         super(ZfsAutoverify, self).__init__(argv, print_arguments)
 
 class ZfsAutoverify(ZfsAuto):
     """The zfs-autoverify class, default agruments and stuff come from ZfsAuto"""
@@ -147,6 +23,14 @@ class ZfsAutoverify(ZfsAuto):
         # NOTE: common options and parameters are in ZfsAuto
         super(ZfsAutoverify, self).__init__(argv, print_arguments)
 
+        # last verified snapshot and time per dataset
+        self.verified_state = StateFile("zfs-autoverify-{}.json".format(self.args.backup_name))
+
+        # what is left of the --budget-* (see take_budget())
+        self.budget_lock = threading.Lock()
+        self.budget_end_time = None
+        self.budget_bytes_used = 0
+
     def parse_args(self, argv):
         """do extra checks on common args"""
 
@@ -156,6 +40,15 @@ class ZfsAutoverify(ZfsAuto):
             self.log.error("Please specify TARGET-PATH")
             sys.exit(255)
 
+        if args.parallel < 1:
+            self.log.error("--parallel should be at least 1")
+            sys.exit(255)
+
+        if (args.budget_time is not None and args.budget_time < 0) or \
+                (args.budget_bytes is not None and args.budget_bytes < 0):
+            self.log.error("--budget-time and --budget-bytes cant be negative")
+            sys.exit(255)
+
         return args
 
     def get_parser(self):
@@ -164,66 +57,200 @@ class ZfsAutoverify(ZfsAuto):
         parser=super(ZfsAutoverify, self).get_parser()
 
         group=parser.add_argument_group("Verify options")
-        group.add_argument('--fs-compare', metavar='METHOD', default="find", choices=["find", "rsync"],
-                            help='Compare method to use for filesystems. (find, rsync) Default: %(default)s ')
+        group.add_argument('--parallel', metavar='COUNT', default=1, type=int,
+                           help='Verify COUNT datasets at the same time. Default: %(default)s')
+        group.add_argument('--timeout', metavar='SECONDS', default=None, type=int,
+                           help='Fail a dataset if verifying it takes more than SECONDS.')
+        group.add_argument('--skip', metavar='NUMBER', default=0, type=int,
+                           help='Skip this number of chunks after every hash. (see zfs-check --skip) Default: %(default)s')
+        group.add_argument('--check-command', metavar='COMMAND', default="zfs-check",
+                           help='Command to start zfs-check on the nodes. Default: %(default)s')
+        group.add_argument('--incremental', action='store_true',
+                           help='Only verify the files that changed since the last verified snapshot of a filesystem. '
+                                '(uses zfs diff on the source. volumes and the first run are always verified completely)')
+        group.add_argument('--budget-time', metavar='SECONDS', default=None, type=int,
+                           help='Dont start verifying new datasets after SECONDS. The datasets that were verified '
+                                'longest ago go first, so the rest is verified first next time.')
+        group.add_argument('--budget-bytes', metavar='BYTES', default=None, type=int,
+                           help='Dont start verifying new datasets after BYTES are verified. (referenced size of '
+                                'the datasets) The datasets that were verified longest ago go first.')
 
         return parser
 
-    def verify_datasets(self, source_mnt, source_datasets, target_node, target_mnt):
+    def get_check_command(self, snapshot, no_manifest=False):
+        """zfs-check command line to hash a snapshot. (both sides need the same order, hence --sort)
 
-        fail_count=0
-        count = 0
-        for source_dataset in source_datasets:
+        no_manifest: never use a cached manifest. (for the target, since thats the data we verify)"""
 
-            # stats
-            if self.args.progress:
-                count = count + 1
-                self.progress("Analysing dataset {}/{} ({} failed)".format(count, len(source_datasets), fail_count))
+        args = [snapshot.name, "--sort", "--skip", self.args.skip]
+        if no_manifest:
+            args.append("--no-manifest")
+        return self.args.check_command + " " + " ".join(cmd_quote(str(arg)) for arg in args)
 
-            try:
-                # determine corresponding target_dataset
-                target_name = self.make_target_name(source_dataset)
-                target_dataset = target_node.get_dataset(target_name)
+    def get_verified_key(self, source_dataset, target_dataset):
+        return "{} {} {} {}".format(source_dataset.zfs_node, source_dataset, target_dataset.zfs_node, target_dataset)
 
-                # find common snapshots to  verify
-                source_snapshot = source_dataset.find_common_snapshot(target_dataset, True)
-                target_snapshot = target_dataset.find_snapshot(source_snapshot)
+    def get_changed_files(self, source_snapshot, verified_key):
+        """files that changed since the last verified snapshot. None if everything should be verified."""
 
-                if source_snapshot is None or target_snapshot is None:
-                    raise(Exception("Cant find common snapshot"))
+        source_dataset = source_snapshot.parent
+        if source_dataset.get_property('type') != "filesystem":
+            return None
 
-                target_snapshot.verbose("Verifying...")
+        base_name = self.verified_state.get(verified_key, {}).get("snapshot")
+        base_snapshot = None if base_name is None else source_dataset.find_snapshot(base_name)
+        if base_snapshot is None:
+            source_dataset.verbose("No previously verified snapshot, verifying everything")
+            return None
 
-                if source_dataset.properties['type']=="filesystem":
-                    verify_filesystem(source_snapshot, source_mnt, target_snapshot, target_mnt, self.args.fs_compare)
-                elif source_dataset.properties['type']=="volume":
-                    verify_volume(source_dataset, source_snapshot, target_dataset, target_snapshot)
-                else:
-                    raise(Exception("{} has unknown type {}".format(source_dataset, source_dataset.properties['type'])))
+        if base_snapshot == source_snapshot:
+            return []
+
+        try:
+            file_names = source_snapshot.changed_files(base_snapshot)
+        except Exception as e:
+            source_dataset.warning("Cant determine changed files, verifying everything: {}".format(e))
+            return None
+
+        if any("\n" in file_name for file_name in file_names):
+            source_dataset.warning("File names with newlines, verifying everything")
+            return None
 
+        source_dataset.verbose("Verifying {} changed files since {}".format(len(file_names), base_snapshot.snapshot_name))
+        return file_names
 
-            except Exception as e:
-                # if self.args.progress:
-                #     self.clear_progress()
+    def update_verified_state(self, verified_key, **values):
+        state = dict(self.verified_state.get(verified_key, {}))
+        state.update(values)
+        self.verified_state.set(verified_key, state)
 
+    def set_verified(self, verified_key, source_snapshot):
+        self.update_verified_state(verified_key, snapshot=source_snapshot.snapshot_name, time=time.time())
+
+    def get_budget_order(self, source_dataset, target_node):
+        """sort key for the --budget-* queue: time of the last successful verification of source_dataset, and then the
+        time of the last attempt. (0 if never)"""
+
+        target_dataset = target_node.get_dataset(self.make_target_name(source_dataset))
+        state = self.verified_state.get(self.get_verified_key(source_dataset, target_dataset), {})
+        return (state.get("time", 0), state.get("attempt", 0))
+
+    @property
+    def budgeted(self):
+        return self.args.budget_time is not None or self.args.budget_bytes is not None
+
+    def take_budget(self, source_dataset):
+        """returns True if there is budget left to start verifying source_dataset, and takes its part."""
+
+        with self.budget_lock:
+            if self.budget_end_time is not None and time.time() >= self.budget_end_time:
+                return False
+
+            if self.args.budget_bytes is not None:
+                if self.budget_bytes_used >= self.args.budget_bytes:
+                    return False
+                # (the last one may exceed the budget, otherwise big datasets would never be verified)
+                self.budget_bytes_used = self.budget_bytes_used + int(source_dataset.get_property('referenced'))
+
+            return True
+
+    def verify_dataset(self, source_dataset, target_node):
+        """verify the latest common snapshot of source_dataset and its target, by running zfs-check on both nodes at the
+        same time. returns True if ok."""
+
+        # determine corresponding target_dataset
+        target_name = self.make_target_name(source_dataset)
+        target_dataset = target_node.get_dataset(target_name)
+
+        try:
+            # find common snapshots to  verify
+            source_snapshot = source_dataset.find_common_snapshot(target_dataset, True)
+            if source_snapshot is None:
+                raise(Exception("Cant find common snapshot"))
+            target_snapshot = target_dataset.find_snapshot(source_snapshot)
+            if target_snapshot is None:
+                raise(Exception("Cant find common snapshot"))
+
+            target_snapshot.verbose("Verifying...")
+
+            # (zfs-check might have to mount or clone)
+            if self.args.test:
+                return True
+
+            verified_key = self.get_verified_key(source_dataset, target_dataset)
+            # (also when it fails, so that a failing dataset doesnt use all the --budget-* every time)
+            self.update_verified_state(verified_key, attempt=time.time())
+
+            file_names = None
+            if self.args.incremental:
+                file_names = self.get_changed_files(source_snapshot, verified_key)
+                if file_names == []:
+                    target_snapshot.verbose("Nothing changed since last verification")
+                    self.set_verified(verified_key, source_snapshot)
+                    return True
+
+            compare = StreamCompare([source_dataset.zfs_node, target_node],
+                                    [self.get_check_command(source_snapshot),
+                                     self.get_check_command(target_snapshot, no_manifest=True)],
+                                    timeout=self.args.timeout, file_names=file_names)
+
+            # (we only need to know if its different)
+            for difference in compare.compare():
+                if len(difference) == 4:
+                    raise (Exception("{}: Chunk {} differs: {} {}".format(*difference)))
+                raise (Exception("Chunk {} differs: {} {}".format(*difference)))
+
+            self.set_verified(verified_key, source_snapshot)
+
+            return True
+
+        except Exception as e:
+            target_dataset.error("FAILED: " + str(e))
+            if self.args.debug:
+                self.verbose("Debug mode, aborting on first error")
+                raise
+            return False
+
+    def verify_datasets(self, source_datasets, target_node):
+        """verify datasets, --parallel at the same time. returns number of failed datasets
+
+        with a --budget-*, the datasets that were verified longest ago go first, and datasets that dont fit in the
+        budget anymore are skipped."""
+
+        if self.budgeted:
+            source_datasets = sorted(source_datasets,
+                                     key=lambda source_dataset: self.get_budget_order(source_dataset, target_node))
+            if self.args.budget_time is not None:
+                self.budget_end_time = time.time() + self.args.budget_time
+
+        def verify(source_dataset):
+            if self.budgeted and not self.take_budget(source_dataset):
+                return None
+            return self.verify_dataset(source_dataset, target_node)
+
+        fail_count=0
+        skip_count=0
+        count = 0
+        for ok in parallel_map(verify, source_datasets, self.args.parallel):
+            count = count + 1
+            if ok is None:
+                skip_count = skip_count + 1
+            elif not ok:
                 fail_count = fail_count + 1
-                target_dataset.error("FAILED: " + str(e))
-                if self.args.debug:
-                    self.verbose("Debug mode, aborting on first error")
-                    raise
 
-        # if self.args.progress:
-        #     self.clear_progress()
+            if self.args.progress:
+                self.progress("Verified dataset {}/{} ({} failed)".format(count, len(source_datasets), fail_count))
 
-        return fail_count
+        if self.args.progress:
+            self.clear_progress()
 
-    def run(self):
+        if skip_count:
+            self.verbose("Budget exhausted: skipped {} of {} datasets. (they go first next time)".format(
+                skip_count, len(source_datasets)))
 
-        source_node=None
-        source_mnt=None
-        target_node=None
-        target_mnt=None
+        return fail_count
 
+    def run(self):
 
         try:
 
@@ -260,12 +287,8 @@ class ZfsAutoverify(ZfsAuto):
 
             self.set_title("Verifying")
 
-            source_mnt, target_mnt= create_mountpoints(source_node, target_node)
-
             fail_count = self.verify_datasets(
-                source_mnt=source_mnt,
                 source_datasets=source_datasets,
-                target_mnt=target_mnt,
                 target_node=target_node)
 
             if not fail_count:
@@ -292,22 +315,11 @@ class ZfsAutoverify(ZfsAuto):
         except KeyboardInterrupt:
             self.error("Aborted")
             return 255
-        finally:
-
-            # cleanup
-            if source_mnt is not None:
-                cleanup_mountpoint(source_node, source_mnt)
-
-            if target_mnt is not None:
-                cleanup_mountpoint(target_node, target_mnt)
-
-
 
 
 def cli():
     import sys
 
-    raise(Exception("This program is incomplete, dont use it yet."))
     signal(SIGPIPE, sigpipe_handler)
     failed = ZfsAutoverify(sys.argv[1:], False).run()
     sys.exit(min(failed,255))
@@ -1,14 +1,51 @@
 from __future__ import print_function
 
+import itertools
+import platform
+import re
+import subprocess
 import time
 from signal import signal, SIGPIPE
 
 from . import util
 from .TreeHasher import TreeHasher
-from .BlockHasher import BlockHasher
+from .BlockHasher import BlockHasher, IO_MODES
+from . import hashers
 from .ZfsNode import ZfsNode
 from .util import *
 from .CliBase import CliBase
+from .StateFile import cache_dir, StateFile
+from .MerkleTree import MerkleTree
+from .StreamCompare import StreamCompare
+from . import binaryhashes
+
+try:
+    from shlex import quote as cmd_quote
+except ImportError:
+    from pipes import quote as cmd_quote
+
+
+# Optional first line of the output. (ignored by older versions, since it has no tabs)
+HEADER_PREFIX = "# zfs-check"
+
+# user property on a volume with the snapdev value to restore. (only while zfs-check made the snapshot devices visible)
+# every run that uses the devices adds a property with this prefix and its tmp_name()
+SNAPDEV_PROPERTY = "zfs_check:snapdev"
+
+
+def format_header(fields):
+    """fields: list of (key, value)"""
+    return HEADER_PREFIX + "".join(" {}={}".format(key, value) for (key, value) in fields)
+
+
+def parse_header(line):
+    """returns dict with the header fields. (unknown fields are just ignored by the caller)"""
+    fields = {}
+    for token in line[len(HEADER_PREFIX):].split():
+        if "=" in token:
+            (key, value) = token.split("=", 1)
+            fields[key] = value
+    return fields
 
 
 class ZfsCheck(CliBase):
@@ -20,7 +57,24 @@ class ZfsCheck(CliBase):
 
         self.node = ZfsNode(self.log, utc=self.args.utc, readonly=self.args.test, debug_output=self.args.debug_output)
 
-        self.block_hasher = BlockHasher(count=self.args.count, bs=self.args.block_size, skip=self.args.skip)
+        self.hash_name = self.args.hash or hashers.DEFAULT_HASH
+        self.offset = self.get_offset()
+        # input was already sampled by the other side, so we shouldnt skip anything.
+        self.input_sampled = False
+        # (fanout, leaf count) if the input contains a hash tree
+        self.input_merkle = None
+        # header fields if the input is in binary format
+        self.input_binary_fields = None
+        self.merkle_process = None
+        # only hash these files of a directory tree. (None for all)
+        self.file_names = None
+        # how to undo prepare_target()
+        self.cleanup_func = None
+        self.block_hasher = BlockHasher(count=self.args.count, bs=self.args.block_size, skip=self.args.skip,
+                                        hash_class=hashers.hash_class(self.hash_name),
+                                        threads=self.args.threads, io_mode=self.args.io,
+                                        fadvise=not self.args.no_fadvise, offset=self.offset,
+                                        holes=not self.args.no_holes)
 
     def get_parser(self):
 
@@ -42,6 +96,93 @@ class ZfsCheck(CliBase):
         group.add_argument('--skip', '-s', metavar="NUMBER", default=0, type=int,
                            help="Skip this number of chunks after every hash. %(default)s")
 
+        group.add_argument('--offset', metavar="NUMBER", default=None, type=int,
+                           help="Skip this number of chunks at the start. (0 to --skip) Use all offsets to check all chunks once.")
+
+        group.add_argument('--rotate', action='store_true',
+                           help="Use the next --offset for this target and --skip every run, so that --skip+1 "
+                                "runs check all chunks once.")
+
+        group.add_argument('--threads', metavar="NUMBER", default=1, type=int,
+                           help="Number of chunks to read and hash at the same time. Can speed things up on fast storage or with large chunks. Default %(default)s")
+
+        group.add_argument('--hash', metavar="ALGORITHM", default=None, choices=hashers.choices(),
+                           help="Hash algorithm: " + ", ".join(hashers.choices()) + ". Default " + hashers.DEFAULT_HASH + ". "
+                                "(with --check the algorithm is detected automatically)")
+
+        group.add_argument('--rehash', action='store_true',
+                           help="Dont use the cached manifest of a snapshot, but read and hash all data again. (to scrub the actual data)")
+
+        group.add_argument('--no-manifest', action='store_true',
+                           help="Dont read or write cached manifests of snapshots.")
+
+        group.add_argument('--format', metavar="FORMAT", default="text", choices=["text", "binary"],
+                           help="Output format: text or binary. Binary is much smaller and faster, but only "
+                                "works for files and volumes. (--check detects the format automatically) Default %(default)s")
+
+        group.add_argument('--output', '-o', metavar="FILE", default=None,
+                           help="Write hashes to FILE instead of STDOUT.")
+
+        group.add_argument('--convert', metavar="FILE", default=None,
+                           help="Dont hash anything, but convert hashes in FILE (- for STDIN) to --format. (when "
+                                "converting text to binary, specify the --block-size and --count that were used)")
+
+        group.add_argument('--merkle', action='store_true',
+                           help="Output a hash tree (root first) before the hashes. With --check this is detected "
+                                "automatically: Reading stops as soon as the tree matches.")
+
+        group.add_argument('--merkle-fanout', metavar="NUMBER", default=16, type=int,
+                           help="Number of children per node in the hash tree. Default %(default)s")
+
+        group.add_argument('--merkle-serve', action='store_true',
+                           help="Hash the target, and then answer hash tree requests on STDIN. (used by --merkle-remote)")
+
+        group.add_argument('--merkle-remote', metavar="COMMAND", default=None,
+                           help="Compare with the target of another zfs-check, by running COMMAND. This "
+                                "should start zfs-check --merkle-serve, for example: \"ssh host zfs-check --merkle-serve "
+                                "pool/vol@snapshot\". Only nodes of the hash tree that differ are transferred.")
+
+        group.add_argument('--io', metavar="MODE", default=IO_MODES[0], choices=IO_MODES,
+                           help="How to read data: " + ", ".join(IO_MODES) + ". (mmap needs python 3) Default %(default)s")
+
+        group.add_argument('--no-fadvise', action='store_true',
+                           help="Dont give the kernel read-ahead hints and dont drop hashed data from the page cache.")
+
+        group.add_argument('--mount', action='store_true',
+                           help="Always mount filesystem snapshots and clone volume snapshots, instead of reading "
+                                "them via .zfs/snapshot or snapshot devices. (snapdev=visible)")
+
+        group.add_argument('--sort', action='store_true',
+                           help="Always hash the files of a directory tree in sorted order. (otherwise only with "
+                                "--threads > 1, hash trees or when a manifest is stored)")
+
+        group.add_argument('--max-errors', metavar="COUNT", default=0, type=int,
+                           help="Stop comparing after COUNT errors. (0 for no limit) Default %(default)s")
+
+        group.add_argument('--no-holes', action='store_true',
+                           help="Read holes in sparse files, instead of using the digest of zeros.")
+
+        group.add_argument('--base', metavar="SNAPSHOT", default=None,
+                           help="Only hash the files that were created or modified since this earlier snapshot of the "
+                                "same filesystem. (uses zfs diff, for incremental verification)")
+
+        group.add_argument('--files-from', metavar="FILE", default=None,
+                           help="Only hash the files of the directory tree that are listed in FILE. (one relative path "
+                                "per line, use - for stdin)")
+
+        group = parser.add_argument_group('Two-sided compare options')
+
+        group.add_argument('--compare-to', metavar="TARGET", default=None,
+                           help="Compare TARGET with this target. Both are hashed at the same time, by starting "
+                                "zfs-check on their nodes. Differences are shown while they come in.")
+        group.add_argument('--ssh-config', metavar='CONFIG-FILE', default=None, help='Custom ssh client config')
+        group.add_argument('--ssh-source', metavar='USER@HOST', default=None,
+                           help='Host of TARGET. (when using --compare-to)')
+        group.add_argument('--ssh-target', metavar='USER@HOST', default=None,
+                           help='Host of the --compare-to target.')
+        group.add_argument('--check-command', metavar='COMMAND', default="zfs-check",
+                           help='Command to start zfs-check on the nodes. Default %(default)s')
+
         return parser
 
     def parse_args(self, argv):
@@ -50,26 +191,97 @@ class ZfsCheck(CliBase):
         if args.test:
             self.warning("TEST MODE - WILL ONLY DO READ-ONLY STUFF")
 
-        if args.target is None:
+        if args.target is None and args.convert is None:
             self.error("Please specify TARGET")
             sys.exit(1)
 
+        if args.format == "binary" and (args.merkle or args.merkle_serve):
+            self.error("Cant use binary format for hash trees")
+            sys.exit(255)
+
+        if args.io == "mmap" and sys.version_info[0] < 3:
+            self.error("--io mmap needs python 3")
+            sys.exit(255)
+
+        if args.offset is not None and (args.offset < 0 or args.offset > args.skip):
+            self.error("--offset should be between 0 and --skip")
+            sys.exit(255)
+
+        if args.offset is not None and args.rotate:
+            self.error("Cant use --offset and --rotate at the same time")
+            sys.exit(255)
+
+        if args.merkle_fanout < 2:
+            self.error("--merkle-fanout should be at least 2")
+            sys.exit(255)
+
+        if args.merkle_remote and args.check is not None:
+            self.error("Cant use --merkle-remote and --check at the same time")
+            sys.exit(255)
+
+        if args.compare_to is not None and (args.check is not None or args.merkle_remote or args.merkle
+                                            or args.merkle_serve or args.format == "binary"):
+            self.error("Cant use --compare-to with --check, hash trees or binary format")
+            sys.exit(255)
+
+        if args.threads < 1:
+            self.error("--threads should be at least 1")
+            sys.exit(255)
+
+        if args.base is not None and (args.files_from is not None or args.target is None or "@" not in args.target):
+            self.error("--base needs a snapshot as TARGET, and cant be used with --files-from")
+            sys.exit(255)
+
         self.verbose("Target               : {}".format(args.target))
+        if args.compare_to is not None:
+            self.verbose("Compare to           : {}".format(args.compare_to))
         self.verbose("Block size           : {} bytes".format(args.block_size))
         self.verbose("Block count          : {}".format(args.count))
         self.verbose("Effective chunk size : {} bytes".format(args.count*args.block_size))
         self.verbose("Skip chunk count     : {} (checks {:.2f}% of data)".format(args.skip, 100/(1+args.skip)))
+        if args.rotate:
+            self.verbose("Offset               : rotating")
+        else:
+            self.verbose("Offset               : {}".format(args.offset or 0))
+        self.verbose("Hash                 : {}".format(args.hash or hashers.DEFAULT_HASH))
+        self.verbose("Threads              : {}".format(args.threads))
+        self.verbose("IO mode              : {}".format(args.io))
+        if args.base is not None:
+            self.verbose("Changed since        : {}".format(args.base))
+        if args.files_from is not None:
+            self.verbose("Files from           : {}".format(args.files_from))
         self.verbose("")
 
 
         return args
 
+    def get_snapshot_dir(self, snapshot):
+        """path of the snapshot in the .zfs/snapshot directory of the mounted filesystem. None if its not accessible."""
+
+        properties = snapshot.parent.properties
+        if properties.get('mounted') != 'yes' or not properties.get('mountpoint', '').startswith('/'):
+            return None
+
+        path = os.path.join(properties['mountpoint'], ".zfs", "snapshot", snapshot.snapshot_name)
+        # (this also automounts the snapshot)
+        if not os.path.isdir(path):
+            return None
+
+        return path
+
     def prepare_zfs_filesystem(self, snapshot):
 
+        if not self.args.mount:
+            path = self.get_snapshot_dir(snapshot)
+            if path is not None:
+                self.debug("Using snapshot directory {}".format(path))
+                return path
+
         mnt = "/tmp/" + tmp_name()
         self.debug("Create temporary mount point {}".format(mnt))
         self.node.run(["mkdir", mnt])
         snapshot.mount(mnt)
+        self.cleanup_func = lambda: self.cleanup_zfs_filesystem(snapshot)
         return mnt
 
     def cleanup_zfs_filesystem(self, snapshot):
@@ -78,35 +290,92 @@ class ZfsCheck(CliBase):
         self.debug("Cleaning up temporary mount point")
         self.node.run(["rmdir", mnt], hide_errors=True, valid_exitcodes=[])
 
+    def wait_for_device(self, dataset, location):
+        """wait for /dev entry of a volume or snapshot to appear"""
+
+        dataset.debug("Waiting for /dev entry to appear: {}".format(location))
+
+        # fake it in testmode
+        if self.args.test:
+            return location
+
+        if not wait_for_path(location, 10):
+            raise (Exception("Timeout while waiting for /dev entry to appear. (looking in: {}). Hint: did you forget to load the encryption key?".format(location)))
+
+        return location
+
+    def get_local_properties(self, dataset):
+        """uncached local properties of dataset, as dict"""
+
+        return dict(self.node.run(["zfs", "get", "-H", "-s", "local", "-o", "property,value", "all", dataset.name],
+                                  tab_split=True, readonly=True, valid_exitcodes=[0]))
+
+    def prepare_zfs_volume_snapdev(self, snapshot):
+        """make the device of the snapshot visible, if it isnt already. (snapdev property)
+
+        Other zfs-checks (like parallel autoverify workers) can use snapshot devices of the same volume at the same time.
+        So every run registers itself in a user property on the volume, and only the last one restores snapdev. (see
+        SNAPDEV_PROPERTY) If a run is killed, snapdev just stays visible."""
+
+        volume = snapshot.parent
+        (snapdev, source) = self.node.run(["zfs", "get", "-H", "-o", "value,source", "snapdev", volume.name],
+                                          tab_split=True, readonly=True, valid_exitcodes=[0])[0]
+
+        if snapdev != "visible":
+            volume.set(SNAPDEV_PROPERTY, snapdev if source == "local" else "inherit")
+            volume.set("snapdev", "visible")
+        elif SNAPDEV_PROPERTY not in self.get_local_properties(volume):
+            # visible on purpose, nothing to restore
+            return self.wait_for_device(snapshot, "/dev/zvol/" + snapshot.name)
+
+        volume.set(self.get_snapdev_user_property(), int(time.time()))
+        self.cleanup_func = lambda: self.cleanup_zfs_volume_snapdev(volume)
+
+        return self.wait_for_device(snapshot, "/dev/zvol/" + snapshot.name)
+
+    @staticmethod
+    def get_snapdev_user_property():
+        """user property that tells we're using the snapshot devices of a volume"""
+        return SNAPDEV_PROPERTY + "-" + re.sub("[^a-zA-Z0-9_.:-]", "_", tmp_name())
+
+    def cleanup_zfs_volume_snapdev(self, volume):
+        """restore snapdev, if no other zfs-check uses the snapshot devices anymore"""
+
+        volume.inherit(self.get_snapdev_user_property())
+
+        properties = self.get_local_properties(volume)
+        if [name for name in properties if name.startswith(SNAPDEV_PROPERTY + "-")]:
+            volume.debug("Snapshot devices still used by another zfs-check, leaving snapdev visible")
+            return
+
+        original = properties.get(SNAPDEV_PROPERTY)
+        if original is None:
+            # (already restored by another zfs-check)
+            return
+
+        volume.inherit(SNAPDEV_PROPERTY)
+        if properties.get("snapdev") != "visible":
+            volume.debug("snapdev was changed by someone else, leaving it alone")
+        elif original == "inherit":
+            volume.inherit("snapdev")
+        else:
+            volume.set("snapdev", original)
+
     # NOTE: https://www.google.com/search?q=Mount+Path+Limit+freebsd
     # Freebsd has limitations regarding path length, so we have to clone it so the part stays sort
     def prepare_zfs_volume(self, snapshot):
-        """clone volume, waits and tries to findout /dev path to the volume, in a compatible way. (linux/freebsd/smartos)"""
+        """clone volume, waits and tries to findout /dev path to the volume, in a compatible way. (linux/freebsd/smartos)
+        On linux the snapshot device is used instead."""
+
+        if not self.args.mount and platform.system() == "Linux":
+            return self.prepare_zfs_volume_snapdev(snapshot)
 
         clone_name = get_tmp_clone_name(snapshot)
         clone = snapshot.clone(clone_name)
+        self.cleanup_func = lambda: self.cleanup_zfs_volume(snapshot)
 
         # TODO: add smartos location to this list as well
-        locations = [
-            "/dev/zvol/" + clone_name
-        ]
-
-        clone.debug("Waiting for /dev entry to appear in: {}".format(locations))
-        time.sleep(0.1)
-
-        start_time = time.time()
-        while time.time() - start_time < 10:
-            for location in locations:
-                if os.path.exists(location):
-                    return location
-
-                # fake it in testmode
-                if self.args.test:
-                    return location
-
-            time.sleep(1)
-
-        raise (Exception("Timeout while waiting for /dev entry to appear. (looking in: {}). Hint: did you forget to load the encryption key?".format(locations)))
+        return self.wait_for_device(clone, "/dev/zvol/" + clone_name)
 
     def cleanup_zfs_volume(self, snapshot):
         """destroys temporary volume snapshot"""
@@ -114,11 +383,12 @@ class ZfsCheck(CliBase):
         clone = snapshot.zfs_node.get_dataset(clone_name)
         clone.destroy(deferred=True, verbose=False)
 
-    def generate_tree_hashes(self, prepared_target):
+    def generate_tree_hashes(self, prepared_target, sort=False):
 
-        tree_hasher = TreeHasher(self.block_hasher)
+        # the hash tree needs the same order on both sides
+        tree_hasher = TreeHasher(self.block_hasher, sort=sort or self.merkle_mode or self.args.sort)
         self.debug("Hashing tree: {}".format(prepared_target))
-        for i in tree_hasher.generate(prepared_target):
+        for i in tree_hasher.generate(prepared_target, self.file_names):
             yield i
 
     def generate_tree_compare(self, prepared_target, input_generator=None):
@@ -140,66 +410,391 @@ class ZfsCheck(CliBase):
         for i in self.block_hasher.compare(prepared_target, input_generator):
             yield i
 
-    def generate_input(self):
-        """parse input lines and yield items to use in compare functions"""
+    def get_base_snapshot(self, node):
+        """ZfsDataset of the --base snapshot on node. (can also be just the snapshot name)"""
 
-        if self.args.check is True:
-            input_fh=sys.stdin
-        else:
-            input_fh=open(self.args.check, 'r')
+        if "@" in self.args.base:
+            return node.get_dataset(self.args.base)
+        return node.get_dataset(self.args.target.split("@")[0] + "@" + self.args.base)
 
-        last_progress_time = time.time()
-        progress_checked = 0
-        progress_skipped = 0
+    def get_file_names(self, node):
+        """the files we should hash, according to --base or --files-from. None to hash everything."""
+
+        if self.args.base is not None:
+            snapshot = node.get_dataset(self.args.target)
+            base_snapshot = self.get_base_snapshot(node)
+            if not base_snapshot.exists:
+                raise (Exception("ZFS snapshot {} does not exist!".format(base_snapshot)))
+            file_names = snapshot.changed_files(base_snapshot)
+            self.verbose("{} changed files since {}".format(len(file_names), base_snapshot.snapshot_name))
+            return file_names
+
+        if self.args.files_from is not None:
+            if self.args.files_from == "-":
+                lines = sys.stdin.readlines()
+            else:
+                with open(self.args.files_from, "r") as fh:
+                    lines = fh.readlines()
+            return [line.rstrip("\n") for line in lines if line.rstrip("\n")]
+
+        return None
+
+    def get_rotate_state(self):
+        return (StateFile("zfs-check-offsets.json"), "{} skip={}".format(self.args.target, self.args.skip))
+
+    def get_offset(self):
+        if not self.args.rotate:
+            return self.args.offset or 0
+
+        (state, key) = self.get_rotate_state()
+        offset = state.get(key, 0)
+        if offset > self.args.skip:
+            offset = 0
+        self.verbose("Using offset {} for this run".format(offset))
+        return offset
+
+    def advance_offset(self):
+        """use next offset next time"""
 
-        line=input_fh.readline()
-        skip=0
+        if self.args.rotate and not self.input_sampled:
+            (state, key) = self.get_rotate_state()
+            state.set(key, (self.offset + 1) % (self.args.skip + 1))
+
+    def set_sample(self, skip, offset):
+        """input was sampled by the other side with this skip and offset"""
+
+        if skip == 0:
+            return
+
+        if self.args.skip and (self.args.skip != skip or self.offset != offset):
+            self.warning("Input was already sampled with --skip {} --offset {}, using that.".format(skip, offset))
+
+        self.input_sampled = True
+        # in case we need to generate the same sample. (hash trees)
+        self.args.skip = skip
+        self.offset = offset
+        self.block_hasher.skip = skip
+        self.block_hasher._skip_count = offset
+
+    def get_header(self):
+        """returns the header fields that describe our output. (empty if its compatible with older versions)"""
+
+        header = []
+        if self.hash_name != hashers.DEFAULT_HASH:
+            header.append(("hash", self.hash_name))
+
+        # (only needed with offsets: older versions always start at 0)
+        if self.args.skip and (self.offset or self.args.rotate):
+            header.append(("skip", self.args.skip))
+            header.append(("offset", self.offset))
+
+        return header
+
+    def apply_header(self, fields):
+        """apply header fields we got from the input."""
+
+        if "hash" in fields:
+            if self.args.hash and self.args.hash != fields["hash"]:
+                raise (Exception("Input was generated with --hash {}, not {}".format(fields["hash"], self.args.hash)))
+            self.debug("Using hash algorithm from input: {}".format(fields["hash"]))
+            self.block_hasher.hash_class = hashers.hash_class(fields["hash"])
+            self.hash_name = fields["hash"]
+
+        if "skip" in fields:
+            self.set_sample(int(fields["skip"]), int(fields.get("offset", 0)))
+
+        if "merkle" in fields:
+            self.input_merkle = (int(fields["merkle"]), int(fields["leaves"]))
+
+    def apply_binary_header(self, fields):
+        """apply header of binary input. (it always specifies all settings)"""
+
+        if fields["bs"] != self.args.block_size or fields["count"] != self.args.count:
+            raise (Exception("Input was generated with --block-size {} --count {}".format(fields["bs"], fields["count"])))
+
+        self.apply_header({"hash": fields["hash"]})
+        self.set_sample(fields["skip"], fields["offset"])
+        self.input_binary_fields = fields
+
+    @property
+    def merkle_mode(self):
+        return self.args.merkle or self.args.merkle_serve or self.args.merkle_remote is not None or \
+               self.input_merkle is not None
+
+    def open_input_file(self, name):
+        """open hashes file for reading. (True or - for stdin)
+
+        returns (filehandle, is_binary)"""
+
+        if name is True or name == "-":
+            # (with python 2 stdin is always text)
+            fh = getattr(sys.stdin, "buffer", None)
+            if fh is not None and hasattr(fh, "peek") and fh.peek(len(binaryhashes.MAGIC)).startswith(binaryhashes.MAGIC):
+                return (fh, True)
+            return (sys.stdin, False)
+
+        fh = open(name, 'rb')
+        if fh.read(len(binaryhashes.MAGIC)) == binaryhashes.MAGIC:
+            fh.seek(0)
+            return (fh, True)
+        fh.close()
+
+        return (open(name, 'r'), False)
+
+    def open_input(self):
+        """open the input and read the header, if there is one. (so we know the settings before we start)"""
+
+        (self.input_fh, binary)=self.open_input_file(self.args.check)
+
+        if binary:
+            self.apply_binary_header(binaryhashes.parse_header(self.input_fh.readline()))
+            return
+
+        self.input_line=self.input_fh.readline()
+        if self.input_line.startswith(HEADER_PREFIX):
+            self.apply_header(parse_header(self.input_line))
+            self.input_line=self.input_fh.readline()
+
+    def read_input_items(self):
+        """yields all items from the input, in text or binary format"""
+
+        if self.input_binary_fields is not None:
+            for (chunk_nr, hexdigest) in binaryhashes.read_digests(self.input_fh, self.input_binary_fields):
+                yield [str(chunk_nr), hexdigest]
+            return
+
+        line=self.input_line
         while line:
             i=line.rstrip().split("\t")
             #ignores lines without tabs
             if (len(i)>1):
+                yield i
+
+            line=self.input_fh.readline()
 
-                if skip==0:
-                    progress_checked=progress_checked+1
+    def generate_input(self):
+        """parse input and yield items to use in compare functions"""
+
+        last_progress_time = time.time()
+        progress_checked = 0
+        progress_skipped = 0
+
+        if self.input_sampled:
+            for i in self.read_input_items():
+                progress_checked=progress_checked+1
+                yield i
+
+            self.verbose("Checked {} hashes".format(progress_checked))
+            return
+
+        skip=self.offset
+        for i in self.read_input_items():
+            if skip==0:
+                progress_checked=progress_checked+1
+                yield i
+                skip=self.args.skip
+            else:
+                skip=skip-1
+                progress_skipped=progress_skipped+1
+
+            if self.args.progress and time.time() - last_progress_time > 1:
+                last_progress_time = time.time()
+                self.progress("Checked {} hashes (skipped {})".format(progress_checked, progress_skipped))
+
+        self.verbose("Checked {} hashes (skipped {})".format(progress_checked, progress_skipped))
+
+    def get_manifest_path(self):
+        """path of the cached manifest of the target, or None if the target cant have one.
+
+        Only snapshots can have one, since they never change. Its keyed by host, snapshot name and guid: A received
+        snapshot has the same guid, and it should never use the manifest of the snapshot it was received from.
+        Manifests of directory trees are always in sorted order."""
+
+        if self.args.no_manifest or "@" not in self.args.target or self.file_names is not None:
+            return None
+
+        snapshot = self.node.get_dataset(self.args.target)
+        if not snapshot.exists:
+            raise Exception("ZFS snapshot {} does not exist!".format(snapshot))
+
+        return os.path.join(cache_dir(), "manifests", "{}-{}-{}-{}-{}-{}".format(
+            platform.node(), snapshot.name.replace("/", "_"), snapshot.properties['guid'], self.args.block_size,
+            self.args.count, self.hash_name))
+
+    def read_manifest(self, manifest_path):
+        """yields all items in the manifest"""
+
+        with open(manifest_path, "r") as fh:
+            for line in fh:
+                i = line.rstrip("\n").split("\t")
+                if len(i) > 1:
                     yield i
-                    skip=self.args.skip
+
+    def generate_manifest_hashes(self, manifest_path):
+        """generate hashes from manifest, applies skipping the same way as BlockHasher does"""
+
+        self.debug("Reading hashes from manifest: {}".format(manifest_path))
+        skip = self.offset
+        for i in self.read_manifest(manifest_path):
+            if skip == 0:
+                yield i
+                skip = self.args.skip
+            else:
+                skip = skip - 1
+
+    def compare_items(self, actual_items, input_generator):
+        """compare input with a list of actual items. yields the same results as the TreeHasher or BlockHasher compare() would."""
+
+        actual_hashes = {}
+        file_names = set()
+        for i in actual_items:
+            actual_hashes[tuple(i[:-1])] = i[-1]
+            if len(i) == 3:
+                file_names.add(i[0])
+
+        for i in input_generator:
+            actual_hexdigest = actual_hashes.get(tuple(i[:-1]))
+            if actual_hexdigest is None:
+                if len(i) == 3 and i[0] not in file_names:
+                    yield (i[0], '-', '-', 'ERROR: not found')
                 else:
-                    skip=skip-1
-                    progress_skipped=progress_skipped+1
+                    yield tuple(i) + ('EOF', )
+            elif actual_hexdigest != i[-1]:
+                yield tuple(i) + (actual_hexdigest, )
+
+    def generate_manifest_compare(self, manifest_path, input_generator):
+        """compare input with manifest."""
 
-                if self.args.progress and time.time() - last_progress_time > 1:
-                    last_progress_time = time.time()
-                    self.progress("Checked {} hashes (skipped {})".format(progress_checked, progress_skipped))
+        self.debug("Comparing with manifest: {}".format(manifest_path))
+        for i in self.compare_items(self.read_manifest(manifest_path), input_generator):
+            yield i
 
-            line=input_fh.readline()
+    def write_manifest(self, manifest_path, hash_generator):
+        """passes through all the hashes from hash_generator, and stores them in the manifest.
 
-        self.verbose("Checked {} hashes (skipped {})".format(progress_checked, progress_skipped))
+        The manifest is only stored when the generator completes. (so it always contains all hashes)"""
+
+        manifest_dir = os.path.dirname(manifest_path)
+        if not os.path.isdir(manifest_dir):
+            os.makedirs(manifest_dir)
+
+        tmp_path = "{}.{}.tmp".format(manifest_path, os.getpid())
+        try:
+            with open(tmp_path, "w") as fh:
+                for i in hash_generator:
+                    fh.write("\t".join(str(field) for field in i) + "\n")
+                    yield i
+
+            os.rename(tmp_path, manifest_path)
+            self.debug("Stored manifest: {}".format(manifest_path))
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def open_output(self, binary):
+        if self.args.output:
+            return open(self.args.output, "wb" if binary else "w")
+        elif binary:
+            return getattr(sys.stdout, "buffer", sys.stdout)
+        else:
+            return sys.stdout
 
     def print_hashes(self, hash_generator):
         """prints hashes that are yielded by the specified hash_generator"""
 
+        if self.args.format == "binary":
+            return self.print_binary(hash_generator, self.args.skip, self.offset)
+
         last_progress_time = time.time()
+        last_flush_time = time.time()
         progress_count = 0
+        output = self.open_output(False)
+
+        header = self.get_header()
+        if header:
+            print(format_header(header), file=output)
+            output.flush()
 
         for i in hash_generator:
 
             if len(i) == 3:
-                print("{}\t{}\t{}".format(*i))
+                print("{}\t{}\t{}".format(*i), file=output)
             else:
-                print("{}\t{}".format(*i))
+                print("{}\t{}".format(*i), file=output)
             progress_count = progress_count + 1
 
             if self.args.progress and time.time() - last_progress_time > 1:
                 last_progress_time = time.time()
                 self.progress("Generated {} hashes.".format(progress_count))
 
-            sys.stdout.flush()
+            # dont flush every line, but make sure the other side still gets a steady stream
+            if time.time() - last_flush_time > 1:
+                last_flush_time = time.time()
+                output.flush()
 
+        if self.args.output:
+            output.close()
+        else:
+            output.flush()
         self.verbose("Generated {} hashes.".format(progress_count))
         self.clear_progress()
 
         return 0
 
+    def print_binary(self, hash_generator, skip, offset):
+        """write hashes in binary format"""
+
+        def check_items():
+            for i in hash_generator:
+                if len(i) != 2:
+                    raise (Exception("Binary format is only supported for files and volumes"))
+                yield i
+
+        fields = {
+            "hash": self.hash_name,
+            "digest_size": self.block_hasher.hash_class().digest_size,
+            "bs": self.args.block_size,
+            "count": self.args.count,
+            "skip": skip,
+            "offset": offset
+        }
+        output = self.open_output(True)
+        count = binaryhashes.write_digests(output, fields, check_items())
+        if self.args.output:
+            output.close()
+
+        self.verbose("Generated {} hashes.".format(count))
+        return 0
+
+    def convert(self):
+        """convert hashes from text to binary format, or the other way around"""
+
+        (input_fh, binary)=self.open_input_file(self.args.convert)
+
+        if binary:
+            fields=binaryhashes.parse_header(input_fh.readline())
+            self.apply_binary_header(fields)
+            items=binaryhashes.read_digests(input_fh, fields)
+        else:
+            self.input_fh=input_fh
+            self.input_line=input_fh.readline()
+            if self.input_line.startswith(HEADER_PREFIX):
+                self.apply_header(parse_header(self.input_line))
+                self.input_line=input_fh.readline()
+            items=self.read_input_items()
+
+            # determine skip from the chunk numbers, for input of older versions
+            if not self.input_sampled:
+                first_items=list(itertools.islice(items, 2))
+                if len(first_items)==2:
+                    self.set_sample(int(first_items[1][0]) - int(first_items[0][0]) - 1, int(first_items[0][0]))
+                items=itertools.chain(first_items, items)
+
+        if self.args.format=="binary":
+            return self.print_binary(items, self.args.skip, self.offset)
+        else:
+            return self.print_hashes(items)
+
     def print_errors(self, compare_generator):
         """prints errors that are yielded by the specified compare_generator"""
         errors = 0
@@ -215,11 +810,48 @@ class ZfsCheck(CliBase):
 
             sys.stdout.flush()
 
+            if errors == self.args.max_errors:
+                self.verbose("Stopping after {} errors".format(errors))
+                break
+
         self.verbose("Total errors: {}".format(errors))
         self.clear_progress()
 
         return errors
 
+    def get_check_command(self, target, no_manifest=False):
+        """command line to run zfs-check on a node, with the same settings as we have
+
+        no_manifest: never use a cached manifest. (for the side thats being verified)"""
+
+        args = [target, "--block-size", self.args.block_size, "--count", self.args.count, "--hash", self.hash_name,
+                "--skip", self.args.skip, "--offset", self.offset, "--threads", self.args.threads, "--io", self.args.io,
+                "--sort"]
+        for flag in ["no_fadvise", "no_holes", "mount", "rehash", "no_manifest"]:
+            if getattr(self.args, flag) or (flag == "no_manifest" and no_manifest):
+                args.append("--" + flag.replace("_", "-"))
+
+        return self.args.check_command + " " + " ".join(cmd_quote(str(arg)) for arg in args)
+
+    def generate_two_sided_compare(self):
+        """hash TARGET and --compare-to on their nodes at the same time, and compare both streams while they come in."""
+
+        nodes = [
+            ZfsNode(self.log, utc=self.args.utc, ssh_config=self.args.ssh_config, ssh_to=self.args.ssh_source,
+                    readonly=self.args.test, debug_output=self.args.debug_output, description="[Source]"),
+            ZfsNode(self.log, utc=self.args.utc, ssh_config=self.args.ssh_config, ssh_to=self.args.ssh_target,
+                    readonly=self.args.test, debug_output=self.args.debug_output, description="[Target]")
+        ]
+        # (the compare-to side is the one we verify, so it must read the actual data)
+        commands = [self.get_check_command(self.args.target),
+                    self.get_check_command(self.args.compare_to, no_manifest=True)]
+
+        # (the changed files are determined on the source, and then hashed on both sides)
+        file_names = self.get_file_names(nodes[0])
+
+        for i in StreamCompare(nodes, commands, file_names=file_names).compare():
+            yield i
+
     def prepare_target(self):
 
         if "@" in self.args.target:
@@ -238,43 +870,274 @@ class ZfsCheck(CliBase):
         return self.args.target
 
     def cleanup_target(self):
-        if "@" in self.args.target:
-            # zfs snapshot
-            snapshot=self.node.get_dataset(self.args.target)
-            if not snapshot.exists:
-                return
+        if self.cleanup_func is not None:
+            cleanup_func = self.cleanup_func
+            self.cleanup_func = None
+            cleanup_func()
 
-            dataset_type = snapshot.parent.properties['type']
+    def collect_items(self, hash_generator):
+        """get all hashes as lists of strings, sorted so both sides have the same order"""
 
-            if dataset_type == 'volume':
-                self.cleanup_zfs_volume(snapshot)
-            elif dataset_type == 'filesystem':
-                self.cleanup_zfs_filesystem(snapshot)
+        items = [[str(field) for field in i] for i in hash_generator]
+        if items and len(items[0]) == 3:
+            items.sort(key=lambda i: (i[0], int(i[1])))
+        else:
+            items.sort(key=lambda i: int(i[0]))
+
+        self.verbose("Generated {} hashes.".format(len(items)))
+        return items
+
+    def merkle_tree(self, items, fanout):
+        """hash tree of items. the leaves are the hashes of the complete lines, so file names and chunk numbers are
+        checked as well."""
+
+        leaves = [self.block_hasher.hash_class("\t".join(i).encode('utf-8')).hexdigest() for i in items]
+        return MerkleTree(leaves, self.block_hasher.hash_class, fanout)
+
+    def print_merkle(self, hash_generator):
+        """prints hash tree, root first. followed by the normal hash lines (which are the leaves)"""
+
+        items = self.collect_items(hash_generator)
+        tree = self.merkle_tree(items, self.args.merkle_fanout)
+
+        output = self.open_output(False)
+
+        # node lines have no tabs, so older versions will just check the leaves
+        print(format_header(self.get_header() + [("merkle", self.args.merkle_fanout), ("leaves", len(items))]), file=output)
+        for level in range(tree.height, 0, -1):
+            for node in tree.levels[level]:
+                print("M{} {}".format(level, node), file=output)
+
+        for i in items:
+            print("\t".join(i), file=output)
+
+        if self.args.output:
+            output.close()
+        else:
+            output.flush()
+        return 0
+
+    def merkle_serve(self, hash_generator):
+        """answer requests from --merkle-remote on stdin.
+
+        requests:
+          nodes LEVEL INDEX...  one line with the node digests. ("-" if it doesnt exist)
+          items INDEX...        one line per leaf, with the hash line. ("-" if it doesnt exist)
+
+        reply lines start with =, so the other side can ignore log output.
+        """
+
+        items = self.collect_items(hash_generator)
+        tree = self.merkle_tree(items, self.args.merkle_fanout)
+
+        print(format_header(self.get_header() + [("merkle", self.args.merkle_fanout), ("leaves", len(items))]))
+        sys.stdout.flush()
+
+        line = sys.stdin.readline()
+        while line:
+            request = line.split()
+            if request[0] == "nodes":
+                nodes = tree.get_nodes(int(request[1]), [int(index) for index in request[2:]])
+                print("=" + " ".join(node or "-" for node in nodes))
+            elif request[0] == "items":
+                for index in request[1:]:
+                    index = int(index)
+                    print("=" + ("\t".join(items[index]) if index < len(items) else "-"))
+            else:
+                raise (Exception("Invalid merkle request: {}".format(line)))
+            sys.stdout.flush()
+            line = sys.stdin.readline()
+
+        return 0
+
+    def start_merkle_remote(self):
+        """start the remote zfs-check, so it hashes at the same time as we do"""
+
+        self.debug("Starting: {}".format(self.args.merkle_remote))
+        self.merkle_process = subprocess.Popen(self.args.merkle_remote, shell=True, stdin=subprocess.PIPE,
+                                               stdout=subprocess.PIPE, universal_newlines=True)
+
+    def merkle_remote_input(self):
+        """returns (fanout, leaf_count, get_nodes, get_items) to talk to the remote zfs-check"""
+
+        process = self.merkle_process
+
+        def read_reply():
+            line = process.stdout.readline()
+            while line and not line.startswith("="):
+                line = process.stdout.readline()
+            if not line:
+                raise (Exception("Remote zfs-check exited unexpectedly"))
+            return line[1:].rstrip("\n")
+
+        # wait until the remote is done hashing
+        line = process.stdout.readline()
+        while line and not line.startswith(HEADER_PREFIX):
+            line = process.stdout.readline()
+        if not line:
+            raise (Exception("Remote zfs-check exited unexpectedly"))
+
+        fields = parse_header(line)
+        if fields.get("hash", hashers.DEFAULT_HASH) != self.hash_name:
+            raise (Exception("Remote uses --hash {}, not {}".format(fields.get("hash", hashers.DEFAULT_HASH), self.hash_name)))
+
+        def get_nodes(level, indexes):
+            process.stdin.write("nodes {} {}\n".format(level, " ".join(str(index) for index in indexes)))
+            process.stdin.flush()
+            return [None if node == "-" else node for node in read_reply().split(" ")][:len(indexes)]
+
+        def get_items(indexes):
+            if not indexes:
+                return []
+            process.stdin.write("items {}\n".format(" ".join(str(index) for index in indexes)))
+            process.stdin.flush()
+            replies = [read_reply() for index in indexes]
+            return [reply.split("\t") for reply in replies if reply != "-"]
+
+        return (int(fields["merkle"]), int(fields["leaves"]), get_nodes, get_items)
+
+    def merkle_stream_input(self):
+        """returns (fanout, leaf_count, get_nodes, get_items) to read nodes from the --merkle input.
+
+        Reads only as far as needed: Levels are read from the top, and when a level matches we stop reading."""
+
+        (fanout, leaf_count) = self.input_merkle
+        sizes = MerkleTree.level_sizes(leaf_count, fanout)
+        levels = {}
+        items = []
+        pending = [self.input_line]
+
+        def read_level(level):
+            while len(levels.get(level, [])) < sizes[level]:
+                if pending:
+                    line = pending.pop()
+                else:
+                    line = self.input_fh.readline()
+                if not line:
+                    raise (Exception("Hash tree in input is incomplete"))
+
+                if line.startswith("M"):
+                    (node_level, node) = line[1:].rstrip().split(" ")
+                    levels.setdefault(int(node_level), []).append(node)
+                else:
+                    i = line.rstrip("\n").split("\t")
+                    if len(i) > 1:
+                        items.append(i)
+                        levels.setdefault(0, []).append(
+                            self.block_hasher.hash_class(line.rstrip("\n").encode('utf-8')).hexdigest())
+
+        def get_nodes(level, indexes):
+            read_level(level)
+            nodes = levels.get(level, [])
+            return [nodes[index] if index < len(nodes) else None for index in indexes]
+
+        def get_items(indexes):
+            read_level(0)
+            return [items[index] for index in indexes if index < len(items)]
+
+        return (fanout, leaf_count, get_nodes, get_items)
+
+    def generate_merkle_compare(self, hash_generator):
+        """compare hashes with the hash tree of the other side"""
+
+        items = self.collect_items(hash_generator)
+
+        if self.merkle_process is not None:
+            (fanout, leaf_count, get_nodes, get_items) = self.merkle_remote_input()
+        else:
+            (fanout, leaf_count, get_nodes, get_items) = self.merkle_stream_input()
+
+        tree = self.merkle_tree(items, fanout)
+        stats = {"nodes": 0}
+
+        def get_nodes_counted(level, indexes):
+            stats["nodes"] = stats["nodes"] + len(indexes)
+            return get_nodes(level, indexes)
+
+        different = tree.diff(get_nodes_counted, leaf_count)
+        self.verbose("Compared {} tree nodes, {} hashes differ.".format(stats["nodes"], len(different)))
+
+        for i in self.compare_items(items, get_items(different)):
+            yield i
 
     def run(self):
 
         compare_generator=None
         hash_generator=None
+        cleanup_needed=False
         try:
-            prepared_target=self.prepare_target()
-            is_dir=os.path.isdir(prepared_target)
+            if self.args.convert is not None:
+                return self.convert()
+
+            if self.args.compare_to is not None:
+                compare_generator = self.generate_two_sided_compare()
+                errors = self.print_errors(compare_generator)
+                self.advance_offset()
+                return errors
 
-            #run as compare
             if self.args.check is not None:
-                input_generator=self.generate_input()
-                if is_dir:
-                    compare_generator = self.generate_tree_compare(prepared_target, input_generator)
+                self.open_input()
+
+            if self.args.merkle_remote:
+                self.start_merkle_remote()
+
+            merkle_check = self.merkle_process is not None or self.input_merkle is not None
+
+            # (when comparing, the input determines which files are compared)
+            if self.args.check is None:
+                self.file_names = self.get_file_names(self.node)
+
+            manifest_path=self.get_manifest_path()
+            use_manifest=manifest_path is not None and not self.args.rehash and os.path.exists(manifest_path)
+            if use_manifest:
+                self.verbose("Using cached manifest")
+
+            #run as compare
+            if self.args.check is not None and not merkle_check:
+                if use_manifest:
+                    compare_generator=self.generate_manifest_compare(manifest_path, self.generate_input())
                 else:
-                    compare_generator=self.generate_file_compare(prepared_target, input_generator)
+                    cleanup_needed=True
+                    prepared_target=self.prepare_target()
+                    input_generator=self.generate_input()
+                    if os.path.isdir(prepared_target):
+                        compare_generator = self.generate_tree_compare(prepared_target, input_generator)
+                    else:
+                        compare_generator=self.generate_file_compare(prepared_target, input_generator)
                 errors=self.print_errors(compare_generator)
-            #run as generator
+
+            #run as generator (also needed to compare hash trees)
             else:
-                if is_dir:
-                    hash_generator = self.generate_tree_hashes(prepared_target)
+                if use_manifest:
+                    hash_generator=self.generate_manifest_hashes(manifest_path)
+                else:
+                    # only a complete run can be used as manifest
+                    store_manifest = manifest_path is not None and self.args.skip == 0
+
+                    cleanup_needed=True
+                    prepared_target=self.prepare_target()
+                    if os.path.isdir(prepared_target):
+                        # manifests are always sorted, so that later runs with --sort and --skip sample the same chunks
+                        hash_generator = self.generate_tree_hashes(prepared_target, sort=store_manifest)
+                    elif self.file_names is not None:
+                        raise (Exception("--base and --files-from only work with directory trees"))
+                    else:
+                        hash_generator=self.generate_file_hashes(prepared_target)
+
+                    if store_manifest:
+                        hash_generator=self.write_manifest(manifest_path, hash_generator)
+
+                if merkle_check:
+                    compare_generator=self.generate_merkle_compare(hash_generator)
+                    errors=self.print_errors(compare_generator)
+                elif self.args.merkle_serve:
+                    errors=self.merkle_serve(hash_generator)
+                elif self.args.merkle:
+                    errors=self.print_merkle(hash_generator)
                 else:
-                    hash_generator=self.generate_file_hashes(prepared_target)
+                    errors=self.print_hashes(hash_generator)
 
-                errors=self.print_hashes(hash_generator)
+            self.advance_offset()
 
         except Exception as e:
             self.error("Exception: " + str(e))
@@ -294,7 +1157,11 @@ class ZfsCheck(CliBase):
                 hash_generator.close()
             if compare_generator is not None:
                 compare_generator.close()
-            self.cleanup_target()
+            if cleanup_needed:
+                self.cleanup_target()
+            if self.merkle_process is not None:
+                self.merkle_process.stdin.close()
+                self.merkle_process.wait()
 
         return errors
 
@@ -5,6 +5,7 @@ import time
 
 from .CachedProperty import CachedProperty
 from .ExecuteNode import ExecuteError
+from .LogStub import format_log
 
 
 class ZfsDataset:
@@ -19,6 +20,9 @@ class ZfsDataset:
         'volume': ["canmount"],
     }
 
+    # with --zfs-compressed, datasets with at least this compressratio are sent without --compress
+    COMPRESSED_RATIO = 1.5
+
     def __init__(self, zfs_node, name, force_exists=None):
         """
         Args:
@@ -65,18 +69,21 @@ class ZfsDataset:
         """
         self.zfs_node.warning("{}: {}".format(self.name, txt))
 
-    def debug(self, txt):
+    def debug(self, txt, *args):
         """
         Args:
             :type txt: str
+            :param args: formatted into txt, only if debugging is enabled
         """
-        self.zfs_node.debug("{}: {}".format(self.name, txt))
+        if self.zfs_node.is_debug():
+            self.zfs_node.debug("{}: {}".format(self.name, format_log(txt, args)))
 
     def invalidate(self):
         """clear caches"""
         CachedProperty.clear(self)
         self.force_exists = None
         self._virtual_snapshots = []
+        self._known_properties = {}
 
     def split_path(self):
         """return the path elements as an array"""
@@ -355,19 +362,49 @@ class ZfsDataset:
     def properties(self):
         """all zfs properties"""
 
-        cmd = [
+        self.debug("Getting zfs properties")
+
+        return self.parse_properties(
+            self.zfs_node.run(tab_split=True, cmd=self.properties_cmd(), readonly=True, valid_exitcodes=[0]))
+
+    def properties_cmd(self):
+        """command to get all zfs properties. (also used by ZfsNode.prefetch_properties())"""
+
+        return [
             "zfs", "get", "-H", "-o", "property,value", "-p", "all", self.name
         ]
 
-        self.debug("Getting zfs properties")
+    @staticmethod
+    def parse_properties(lines):
+        """parse the tab splitted output of properties_cmd()"""
 
         ret = {}
-        for pair in self.zfs_node.run(tab_split=True, cmd=cmd, readonly=True, valid_exitcodes=[0]):
+        for pair in lines:
             if len(pair) == 2:
                 ret[pair[0]] = pair[1]
 
         return ret
 
+    def set_known_properties(self, properties):
+        """store property values we already got from somewhere else. (e.g. the systemwide zfs get in
+        ZfsNode.selected_datasets()) This prevents a zfs get all, if these are the only properties we need.
+
+        Args:
+            :type properties: dict[str, str]
+        """
+        self._known_properties.update(properties)
+
+    def get_property(self, name):
+        """get the value of one zfs property. Uses the known properties if possible, otherwise gets all properties.
+
+        Args:
+            :type name: str
+        """
+        if name in self._known_properties:
+            return self._known_properties[name]
+
+        return self.properties[name]
+
     def is_changed(self, min_changed_bytes=1):
         """dataset is changed since ANY latest snapshot ?
 
@@ -379,7 +416,7 @@ class ZfsDataset:
         if min_changed_bytes == 0:
             return True
 
-        if int(self.properties['written']) < min_changed_bytes:
+        if int(self.get_property('written')) < min_changed_bytes:
             return False
         else:
             return True
@@ -764,12 +801,16 @@ class ZfsDataset:
 
     def transfer_snapshot(self, target_snapshot, features, prev_snapshot, show_progress,
                           filter_properties, set_properties, ignore_recv_exit_code, resume_token,
-                          raw, send_properties, write_embedded, send_pipes, recv_pipes, zfs_compressed, force):
+                          raw, send_properties, write_embedded, send_pipes, recv_pipes, zfs_compressed, force,
+                          stream_checksum_property=None):
         """transfer this snapshot to target_snapshot. specify prev_snapshot for
         incremental transfer
 
         connects a send_pipe() to recv_pipe()
 
+        stream_checksum_property: the pipes hash the stream on both sides. (mbuffer -H) Compare these hashes and store
+        it in this property of both snapshots.
+
         Args:
             :type send_pipes: list[str]
             :type recv_pipes: list[str]
@@ -809,12 +850,35 @@ class ZfsDataset:
                                   set_properties=set_properties, ignore_exit_code=ignore_recv_exit_code,
                                   recv_pipes=recv_pipes, force=force)
 
+        if stream_checksum_property and not self.zfs_node.readonly:
+            self.check_stream_hashes(target_snapshot, stream_checksum_property, store=not resume_token)
+
         # try to automount it, if its the initial transfer
         if not prev_snapshot:
             # in test mode it doesnt actually exist, so dont try to mount it/read properties
             if not target_snapshot.zfs_node.readonly:
                 target_snapshot.parent.automount()
 
+    def check_stream_hashes(self, target_snapshot, stream_checksum_property, store):
+        """compare the hashes of the stream that was just sent and received, and store them in both snapshots"""
+
+        source_hash = self.zfs_node.pop_stream_hash()
+        target_hash = target_snapshot.zfs_node.pop_stream_hash()
+
+        # (it was asked for, so we cant consider it ok without them)
+        if source_hash is None or target_hash is None:
+            raise (Exception("Didnt get a stream checksum from both sides (does mbuffer support -H?)"))
+
+        if source_hash != target_hash:
+            raise (Exception("Stream checksum mismatch: sent {}, received {}".format(source_hash, target_hash)))
+
+        self.debug("Stream checksum ok: {}".format(source_hash))
+
+        # (a resumed stream is incomplete)
+        if store:
+            self.set(stream_checksum_property, source_hash)
+            target_snapshot.set(stream_checksum_property, target_hash)
+
     def abort_resume(self):
         """abort current resume state"""
         self.debug("Aborting resume")
@@ -982,7 +1046,7 @@ class ZfsDataset:
 
         allowed_filter_properties = []
         allowed_set_properties = []
-        illegal_properties = self.ILLEGAL_PROPERTIES[self.properties['type']]
+        illegal_properties = self.ILLEGAL_PROPERTIES[self.get_property('type')]
         for set_property in set_properties:
             (property_, value) = set_property.split("=")
             if property_ not in illegal_properties:
@@ -1126,13 +1190,35 @@ class ZfsDataset:
                 if len(incompatible_target_snapshots) > 0:
                     self.rollback()
 
+    def is_compressed_stream(self, raw, zfs_compressed):
+        """returns the reason why the zfs send stream of this dataset is (mostly) incompressible, or None.
+
+        Args:
+            :type raw: bool
+            :type zfs_compressed: bool
+        """
+
+        if raw:
+            return "raw encrypted stream"
+
+        if zfs_compressed and self.properties.get('compression', 'off') != 'off':
+            ratio = float(self.properties.get('compressratio', '1').rstrip('x'))
+            if ratio >= self.COMPRESSED_RATIO:
+                return "already compressed by zfs (compression={}, compressratio={:.2f}x)".format(
+                    self.properties['compression'], ratio)
+
+        return None
+
     def sync_snapshots(self, target_dataset, features, show_progress, filter_properties, set_properties,
                        ignore_recv_exit_code, holds, rollback, decrypt, encrypt, also_other_snapshots,
                        no_send, destroy_incompatible, send_pipes, recv_pipes, zfs_compressed, force, guid_check,
-                       clones, make_target_name):
+                       clones, make_target_name, stream_checksum_property=None, plain_pipes=None):
         """sync this dataset's snapshots to target_dataset, while also thinning
         out old snapshots along the way.
 
+        plain_pipes: (send_pipes, recv_pipes) without compression. These are used instead if the stream of this dataset
+        is already compressed. (see is_compressed_stream())
+
         Args:
             :type send_pipes: list[str]
             :type recv_pipes: list[str]
@@ -1150,6 +1236,8 @@ class ZfsDataset:
             :type guid_check: bool
             :type clones: str
             :type make_target_name: Callable[[ZfsDataset], str]
+            :type stream_checksum_property: str
+            :type plain_pipes: tuple[list[str], list[str]]
         """
 
         # self.verbose("-> {}".format(target_dataset))
@@ -1169,6 +1257,13 @@ class ZfsDataset:
                 # keep data encrypted by sending it raw (including properties)
                 raw = True
 
+        # compressing it again is useless?
+        if plain_pipes is not None:
+            reason = self.is_compressed_stream(raw, zfs_compressed)
+            if reason:
+                self.verbose("Not using compression: {}".format(reason))
+                (send_pipes, recv_pipes) = plain_pipes
+
         (common_snapshot, start_snapshot, source_obsoletes, target_obsoletes, target_keeps,
          incompatible_target_snapshots) = \
             self._plan_sync(target_dataset=target_dataset, also_other_snapshots=also_other_snapshots,
@@ -1232,7 +1327,8 @@ class ZfsDataset:
                                                   ignore_recv_exit_code=ignore_recv_exit_code,
                                                   resume_token=resume_token, write_embedded=write_embedded, raw=raw,
                                                   send_properties=send_properties, send_pipes=send_pipes,
-                                                  recv_pipes=recv_pipes, zfs_compressed=zfs_compressed, force=force)
+                                                  recv_pipes=recv_pipes, zfs_compressed=zfs_compressed, force=force,
+                                                  stream_checksum_property=stream_checksum_property)
 
                 resume_token = None
 
@@ -1267,6 +1363,52 @@ class ZfsDataset:
 
             source_snapshot = self.find_next_snapshot(source_snapshot, also_other_snapshots, clones=clones)
 
+    def changed_files(self, base_snapshot):
+        """returns the regular files that are created, modified or renamed since base_snapshot, according to zfs diff.
+        (paths are relative to the root of the filesystem. this should be a snapshot)
+
+        :type base_snapshot: ZfsDataset
+        """
+
+        self.debug("Getting changed files since {}".format(base_snapshot.snapshot_name))
+
+        mountpoint = self.parent.properties['mountpoint']
+        if not mountpoint.startswith("/"):
+            raise (Exception("Cant determine changed files: mountpoint is {}".format(mountpoint)))
+        prefix = mountpoint.rstrip("/") + "/"
+
+        cmd = [
+            "zfs", "diff", "-H", "-F", base_snapshot.name, self.name
+        ]
+
+        file_names = []
+        for fields in self.zfs_node.run(cmd=cmd, tab_split=True, readonly=True, valid_exitcodes=[0]):
+            # change type, file type, path [, new path]
+            (change, file_type) = fields[0:2]
+            if change == "-" or file_type != "F":
+                continue
+
+            path = self.unescape_diff_path(fields[-1])
+            if not path.startswith(prefix):
+                raise (Exception("Unexpected path in zfs diff output: {}".format(path)))
+            file_names.append(path[len(prefix):])
+
+        return file_names
+
+    @staticmethod
+    def unescape_diff_path(path):
+        """zfs diff escapes spaces, backslashes and other unprintable bytes as \\0ooo"""
+
+        data = bytearray()
+        pos = 0
+        for match in re.finditer(r"\\([0-7]{4})", path):
+            data.extend(path[pos:match.start()].encode('utf-8'))
+            data.append(int(match.group(1), 8))
+            pos = match.end()
+        data.extend(path[pos:].encode('utf-8'))
+
+        return data.decode('utf-8', 'replace')
+
     def mount(self, mount_point):
 
         self.debug("Mounting")
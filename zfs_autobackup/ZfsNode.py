@@ -13,15 +13,19 @@ from .CachedProperty import CachedProperty
 from .ZfsPool import ZfsPool
 from .ZfsDataset import ZfsDataset
 from .ExecuteNode import ExecuteError
-from .util import datetime_now
+from .LogStub import format_log
+from .util import datetime_now, run_parallel
 
 
 class ZfsNode(ExecuteNode):
     """a node that contains zfs datasets. implements global (systemwide/pool wide) zfs commands"""
 
+    # properties that are also requested when selecting datasets, and that are used afterwards. (see selected_datasets())
+    SELECT_PROPERTIES = ["createtxg", "written", "type", "referenced"]
+
     def __init__(self, logger, utc=False, snapshot_time_format="", hold_name="", ssh_config=None, ssh_to=None, readonly=False,
                  description="",
-                 debug_output=False, thinner=None, exclude_snapshot_patterns=[]):
+                 debug_output=False, thinner=None, exclude_snapshot_patterns=[], probe_cache=None):
 
         self.utc = utc
         self.snapshot_time_format = snapshot_time_format
@@ -33,6 +37,9 @@ class ZfsNode(ExecuteNode):
 
         self.exclude_snapshot_patterns = exclude_snapshot_patterns
 
+        # StateFile to remember probe results in, or None
+        self.probe_cache = probe_cache
+
         if ssh_config:
             self.verbose("Using custom SSH config: {}".format(ssh_config))
 
@@ -58,6 +65,9 @@ class ZfsNode(ExecuteNode):
         self._progress_total_bytes = 0
         self._progress_start_time = time.time()
 
+        # last md5 hash of a stream that was printed by mbuffer -H. (see pop_stream_hash())
+        self._stream_hash = None
+
         ExecuteNode.__init__(self, ssh_config=ssh_config, ssh_to=ssh_to, readonly=readonly, debug_output=debug_output)
 
     def thin(self, objects, keep_objects):
@@ -68,27 +78,59 @@ class ZfsNode(ExecuteNode):
         else:
             return (keep_objects, [])
 
+    @CachedProperty
+    def zfs_version(self):
+        """version string of zfs userland and kernel module. None if this zfs implementation cant tell us"""
+
+        try:
+            return " ".join(self.run(["zfs", "--version"], readonly=True, hide_errors=True, valid_exitcodes=[0]))
+        except ExecuteError:
+            return None
+
+    def cached_probe(self, name, probe):
+        """return result of probe(). The result is remembered in the probe cache, per node and zfs version.
+
+        :type name: str
+        :type probe: Callable
+        """
+
+        if self.probe_cache is None or self.zfs_version is None:
+            return probe()
+
+        key = "{} {}".format(self, name)
+        cached = self.probe_cache.get(key)
+        if cached is not None and cached.get("zfs_version") == self.zfs_version:
+            self.debug("Cached {}: {}", name, cached["result"])
+            return cached["result"]
+
+        result = probe()
+        self.probe_cache.set(key, {"zfs_version": self.zfs_version, "result": result})
+        return result
+
+    def probe_options(self, cmd, options):
+        """returns list of options that are supported by the zfs command cmd. (tests them all at the same time)"""
+
+        # not every zfs implementation supports them all
+        supported = run_parallel([
+            lambda option=option: self.valid_command(cmd + [option, "zfs_autobackup_option_test"])
+            for option in options
+        ])
+
+        return [option for (option, valid) in zip(options, supported) if valid]
+
     @CachedProperty
     def supported_send_options(self):
         """list of supported options, for optimizing sends"""
-        # not every zfs implementation supports them all
 
-        ret = []
-        for option in ["-L", "-e", "-c"]:
-            if self.valid_command(["zfs", "send", option, "zfs_autobackup_option_test"]):
-                ret.append(option)
-        return ret
+        return self.cached_probe("supported_send_options",
+                                 lambda: self.probe_options(["zfs", "send"], ["-L", "-e", "-c"]))
 
     @CachedProperty
     def supported_recv_options(self):
         """list of supported options"""
-        # not every zfs implementation supports them all
 
-        ret = []
-        for option in ["-s"]:
-            if self.valid_command(["zfs", "recv", option, "zfs_autobackup_option_test"]):
-                ret.append(option)
-        return ret
+        return self.cached_probe("supported_recv_options",
+                                 lambda: self.probe_options(["zfs", "recv"], ["-s"]))
 
     def valid_command(self, cmd):
         """test if a specified zfs options are valid exit code. use this to determine support options"""
@@ -100,6 +142,33 @@ class ZfsNode(ExecuteNode):
 
         return True
 
+    def prefetch_properties(self, datasets, parallel=16):
+        """get the properties of all datasets at the same time, instead of one zfs get per dataset when they're needed.
+        (uses asyncio, only on python 3.5+. Failures are ignored here: Those datasets will just get them later.)
+
+        :type datasets: list of ZfsDataset
+        :param parallel: max number of zfs commands at the same time
+        """
+
+        if sys.version_info < (3, 5):
+            return
+
+        from .AsyncCmdPipe import gather_bounded, run_sync
+
+        datasets = [dataset for dataset in datasets if not CachedProperty.is_cached(dataset, 'properties')]
+        if not datasets:
+            return
+
+        self.debug("Getting zfs properties of {} datasets".format(len(datasets)))
+        results = run_sync(gather_bounded(
+            [self.run_async(tab_split=True, cmd=dataset.properties_cmd(), readonly=True, valid_exitcodes=[0],
+                            hide_errors=True)
+             for dataset in datasets], parallel, return_exceptions=True))
+
+        for (dataset, lines) in zip(datasets, results):
+            if not isinstance(lines, Exception):
+                CachedProperty.set(dataset, 'properties', dataset.parse_properties(lines))
+
     def get_pool(self, dataset):
         """get a ZfsPool() object from dataset. stores objects internally to enable caching"""
 
@@ -123,6 +192,13 @@ class ZfsNode(ExecuteNode):
     def parse_zfs_progress(self, line, hide_errors, prefix):
         """try to parse progress output of zfs recv -Pv, and don't show it as error to the user """
 
+        # stream hash of mbuffer -H?
+        match = re.match("md5 hash: *([0-9a-f]+)", line.strip(), re.IGNORECASE)
+        if match:
+            self.debug("{}{}", prefix, line.rstrip())
+            self._stream_hash = match.group(1).lower()
+            return
+
         # is it progress output?
         progress_fields = line.rstrip().split("\t")
 
@@ -133,7 +209,7 @@ class ZfsNode(ExecuteNode):
                 re.match("send from .*estimated size is ", line)):
 
             # always output for debugging offcourse
-            self.debug(prefix + line.rstrip())
+            self.debug("{}{}", prefix, line.rstrip())
 
             # actual useful info
             if len(progress_fields) >= 3:
@@ -163,13 +239,19 @@ class ZfsNode(ExecuteNode):
 
         # still do the normal stderr output handling
         if hide_errors:
-            self.debug(prefix + line.rstrip())
+            self.debug("{}{}", prefix, line.rstrip())
         else:
             self.error(prefix + line.rstrip())
 
     # def _parse_stderr_pipe(self, line, hide_errors):
     #     self.parse_zfs_progress(line, hide_errors, "STDERR|> ")
 
+    def pop_stream_hash(self):
+        """returns md5 hash of the last stream that was hashed on this node, and forgets it. None if there is none."""
+        stream_hash = self._stream_hash
+        self._stream_hash = None
+        return stream_hash
+
     def _parse_stderr(self, line, hide_errors):
         self.parse_zfs_progress(line, hide_errors, "STDERR > ")
 
@@ -182,8 +264,12 @@ class ZfsNode(ExecuteNode):
     def warning(self, txt):
         self.logger.warning("{} {}".format(self.description, txt))
 
-    def debug(self, txt):
-        self.logger.debug("{} {}".format(self.description, txt))
+    def is_debug(self):
+        return self.logger.is_debug()
+
+    def debug(self, txt, *args):
+        if self.logger.is_debug():
+            self.logger.debug("{} {}".format(self.description, format_log(txt, args)))
 
     def consistent_snapshot(self, datasets, snapshot_name, min_changed_bytes, pre_snapshot_cmds=[],
                             post_snapshot_cmds=[], set_snapshot_properties=[]):
@@ -240,20 +326,36 @@ class ZfsNode(ExecuteNode):
                 except Exception as e:
                     pass
 
-    def selected_datasets(self, property_name, exclude_received, exclude_paths, exclude_unchanged):
+    def selected_datasets(self, property_name, exclude_received, exclude_paths, exclude_unchanged,
+                          extra_properties=None):
         """determine filesystems that should be backed up by looking at the special autobackup-property, systemwide
 
+           extra_properties: also get these properties in the same command, for later use. ("-" if its not set)
+
            returns: (list of selected ZfsDataset sorted by createtxg, list of excluded ZfsDataset)
         """
 
+        if extra_properties is None:
+            extra_properties = []
+
         self.debug("Getting selected datasets")
 
-        # get all source filesystems that have the backup property
+        # get all source filesystems that have the backup property. also get the properties that are needed later
+        # on, so that selecting takes only one command, no matter how many datasets there are.
         lines = self.run(tab_split=True, readonly=True, cmd=[
             "zfs", "get", "-t", "volume,filesystem", "-Hp",
-            property_name + ",createtxg"
+            ",".join([property_name] + self.SELECT_PROPERTIES + extra_properties)
         ])
 
+        # group the properties per dataset. (keep the order of zfs get, so parents are always before their childs)
+        names = []
+        properties = {}
+        for line in lines:
+            (name, prop_name, value, raw_source) = line
+            if name not in properties:
+                names.append(name)
+                properties[name] = {}
+            properties[name][prop_name] = (value, raw_source)
 
         # The returnlist of selected ZfsDataset's:
         selected_filesystems = []
@@ -262,16 +364,18 @@ class ZfsNode(ExecuteNode):
         # list of sources, used to resolve inherited sources
         sources = {}
 
-        for line in lines:
-            (name, prop_name, value, raw_source) = line
-            if prop_name == "createtxg":
-                # createtxg for the last dataset
-                if selected_filesystems and selected_filesystems[-1].name == name:
-                    selected_filesystems[-1].createtxg = int(value)
-            if prop_name != property_name:
-                continue
+        for name in names:
+            (value, raw_source) = properties[name][property_name]
             dataset = self.get_dataset(name, force_exists=True)
 
+            # feed the other properties into the dataset cache
+            known_properties = {}
+            for prop_name in self.SELECT_PROPERTIES + extra_properties:
+                if prop_name in properties[name]:
+                    known_properties[prop_name] = properties[name][prop_name][0]
+            dataset.set_known_properties(known_properties)
+            dataset.createtxg = int(known_properties["createtxg"])
+
             # "resolve" inherited sources
             sources[name] = raw_source
             if raw_source.find("inherited from ") == 0:
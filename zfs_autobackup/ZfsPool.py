@@ -1,4 +1,5 @@
 from .CachedProperty import CachedProperty
+from .LogStub import format_log
 
 
 class ZfsPool():
@@ -29,8 +30,9 @@ class ZfsPool():
     def error(self, txt):
         self.zfs_node.error("zpool {}: {}".format(self.name, txt))
 
-    def debug(self, txt):
-        self.zfs_node.debug("zpool {}: {}".format(self.name, txt))
+    def debug(self, txt, *args):
+        if self.zfs_node.is_debug():
+            self.zfs_node.debug("zpool {}: {}".format(self.name, format_log(txt, args)))
 
     @CachedProperty
     def properties(self):
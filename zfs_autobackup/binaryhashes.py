@@ -0,0 +1,87 @@
+import binascii
+
+# Compact binary format for zfs-check hashes of files and volumes:
+#
+#  ZFSCHECKBIN1 hash=sha1 digest_size=20 bs=4096 count=25600 skip=0 offset=0\n
+#  <raw digest of chunk offset><raw digest of chunk offset+skip+1><raw digest of chunk offset+2*(skip+1)>...
+#
+# Digests have a fixed size, so chunk numbers are implicit and digest i can be found at header_size+i*digest_size.
+# (so the file can also be used with mmap or seek())
+
+MAGIC = b"ZFSCHECKBIN1"
+
+# number of digests per read or write
+BATCH_SIZE = 65536
+
+
+def format_header(fields):
+    """fields: list of (key, value)"""
+    return MAGIC + "".join(" {}={}".format(key, value) for (key, value) in fields).encode('ascii') + b"\n"
+
+
+def parse_header(line):
+    fields = {}
+    for token in line[len(MAGIC):].decode('ascii').split():
+        (key, value) = token.split("=", 1)
+        fields[key] = value
+
+    fields.setdefault("offset", "0")
+    for key in ["digest_size", "bs", "count", "skip", "offset"]:
+        if key not in fields:
+            raise (Exception("Invalid binary hash file: missing {} in header".format(key)))
+        fields[key] = int(fields[key])
+
+    return fields
+
+
+def chunk_nr(fields, index):
+    """chunk number of digest index"""
+    return fields['offset'] + index * (fields['skip'] + 1)
+
+
+def write_digests(fh, fields, hash_generator):
+    """write header and all hashes from hash_generator (chunk_nr, hexdigest) to binary filehandle.
+    returns number of digests written."""
+
+    fh.write(format_header([(key, fields[key]) for key in ["hash", "digest_size", "bs", "count", "skip", "offset"]]))
+
+    index = 0
+    buffer = bytearray()
+    for (nr, hexdigest) in hash_generator:
+        if int(nr) != chunk_nr(fields, index):
+            raise (Exception("Chunk {} cant be stored in binary format: expected chunk {}".format(nr, chunk_nr(fields, index))))
+
+        digest = binascii.unhexlify(hexdigest)
+        if len(digest) != fields['digest_size']:
+            raise (Exception("Digest of chunk {} has wrong size".format(nr)))
+
+        buffer.extend(digest)
+        index = index + 1
+        if index % BATCH_SIZE == 0:
+            fh.write(buffer)
+            buffer = bytearray()
+
+    fh.write(buffer)
+    fh.flush()
+    return index
+
+
+def read_digests(fh, fields):
+    """yields (chunk_nr, hexdigest) from binary filehandle, positioned after the header."""
+
+    digest_size = fields['digest_size']
+    step = fields['skip'] + 1
+    nr = chunk_nr(fields, 0)
+    while True:
+        data = fh.read(digest_size * BATCH_SIZE)
+        if not data:
+            return
+        if len(data) % digest_size:
+            raise (Exception("Binary hash file is truncated"))
+
+        # hexlify everything at once, much faster than per digest
+        hexdata = binascii.hexlify(data).decode('ascii')
+        hex_size = digest_size * 2
+        for offset in range(0, len(hexdata), hex_size):
+            yield (nr, hexdata[offset:offset + hex_size])
+            nr = nr + step
@@ -0,0 +1,35 @@
+import hashlib
+
+# Hash algorithms zfs-check can use. sha1 is the default, since thats what older versions always used.
+# For integrity checks we dont need cryptographic strength, so the faster ones are fine as well.
+
+HASH_CLASSES = {
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+}
+
+# python 3.6+
+if hasattr(hashlib, 'blake2b'):
+    HASH_CLASSES['blake2b'] = hashlib.blake2b
+
+# optional, non-cryptographic and much faster: pip install xxhash
+try:
+    import xxhash
+
+    HASH_CLASSES['xxh64'] = xxhash.xxh64
+    if hasattr(xxhash, 'xxh128'):
+        HASH_CLASSES['xxh128'] = xxhash.xxh128
+except ImportError:
+    pass
+
+DEFAULT_HASH = 'sha1'
+
+
+def hash_class(name):
+    if name not in HASH_CLASSES:
+        raise (Exception("Hash algorithm {} not available here. (available: {})".format(name, ", ".join(choices()))))
+    return HASH_CLASSES[name]
+
+
+def choices():
+    return sorted(HASH_CLASSES.keys())
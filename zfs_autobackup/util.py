@@ -3,7 +3,9 @@
 import os
 import platform
 import sys
+from collections import deque
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 
 def tmp_name(suffix=""):
@@ -24,6 +26,116 @@ def get_tmp_clone_name(snapshot):
 
 
 
+def run_parallel(funcs):
+    """call all funcs at the same time in separate threads, and wait until they're all done.
+
+    Use this for things that have to wait on something else. (like commands that run remotely)
+    returns list of results. re-raises the first exception that occurred."""
+
+    if not funcs:
+        return []
+
+    pool = ThreadPool(len(funcs))
+    try:
+        results = [pool.apply_async(func) for func in funcs]
+        return [result.get() for result in results]
+    finally:
+        pool.terminate()
+
+
+def parallel_map(func, iterable, threads):
+    """like map(), but calls func in multiple threads. Still yields the results in the original order.
+
+    Only a limited number of items is in flight (threads*2), so it also works for huge or endless iterables.
+    The iterable itself is always consumed in the calling thread. re-raises exceptions of func."""
+
+    pool = ThreadPool(threads)
+    pending = deque()
+    try:
+        for item in iterable:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= threads * 2:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+# inotify constants (from sys/inotify.h)
+IN_CREATE = 0x100
+IN_MOVED_TO = 0x80
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+
+def inotify_init():
+    """returns (libc, fd) of a new inotify instance, or None if inotify isnt available on this platform."""
+
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError, TypeError):
+        return None
+
+    if fd < 0:
+        return None
+
+    return (libc, fd)
+
+
+def wait_for_path(path, timeout):
+    """wait until path exists. returns False on timeout.
+
+    Uses inotify to wake up as soon as something is created in the (deepest existing) parent directory, otherwise
+    polls every 0.1 seconds.
+    """
+
+    import select
+    import time
+
+    end_time = time.time() + timeout
+    inotify = inotify_init()
+    try:
+        while not os.path.exists(path):
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                return False
+
+            if inotify is None:
+                time.sleep(min(remaining, 0.1))
+                continue
+
+            (libc, fd) = inotify
+            watch_dir = os.path.dirname(path)
+            while not os.path.isdir(watch_dir):
+                watch_dir = os.path.dirname(watch_dir)
+
+            if libc.inotify_add_watch(fd, watch_dir.encode('utf-8'), IN_CREATE | IN_MOVED_TO) < 0:
+                time.sleep(min(remaining, 0.1))
+                continue
+
+            # (the path might have been created before the watch was added)
+            if os.path.exists(path):
+                return True
+
+            if select.select([fd], [], [], remaining)[0]:
+                # just clear the events, we check the path ourselves
+                try:
+                    while os.read(fd, 4096):
+                        pass
+                except OSError:
+                    pass
+
+        return True
+    finally:
+        if inotify is not None:
+            os.close(inotify[1])
+
+
 def output_redir():
     """use this after a BrokenPipeError to prevent further exceptions.
     Redirects stdout/err to /dev/null